@@ -0,0 +1,309 @@
+import math
+import numpy as np
+import pandas as pd
+from psi_protocol import SCHEME_BFV
+
+# Values that can be aggregated: Alice's Salary, Bob's Bonus, or their sum
+VALUES = ("Salary", "Bonus", "TotalComp")
+AGGREGATES = ("count", "sum", "mean", "sum_sq", "var", "std")
+# The original single statistic: SUM(Salary + Bonus) per Department
+DEFAULT_STATS = (("TotalComp", "sum"),)
+DEFAULT_GROUP_BY = ("Department",)
+# The only group-by column on Bob's side; every other column is Alice's
+BOB_GROUP_COLUMN = "Department"
+# What Bob assumes when a request has no layout: one segment, Enc(Salary) + Bonus
+DEFAULT_LAYOUT = {"segments": [{"weight": "one", "add": "bonus", "scale": 1}], "group_by_department": True}
+
+# Each per-group quantity is a sum of terms (Alice's per-row monomial, Bob's
+# per-row factor). Monomials: "one" = 1, "salary" = S, "salary_sq" = S^2.
+# Factors: "one" = 1, "bonus" = B, "bonus_sq" = B^2, "2bonus" = 2B.
+QUANTITY_TERMS = {
+    "count": [("one", "one")],
+    "sum_Salary": [("salary", "one")],
+    "sum_Bonus": [("one", "bonus")],
+    "sum_TotalComp": [("salary", "one"), ("one", "bonus")],
+    "sq_Salary": [("salary_sq", "one")],
+    "sq_Bonus": [("one", "bonus_sq")],
+    "sq_TotalComp": [("salary_sq", "one"), ("salary", "2bonus"), ("one", "bonus_sq")],
+}
+
+def _quantities(value, aggregate) -> list:
+    if aggregate == "count":
+        return ["count"]
+    if aggregate == "sum":
+        return [f"sum_{value}"]
+    if aggregate == "mean":
+        return [f"sum_{value}", "count"]
+    if aggregate == "sum_sq":
+        return [f"sq_{value}"]
+    return [f"sq_{value}", f"sum_{value}", "count"]
+
+def group_stride(num_groups) -> int:
+    """
+    Slots per segment in a packed result: the next power of two >= num_groups.
+    """
+    return 1 << max(0, (num_groups - 1).bit_length())
+
+def stat_column(value, aggregate) -> str:
+    return "count" if aggregate == "count" else f"{value}_{aggregate}"
+
+def slot_positions(num_rows, num_segments, span=None, block_rows=None):
+    """
+    Where the rows of a chunk go: returns (positions, vector length) with
+    positions[j, r] the slot of row r in segment j.
+
+    Without span the segments simply follow each other. With span, slots
+    form blocks of `span` slots holding block_rows rows each (the rest is
+    zero padding), and block q * num_segments + j holds the q-th block_rows
+    rows of segment j.
+    """
+    r = np.arange(num_rows)
+    segment = np.arange(num_segments)[:, None]
+    if not span:
+        return segment * num_rows + r, num_segments * num_rows
+    blocks = (r // block_rows) * num_segments + segment
+    return blocks * span + r % block_rows, num_segments * -(-num_rows // block_rows) * span
+
+def segment_vectors(layout, bonuses, groups, stride, integer=False):
+    """
+    Bob's side of a layout (AggregationLayout.wire()) for one chunk, given his
+    bonuses and group number of each row. Returns the arguments for
+    group_sum: (group_index, num_groups, span, weights, addends), where
+    weights and addends are None if every segment uses 1 / 0. Addends are
+    divided by their segment's scale (always 1 for BFV).
+    """
+    segments = layout["segments"]
+    span = layout.get("span")
+    positions, length = slot_positions(len(groups), len(segments), span, layout.get("block_rows"))
+    dtype = np.int64 if integer else np.float64
+    b = np.asarray(bonuses, dtype=dtype)
+    factors = {"one": np.ones_like(b), "bonus": b, "bonus_sq": b * b, "2bonus": 2 * b}
+
+    # Blocks are summed separately, so there every segment uses slots 0..stride-1
+    group_index = np.zeros(length, dtype=np.int64)
+    for j, pos in enumerate(positions):
+        group_index[pos] = groups if span else j * stride + np.asarray(groups)
+    num_groups = stride if span else len(segments) * stride
+
+    weights = addends = None
+    if any(s["weight"] != "one" for s in segments):
+        weights = np.ones(length, dtype=dtype)
+        for s, pos in zip(segments, positions):
+            weights[pos] = factors[s["weight"]]
+    if any(s.get("add") for s in segments):
+        addends = np.zeros(length, dtype=dtype)
+        for s, pos in zip(segments, positions):
+            if s.get("add"):
+                addends[pos] = factors[s["add"]] if integer else factors[s["add"]] / s["scale"]
+    return group_index, num_groups, span, weights, addends
+
+class AggregationLayout:
+    """
+    Packs several statistics over several group-by columns into one
+    encrypted pass.
+
+    Every chunk of rows is encrypted as one vector holding several segments.
+    Segment j holds an Alice-side monomial of each row (1, Salary or
+    Salary^2, masked to one band of Alice's group-by columns). Bob turns it
+    into monomial * factor + addend with his Bonus, using a plaintext add
+    and weights folded into group_sum's masks, so the multiplicative depth
+    stays 1. One group_sum per chunk then sums every segment per department.
+    With several segments the slots are cut into blocks (see slot_positions)
+    that group_sum folds separately, so it still needs only one mask per
+    department and each extra segment costs about what its slots cost.
+
+    Alice's group-by columns (e.g. an Age band) never reach Bob: rows outside
+    a band simply contribute 0 to that band's segments. Without such
+    columns, Bob-only terms (count, sums of B or B^2) ride along as addends
+    on a segment of the same quantity, which keeps the layout small.
+    For CKKS, segments whose values are much larger than Salary + Bonus
+    (squares, S * 2B) are scaled down by a power of two, so the parameters
+    stay those of the plain sum. Their absolute error grows by that factor.
+    """
+    def __init__(self, stats=DEFAULT_STATS, group_by=DEFAULT_GROUP_BY, bins=None):
+        """
+        stats: (value, aggregate) pairs, value in VALUES and aggregate in
+               AGGREGATES; "count" alone also works.
+        group_by: "Department" (Bob's) and/or columns of Alice's data.
+        bins: optional {column: bin edges} to group Alice's numeric columns by band.
+        """
+        stats = [("", "count") if s == "count" else tuple(s) for s in stats]
+        for value, aggregate in stats:
+            if aggregate not in AGGREGATES or (aggregate != "count" and value not in VALUES):
+                raise ValueError(f"Unsupported statistic {(value, aggregate)}; "
+                                 f"values are {VALUES}, aggregates {AGGREGATES}")
+        self.stats = stats
+        self.group_by = list(group_by)
+        self.by_bob = BOB_GROUP_COLUMN in self.group_by
+        self.alice_columns = [c for c in self.group_by if c != BOB_GROUP_COLUMN]
+        self.bins = dict(bins or {})
+        quantities = [q for value, aggregate in stats for q in _quantities(value, aggregate)]
+        # Empty (band, department) cells are only recognizable by their count
+        if self.alice_columns:
+            quantities.append("count")
+        self.quantities = list(dict.fromkeys(quantities))
+        self.segments = []
+        self.stride = 1
+        self.span = self.block_rows = None
+
+    def alice_columns_needed(self) -> list:
+        return ["Salary"] + self.alice_columns
+
+    def set_rows(self, frame):
+        """
+        Alice's intersection rows (Salary plus her group-by columns), in the
+        order they will be sent. Assigns every row to a band.
+        """
+        self.salaries = frame["Salary"].to_numpy(dtype=np.int64)
+        if self.alice_columns:
+            keys = [pd.cut(frame[c], self.bins[c], right=False) if c in self.bins else frame[c]
+                    for c in self.alice_columns]
+            codes, self.bands = pd.MultiIndex.from_arrays(keys).factorize()
+            self.band_codes = codes
+            self.bands = list(self.bands)
+        else:
+            self.band_codes = np.zeros(len(frame), dtype=np.int64)
+            self.bands = [()]
+
+    def plan(self, value_bound, scheme, stride=1):
+        """
+        Builds the segments for the rows given to set_rows. value_bound is
+        Bob's power-of-two bound on Bonus, stride the result slots per
+        segment (group_stride of Bob's groups). Returns (values per row,
+        result slots, largest slot magnitude), the inputs for plan_he_params.
+        """
+        salary_bound = float(np.abs(self.salaries).max()) if len(self.salaries) else 0.0
+        mono_bound = {"one": 1.0, "salary": salary_bound, "salary_sq": salary_bound ** 2, None: 0.0}
+        factor_bound = {"one": 1.0, "bonus": value_bound, "bonus_sq": value_bound ** 2, "2bonus": 2 * value_bound, None: 0.0}
+        base = max(salary_bound + value_bound, 1.0)
+        single_band = not self.alice_columns
+
+        segments = []
+        for band in range(len(self.bands)):
+            for quantity in self.quantities:
+                alice_terms = [t for t in QUANTITY_TERMS[quantity] if not (single_band and t[0] == "one" and t[1] != "one")]
+                bob_terms = [t[1] for t in QUANTITY_TERMS[quantity] if t not in alice_terms]
+                if not alice_terms:
+                    alice_terms = [(None, "one")]
+                for i, (monomial, weight) in enumerate(alice_terms):
+                    # Bob-only terms are added once, on the quantity's first segment
+                    add = bob_terms[0] if bob_terms and i == 0 else None
+                    bound = mono_bound[monomial] * factor_bound[weight] + factor_bound[add]
+                    scale = 1
+                    if scheme != SCHEME_BFV and bound > base:
+                        scale = 2 ** math.ceil(math.log2(bound / base))
+                    segments.append({"band": band, "quantity": quantity, "monomial": monomial,
+                                     "weight": weight, "add": add, "scale": scale, "bound": bound / scale})
+        self.segments = segments
+        self.stride = stride
+        # Blocks of at least twice the stride, one per segment, must fit
+        slots = stride if len(segments) == 1 else 2 * len(segments) * stride
+        return len(segments), slots, max(s["bound"] for s in segments)
+
+    def wire(self) -> dict:
+        """
+        What Bob needs: per segment his factor, addend and scale, and whether
+        to group by Department.
+        """
+        return {
+            "segments": [{"weight": s["weight"], "add": s["add"], "scale": s["scale"]} for s in self.segments],
+            "group_by_department": self.by_bob,
+            "span": self.span,
+            "block_rows": self.block_rows
+        }
+
+    def pack(self, slot_count, bfv=False) -> int:
+        """
+        Picks the block size for a ciphertext of slot_count slots and
+        returns the rows per chunk. A single segment fills the slots as they
+        are. Otherwise a block of span slots (a power of two within one SIMD
+        row) holds span - stride rows, the padding leaving room for
+        group_sum's rotations; the span that fits the most rows wins.
+        """
+        num_segments = len(self.segments)
+        self.span = self.block_rows = None
+        if num_segments == 1:
+            self.chunk_rows = slot_count
+            return slot_count
+        row_size = slot_count // 2 if bfv else slot_count
+        best = (0, None)
+        span = 2 * self.stride
+        while span <= row_size:
+            rows = slot_count // span // num_segments * (span - self.stride)
+            if rows > best[0]:
+                best = (rows, span)
+            span *= 2
+        if not best[0]:
+            raise ValueError(f"{num_segments} segments do not fit in {slot_count} slots")
+        self.chunk_rows, self.span = best
+        self.block_rows = self.span - self.stride
+        return self.chunk_rows
+
+    def encode(self, start, stop, integer=False) -> list:
+        """
+        Alice's plaintext vector for rows [start, stop), laid out by slot_positions.
+        """
+        s = self.salaries[start:stop]
+        in_band = self.band_codes[start:stop]
+        monomials = {"one": np.ones(len(s), dtype=np.int64), "salary": s, "salary_sq": s * s,
+                     None: np.zeros(len(s), dtype=np.int64)}
+        positions, length = slot_positions(len(s), len(self.segments), self.span, self.block_rows)
+        vector = np.zeros(length, dtype=np.int64 if integer else np.float64)
+        for seg, pos in zip(self.segments, positions):
+            values = np.where(in_band == seg["band"], monomials[seg["monomial"]], 0)
+            vector[pos] = values if integer else values / seg["scale"]
+        return vector.tolist()
+
+    def _segment_totals(self, slots, g, stride):
+        # Segment j's total for group g: one slot, or one slot per block of segment j
+        num_segments = len(self.segments)
+        if not self.span:
+            return [slots[j * stride + g] for j in range(num_segments)]
+        num_blocks = num_segments * (self.chunk_rows // self.block_rows)
+        return slots[:num_blocks * self.span].reshape(-1, num_segments, self.span)[:, :, g].sum(axis=0)
+
+    def decode(self, slots, groups, stride) -> pd.DataFrame:
+        """
+        Turns the decrypted slots into one row per (Alice band, department)
+        with a column per statistic.
+        """
+        # BFV slots are exact integers and stay so
+        slots = np.asarray(slots)
+        records = []
+        for dept, g in groups.items():
+            totals = {}
+            for seg, total in zip(self.segments, self._segment_totals(slots, g, stride)):
+                key = (seg["band"], seg["quantity"])
+                totals[key] = totals.get(key, 0) + total * seg["scale"]
+            for band, labels in enumerate(self.bands):
+                q = {quantity: totals[(band, quantity)] for quantity in self.quantities}
+                if "count" in q:
+                    q["count"] = round(q["count"])
+                    if self.alice_columns and not q["count"]:
+                        continue
+                record = dict(zip(self.alice_columns, labels))
+                if self.by_bob:
+                    record[BOB_GROUP_COLUMN] = dept
+                for value, aggregate in self.stats:
+                    record[stat_column(value, aggregate)] = self._statistic(q, value, aggregate)
+                records.append(record)
+        columns = [c for c in self.group_by] + [stat_column(v, a) for v, a in self.stats]
+        return pd.DataFrame(records, columns=columns)
+
+    @staticmethod
+    def _statistic(q, value, aggregate):
+        if aggregate == "count":
+            return q["count"]
+        if aggregate == "sum":
+            return q[f"sum_{value}"]
+        if aggregate == "sum_sq":
+            return q[f"sq_{value}"]
+        count = q["count"]
+        if not count:
+            return float("nan")
+        mean = q[f"sum_{value}"] / count
+        if aggregate == "mean":
+            return mean
+        # Population variance
+        var = max(q[f"sq_{value}"] / count - mean * mean, 0.0)
+        return var if aggregate == "var" else math.sqrt(var)
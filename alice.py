@@ -1,93 +1,220 @@
+import os
+import pickle
+import shutil
 import socket
+import tempfile
 import pandas as pd
-from psi_protocol import PSIProtocol, SecureAggregator
-from data_generator import generate_data
+from psi_protocol import PSIProtocol, SecureAggregator, plan_he_params, DEFAULT_HE_PRECISION, SCHEME_CKKS, SCHEME_BFV, DEFAULT_MAX_FP, DEFAULT_MAX_QUERY_SIZE, expected_false_positives, truncate_points, decrypt_payloads
+import numpy as np
+from point_array import PointArray
+from blinded_cache import BlindedSetCache
+from curves import CURVE_PREFERENCE, CURVE_P256, key_file_name
+from row_index import unpack_rows
+from cardinality import hash_ids, sample_mask, sample_rate_for, estimate_cardinality, DEFAULT_CARDINALITY_SAMPLE, DEFAULT_CONFIDENCE
+from aggregation import AggregationLayout, DEFAULT_STATS, DEFAULT_GROUP_BY, group_stride, stat_column
+from out_of_core import SpillFile, intersect_files, iter_id_chunks, iter_rows, load_indices, DEFAULT_READ_ROWS, DEFAULT_MEMORY_BYTES
+from data_generator import generate_party, ALICE
 import network_utils
-from tqdm import tqdm
+from event_log import EventLog, DEFAULT_LOG_CAPACITY, DEBUG, INFO, WARNING, ERROR
+from metrics import Metrics
+import threading
+from collections import deque
 import time
-import tenseal as ts
+from functools import wraps
+
+def timed_phase(phase):
+    """
+    Records the duration of a client method in the phase_seconds histogram.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer("phase_seconds", phase=phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 class AliceClient:
-    def __init__(self, host='127.0.0.1', port=5000):
+    def __init__(self, host='127.0.0.1', port=5000, workers=None, cache_dir=None, curves=CURVE_PREFERENCE,
+                 log_capacity=DEFAULT_LOG_CAPACITY, log_level="info"):
+        """
+        cache_dir: if set, Bob's offline set for unbalanced PSI is persisted there.
+        curves: PSI curves Alice accepts, most preferred first; connect() agrees
+                on one of them with Bob (PSI_HELLO).
+        log_capacity, log_level: size of the event ring buffer and the lowest level kept (None = off).
+        """
         self.host = host
         self.port = port
         self.socket = None
-        self.psi = PSIProtocol()
+        self.curves = list(curves)
+        # Counters/histograms for blinding, messages, HE ops and phase latency
+        self.metrics = Metrics(prefix="alice_")
+        self.psi = PSIProtocol(workers=workers, metrics=self.metrics, curve=self.curves[0])
+        self.cache_dir = cache_dir
         self.df_alice = None
         self.intersection_ids = []
+        # Row positions of intersection_ids in df_alice (ascending)
+        self.intersection_rows = None
+        # File-backed dataset (load_file) and the row-number file run_psi_file writes
+        self.data_file = None
+        self.intersection_path = None
         self.joined_data = None
         self.aggregated_data = None
-        self.logs = []
+        # Last run_psi_cardinality result
+        self.cardinality = None
+        self.offline_set = None
+        # Delta PSI: persisted key, H(x)^a cache and last results (created lazily)
+        self.delta_psi = None
+        self.delta_cache = None
+        self.delta_state = None
+        # Long-lived HE context for this session and its content-hash ID
+        self.he_context = None
+        self.he_context_id = None
+        self.he_params = None
+        # Bounded, thread-safe event buffer (see log() / logs)
+        self.events = EventLog(log_capacity, log_level)
+
+    def log(self, message, level=INFO, **fields):
+        self.events.emit(level, message, **fields)
 
-    def log(self, message):
-        timestamp = time.strftime("%H:%M:%S")
-        entry = f"[{timestamp}] {message}"
-        print(entry)
-        self.logs.append(entry)
+    @property
+    def logs(self) -> list:
+        """
+        Formatted lines of the events still in the log, oldest first.
+        """
+        return self.events.lines()
 
     def generate_data(self):
         self.log("Generating data for Alice...")
-        self.df_alice, _ = generate_data()
+        self.df_alice = generate_party(ALICE)
+        self.data_file = None
         self.log(f"Alice has {len(self.df_alice)} rows.")
         return self.df_alice
 
+    def load_file(self, path):
+        """
+        Uses a .csv / .parquet file that may not fit in memory as Alice's data;
+        run it through run_psi_file.
+        """
+        self.data_file = path
+        self.df_alice = None
+        self.log(f"Alice's data is file-backed: {path}")
+
     def connect(self):
         self.log(f"Connecting to Bob at {self.host}:{self.port}...")
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
             self.log("Connected successfully.")
-            return True
         except Exception as e:
-            self.log(f"Connection failed: {e}")
+            self.log(f"Connection failed: {e}", level=ERROR)
+            return False
+        if not self._negotiate_curve():
+            self.socket.close()
+            self.socket = None
+            return False
+        return True
+
+    def _negotiate_curve(self):
+        """
+        PSI handshake: offers our curves to Bob and switches to the one he picks.
+        """
+        network_utils.send_msg(self.socket, {"command": "PSI_HELLO", "curves": self.curves}, metrics=self.metrics)
+        msg = self._recv_reply()
+        if msg is None:
             return False
+        curve = msg["curve"]
+        if curve != self.psi.curve.name:
+            workers = self.psi.workers
+            self.psi.close()
+            self.psi = PSIProtocol(workers=workers, metrics=self.metrics, curve=curve)
+        if self.delta_psi is not None and self.delta_psi.curve.name != curve:
+            # Delta state is per curve; the right one is loaded on the next run
+            self.delta_psi.close()
+            self.delta_psi = self.delta_cache = self.delta_state = None
+        self.log(f"Using curve {curve} for PSI.")
+        return True
+
+    def _recv_reply(self):
+        """
+        Receives Bob's reply, returning None (and logging why) if the
+        connection closed or Bob answered with an error (e.g. busy/timeout).
+        """
+        msg = network_utils.recv_msg(self.socket, metrics=self.metrics)
+        if msg is None:
+            self.log("Connection closed by Bob.", level=WARNING)
+            return None
+        if "error" in msg:
+            self.log(f"Bob returned an error: {msg['error']}", level=WARNING)
+            return None
+        return msg
 
-    def run_psi(self, progress_callback=None):
+    @timed_phase("psi")
+    def run_psi(self, progress_callback=None, compact=False, max_fp=DEFAULT_MAX_FP, with_payload=False):
+        """
+        compact: Bob sends truncated digests of H(y)^b instead of full points.
+                 Alice unblinds her A^ab to A^b and checks membership, so her
+                 work and the transfer no longer scale with 32 bytes per Bob row.
+        max_fp: bound on the expected number of false matches in compact mode.
+        with_payload: Bob attaches his row (Department, Bonus) to each blinded
+                 value, encrypted so that only matches can be opened; joined_data
+                 is filled in the same round trip and run_join is not needed.
+        """
         if not self.socket:
-            self.log("Not connected.")
+            self.log("Not connected.", level=WARNING)
             return None
+        if compact and with_payload:
+            raise ValueError("compact and with_payload cannot be combined")
 
         self.log("Starting PSI Protocol (Optimized Cryptography)...")
         alice_ids = self.df_alice["ID"].tolist()
         
         # 1. Blind Items (H(x)^a)
         # Note: In optimized protocol, this is ECDH half-step: a * H(x)
-        alice_blinded = []
-        total = len(alice_ids)
-        for i, uid in enumerate(alice_ids):
-            # Map to curve
-            pt = self.psi.hash_to_curve_public_key(uid)
-            # Apply private key (ECDH) -> returns x-coord bytes
-            blinded = self.psi.apply_private_key(pt)
-            alice_blinded.append(blinded)
-            if progress_callback and i % 10 == 0:
-                progress_callback(i / total)
-        
-        if progress_callback: progress_callback(1.0)
+        alice_blinded = self.psi.blind_many(alice_ids, progress_callback=progress_callback)
 
         # 2. Send to Bob
         self.log("Sending blinded items to Bob...")
-        network_utils.send_msg(self.socket, {"command": "PSI", "points": alice_blinded})
+        request = {"command": "PSI", "points": alice_blinded, "curve": self.psi.curve.name}
+        if compact:
+            request.update({"compact": True, "max_fp": max_fp})
+        if with_payload:
+            request["payload"] = True
+        network_utils.send_msg(self.socket, request, metrics=self.metrics)
         
         # 3. Receive A^b (Alice's items blinded by Bob)
         self.log("Waiting for Bob's response...")
-        msg = network_utils.recv_msg(self.socket)
+        msg = self._recv_reply()
+        if msg is None:
+            return None
         alice_blinded_by_bob = msg["points"]
+        key_points = msg.get("key_points")
         
         # 4. Receive B^b (Bob's items blinded by Bob)
         # Bob calculates H(y)^b and sends it.
         # Actually Bob sends H(y)^b. Alice computes (H(y)^b)^a.
-        msg = network_utils.recv_msg(self.socket)
+        msg = self._recv_reply()
+        if msg is None:
+            return None
+
+        if compact:
+            # 5'. Unblind A^ab -> A^b and compare digests against Bob's B^b digests
+            num_bytes = msg["digest_bytes"]
+            bob_digests = msg["digests"]
+            expected_fp = expected_false_positives(len(alice_ids), len(bob_digests), num_bytes)
+            self.log(f"Received {len(bob_digests)} {num_bytes}-byte digests "
+                     f"(expected false positives {expected_fp:.2e}).")
+            alice_blinded_by_b = self.psi.unblind_many(alice_blinded_by_bob)
+            self._intersect(alice_ids, truncate_points(alice_blinded_by_b, num_bytes), bob_digests)
+            self.log(f"Intersection found: {len(self.intersection_ids)} items.")
+            return self.intersection_ids
+
         bob_blinded = msg["points"]
         
         # 5. Compute B^ba = (H(y)^b)^a
         self.log("Computing final intersection...")
-        bob_blinded_by_alice = []
-        for p in bob_blinded:
-            # p is x-coord bytes from Bob.
-            # We treat it as public key and apply 'a'.
-            val = self.psi.apply_private_key(p)
-            bob_blinded_by_alice.append(val)
+        # p is x-coord bytes from Bob. We treat it as public key and apply 'a'.
+        bob_blinded_by_alice = self.psi.reblind_many(bob_blinded)
         
         # 6. Intersect
         # Intersection is where A^ab == B^ba ?
@@ -95,104 +222,721 @@ class AliceClient:
         # Bob sent B^b. Alice computed (B^b)^a = B^ba.
         # If A=B, then A^ab == B^ba (commutativity).
         
-        bob_set = set(bob_blinded_by_alice)
-            
-        self.intersection_ids = []
-        for i, val in enumerate(alice_blinded_by_bob):
-            if val in bob_set:
-                self.intersection_ids.append(alice_ids[i])
-        
+        if with_payload:
+            self._intersect_with_payload(alice_ids, alice_blinded_by_bob, key_points, bob_blinded_by_alice,
+                                         msg["payloads"], msg["schema"])
+            self.log(f"Intersection found: {len(self.intersection_ids)} items, with Bob's rows attached.")
+            return self.intersection_ids
+
+        self._intersect(alice_ids, alice_blinded_by_bob, bob_blinded_by_alice)
         self.log(f"Intersection found: {len(self.intersection_ids)} items.")
         return self.intersection_ids
 
+    def _intersect_with_payload(self, alice_ids, alice_values, key_points, bob_values, payloads, schema):
+        """
+        Like _intersect, and also decrypts Bob's payload for each match: its key
+        comes from unblinding A^ab2 to H(x)^b2, which only works for our own
+        items. The decrypted rows become joined_data.
+        """
+        found = PointArray.from_list(alice_values).find(PointArray.from_list(bob_values))
+        matched = np.nonzero(found >= 0)[0]
+        ok, records = decrypt_payloads(self.psi.unblind_many(key_points[matched]), payloads[found[matched]])
+        # A payload that doesn't open means a false match
+        matched = matched[ok]
+        self.intersection_ids = [alice_ids[i] for i in matched]
+        self.intersection_rows = matched
+        self.intersection_path = None
+        self.joined_data = pd.concat([self.df_alice.iloc[matched].reset_index(drop=True),
+                                      unpack_rows(records[ok], schema)], axis=1)
+        return self.intersection_ids
+
+    def _offline_set_path(self):
+        return os.path.join(self.cache_dir, f"bob_offline_{self.host}_{self.port}.pkl")
+
+    def _load_offline_set(self):
+        if self.offline_set is None and self.cache_dir:
+            path = self._offline_set_path()
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self.offline_set = pickle.load(f)
+        return self.offline_set
+
+    @timed_phase("psi_setup")
+    def fetch_offline_set(self, max_query_size=DEFAULT_MAX_QUERY_SIZE, max_fp=DEFAULT_MAX_FP):
+        """
+        Offline phase of unbalanced PSI: downloads digests of Bob's H(y)^b, or
+        confirms the cached copy is still current for Bob's key epoch and data version.
+        max_query_size is the largest query the digests are sized for.
+        """
+        if not self.socket:
+            self.log("Not connected.", level=WARNING)
+            return None
+
+        cached = self._load_offline_set()
+        request = {"command": "PSI_SETUP", "max_query_size": max_query_size, "max_fp": max_fp,
+                   "curve": self.psi.curve.name}
+        if cached:
+            request.update({"epoch": cached["epoch"], "version": cached["version"]})
+        network_utils.send_msg(self.socket, request, metrics=self.metrics)
+
+        msg = self._recv_reply()
+        if msg is None:
+            return None
+        if msg.get("unchanged"):
+            self.log(f"Offline set is current (epoch {msg['epoch']}, version {msg['version']}).")
+            return self.offline_set
+
+        self.offline_set = {
+            "epoch": msg["epoch"],
+            "version": msg["version"],
+            "max_query_size": max_query_size,
+            "digest_bytes": msg["digest_bytes"],
+            "digests": msg["digests"]
+        }
+        self.log(f"Fetched offline set: {len(self.offline_set['digests'])} "
+                 f"{msg['digest_bytes']}-byte digests (epoch {msg['epoch']}, version {msg['version']}).")
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._offline_set_path(), 'wb') as f:
+                pickle.dump(self.offline_set, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return self.offline_set
+
+    def _delta_key_path(self):
+        return os.path.join(self.cache_dir, key_file_name("alice_delta_key", self.psi.curve.name))
+
+    def _delta_state_path(self):
+        suffix = "" if self.psi.curve.name == CURVE_P256 else f"_{self.psi.curve.name}"
+        return os.path.join(self.cache_dir, f"psi_delta_{self.host}_{self.port}{suffix}.pkl")
+
+    def _empty_delta_state(self):
+        return {"alice_epoch": self.delta_psi.key_fingerprint(), "bob_epoch": None, "bob_version": None,
+                "ab": {}, "bob_ba": PointArray.empty()}
+
+    def _load_delta_state(self):
+        """
+        Loads the delta-PSI key for the session's curve (alice_delta_key*.pem, kept across sessions),
+        the on-disk H(x)^a cache and the last A^ab / B^ba results for this Bob.
+        Results computed under another Alice key are discarded.
+        """
+        if self.delta_psi is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.delta_psi = PSIProtocol.from_key_file(self._delta_key_path(), workers=self.psi.workers,
+                                                       metrics=self.metrics, curve=self.psi.curve.name)
+            self.delta_cache = BlindedSetCache(self.delta_psi, BlindedSetCache.path_for(self.cache_dir, self.delta_psi,
+                                                                                       name="alice_blinded"))
+        if self.delta_state is None:
+            path = self._delta_state_path()
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    state = pickle.load(f)
+                if state.get("alice_epoch") == self.delta_psi.key_fingerprint():
+                    state["bob_ba"] = PointArray(state["bob_ba"])
+                    self.delta_state = state
+            if self.delta_state is None:
+                self.delta_state = self._empty_delta_state()
+        return self.delta_state
+
+    def _save_delta_state(self):
+        state = dict(self.delta_state, bob_ba=self.delta_state["bob_ba"].data)
+        tmp_path = self._delta_state_path() + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._delta_state_path())
+
+    def rotate_delta_key(self):
+        """
+        Starts a new Alice key epoch for delta PSI; the next run is a full refresh.
+        """
+        self._load_delta_state()
+        self.delta_psi.close()
+        for path in (self._delta_key_path(), self._delta_state_path(), self.delta_cache.path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.delta_psi = self.delta_cache = self.delta_state = None
+        self.log("Delta PSI key rotated.")
+
+    @timed_phase("psi_delta")
+    def run_psi_delta(self, progress_callback=None):
+        """
+        Incremental PSI for repeated runs against the same Bob (needs cache_dir).
+        Alice keeps her delta key, H(x)^a and the last A^ab and B^ba on disk.
+        A re-run blinds only new IDs and sends them with the PSI_DELTA command;
+        Bob returns their A^ab and the changes to his set since the version
+        Alice last saw. Removed IDs are simply retired from the cache, since
+        Bob holds no per-Alice state, so the elliptic-curve work is O(changes).
+        If Bob rotated his key the whole set is refreshed; rotate_delta_key
+        does the same for Alice's side.
+        """
+        if not self.socket or not self.cache_dir:
+            self.log("Cannot run delta PSI: No connection or no cache_dir.", level=WARNING)
+            return None
+
+        state = self._load_delta_state()
+        alice_ids = self.df_alice["ID"].tolist()
+        added, removed = self.delta_cache.sync(alice_ids, progress_callback=progress_callback)
+        current = set(alice_ids)
+        for uid in [uid for uid in state["ab"] if uid not in current]:
+            del state["ab"][uid]
+        self.log(f"Delta PSI: {added} IDs newly blinded, {removed} retired.")
+
+        for _ in range(2):
+            need = [uid for uid in dict.fromkeys(alice_ids) if uid not in state["ab"]]
+            network_utils.send_msg(self.socket, {
+                "command": "PSI_DELTA",
+                "curve": self.delta_psi.curve.name,
+                "epoch": state["bob_epoch"],
+                "version": state["bob_version"],
+                "points": self.delta_cache.lookup(need)
+            }, metrics=self.metrics)
+            msg = self._recv_reply()
+            if msg is None:
+                return None
+            if not msg.get("stale"):
+                break
+            # Bob's key changed: every cached A^ab and B^ba is void
+            self.log("Bob rotated his key, refreshing the full set...")
+            state = self.delta_state = self._empty_delta_state()
+        else:
+            self.log("Delta PSI: Bob kept reporting a stale epoch.", level=WARNING)
+            return None
+
+        state["ab"].update(zip(need, msg["points"]))
+        if "full" in msg:
+            state["bob_ba"] = self.delta_psi.reblind_many(msg["full"])
+            self.log(f"Received Bob's full set ({len(msg['full'])} items).")
+        else:
+            bob_ba = state["bob_ba"]
+            if len(msg["removed"]):
+                bob_ba = bob_ba[~bob_ba.isin(self.delta_psi.reblind_many(msg["removed"]))]
+            state["bob_ba"] = PointArray.concatenate([bob_ba, self.delta_psi.reblind_many(msg["added"])])
+            self.log(f"Bob's set changed by +{len(msg['added'])} / -{len(msg['removed'])} "
+                     f"since version {state['bob_version']}.")
+        state["bob_epoch"], state["bob_version"] = msg["epoch"], msg["version"]
+        self._save_delta_state()
+
+        self._intersect(alice_ids, PointArray.from_list([state["ab"][uid] for uid in alice_ids]), state["bob_ba"])
+        self.log(f"Intersection found: {len(self.intersection_ids)} items ({len(need)} IDs sent to Bob).")
+        return self.intersection_ids
+
+    @timed_phase("psi_cardinality")
+    def run_psi_cardinality(self, max_sample=DEFAULT_CARDINALITY_SAMPLE, sample_rate=None,
+                            confidence=DEFAULT_CONFIDENCE, max_fp=DEFAULT_MAX_FP, progress_callback=None):
+        """
+        Estimates the size of the intersection without running the full PSI,
+        e.g. to size a later run_psi / run_secure_aggregation job.
+
+        Both parties keep only the IDs whose seeded hash falls in the same
+        sample (rate sample_rate, by default about max_sample of Alice's
+        IDs), and run a compact PSI on those: Bob shuffles A^ab, so only the
+        number of matches comes back. Bob lowers the rate for his side if his
+        sample would exceed max_sample; samples are nested, so the matches
+        then follow his (smaller) rate. Blinding, transfer and Bob's work all
+        scale with the sample instead of the sets. Works for in-memory and
+        file-backed data on both sides.
+        Returns a CardinalityEstimate (estimate, low, high, ...), also kept in
+        self.cardinality, or None on failure.
+        """
+        if not self.socket or (self.df_alice is None and not self.data_file):
+            self.log("Cannot estimate cardinality: No connection or no data.", level=WARNING)
+            return None
+
+        # Fresh seed per request, so repeated estimates are independent
+        seed = int.from_bytes(os.urandom(8), 'big') >> 1
+        if self.df_alice is not None:
+            chunks = [self.df_alice["ID"].to_numpy(dtype=object)]
+        else:
+            chunks = iter_id_chunks(self.data_file)
+        if sample_rate is None:
+            if self.df_alice is None:
+                # File-backed: one pass to count the IDs, one to sample them
+                alice_size = sum(len(ids) for ids in iter_id_chunks(self.data_file))
+            else:
+                alice_size = len(self.df_alice)
+            sample_rate = sample_rate_for(alice_size, max_sample)
+        alice_size = 0
+        sampled = []
+        for ids in chunks:
+            ids = np.asarray(ids, dtype=object)
+            alice_size += len(ids)
+            sampled.extend(ids[sample_mask(hash_ids(ids), sample_rate, seed)].tolist())
+
+        self.log(f"Estimating intersection size from a {sample_rate:.3g} sample ({len(sampled)} of {alice_size} IDs)...")
+        network_utils.send_msg(self.socket, {
+            "command": "PSI_CARDINALITY",
+            "points": self.psi.blind_many(sampled, progress_callback=progress_callback),
+            "curve": self.psi.curve.name,
+            "sample_rate": sample_rate,
+            "max_sample": max_sample,
+            "seed": seed,
+            "max_fp": max_fp
+        }, metrics=self.metrics)
+        msg = self._recv_reply()
+        if msg is None:
+            return None
+
+        # Only common IDs in both samples can match, i.e. those under the lower rate
+        sample_rate = min(sample_rate, msg.get("sample_rate", sample_rate))
+        # A^ab -> A^b, compared against the digests of Bob's sampled B^b
+        alice_blinded_by_b = truncate_points(self.psi.unblind_many(msg["points"]), msg["digest_bytes"])
+        matches = int(alice_blinded_by_b.isin(msg["digests"]).sum())
+        self.cardinality = estimate_cardinality(matches, sample_rate, alice_size, msg["bob_size"], confidence)
+        self.log(f"Estimated intersection: ~{self.cardinality.estimate:,.0f} items "
+                 f"({confidence:.0%} interval {self.cardinality.low:,.0f} - {self.cardinality.high:,.0f}, "
+                 f"{matches} matches in the sample).")
+        return self.cardinality
+
+    @timed_phase("psi_unbalanced")
+    def run_psi_unbalanced(self, progress_callback=None):
+        """
+        Online phase of unbalanced PSI: only Alice's blinded items travel and are
+        processed, so a query costs O(|Alice|) regardless of Bob's set size.
+        """
+        if not self.socket:
+            self.log("Not connected.", level=WARNING)
+            return None
+
+        alice_ids = self.df_alice["ID"].tolist()
+        if self._load_offline_set() is None or len(alice_ids) > self.offline_set["max_query_size"]:
+            if self.fetch_offline_set(max_query_size=max(len(alice_ids), DEFAULT_MAX_QUERY_SIZE)) is None:
+                return None
+
+        self.log("Starting Unbalanced PSI (online phase)...")
+        alice_blinded = self.psi.blind_many(alice_ids, progress_callback=progress_callback)
+        network_utils.send_msg(self.socket, {"command": "PSI", "points": alice_blinded, "unbalanced": True,
+                                              "curve": self.psi.curve.name}, metrics=self.metrics)
+
+        msg = self._recv_reply()
+        if msg is None:
+            return None
+        if (msg["epoch"], msg["version"]) != (self.offline_set["epoch"], self.offline_set["version"]):
+            # Bob rotated his key or changed his data since our offline copy
+            self.log("Offline set is stale, refreshing...")
+            if self.fetch_offline_set(max_query_size=self.offline_set["max_query_size"]) is None:
+                return None
+
+        # Unblind A^ab -> A^b and look it up in Bob's offline digests
+        num_bytes = self.offline_set["digest_bytes"]
+        alice_blinded_by_b = self.psi.unblind_many(msg["points"])
+        self._intersect(alice_ids, truncate_points(alice_blinded_by_b, num_bytes), self.offline_set["digests"])
+        self.log(f"Intersection found: {len(self.intersection_ids)} items.")
+        return self.intersection_ids
+
+    def _intersect(self, alice_ids, alice_values, bob_values):
+        """
+        Keeps the IDs whose (double-blinded or digested) value occurs in Bob's
+        values, using a vectorized sorted merge over the PointArrays.
+        """
+        indices = PointArray.from_list(alice_values).intersect_indices(PointArray.from_list(bob_values))
+        self.intersection_ids = [alice_ids[i] for i in indices]
+        self.intersection_rows = indices
+        self.intersection_path = None
+        return self.intersection_ids
+
+    def _start_sender(self, blinded_chunks, send_errors):
+        """
+        Sends each PointArray of blinded_chunks to Bob from a background
+        thread, then {"done": True}. The stream is always terminated: if
+        blinding or sending fails, the error goes into send_errors and the
+        last message carries it, so Bob closes the stream and our receive
+        loop ends. If even that cannot be sent, the socket is shut down so a
+        blocked receive returns.
+        """
+        def sender():
+            last = {"done": True}
+            try:
+                for blinded in blinded_chunks:
+                    network_utils.send_msg(self.socket, {"points": blinded}, metrics=self.metrics)
+            except Exception as e:
+                send_errors.append(e)
+                last["error"] = str(e)
+            finally:
+                try:
+                    network_utils.send_msg(self.socket, last, metrics=self.metrics)
+                except Exception as e:
+                    send_errors.append(e)
+                    try:
+                        self.socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        send_thread = threading.Thread(target=sender, daemon=True)
+        send_thread.start()
+        return send_thread
+
+    @staticmethod
+    def _send_error_note(send_errors) -> str:
+        return f" (sending failed: {send_errors[0]})" if send_errors else ""
+
+    @timed_phase("psi_stream")
+    def run_psi_stream(self, chunk_size=1024, progress_callback=None):
+        """
+        Streaming PSI: blinded chunks are sent as soon as they are ready while
+        Bob re-blinds them and streams his own blinded set back in parallel,
+        so blinding, transfer and Bob's work overlap. Bob's chunks are
+        re-blinded on the worker pool while more arrive.
+        Memory is not bounded by chunk_size: A^ab and B^ba are kept for the
+        final intersection (32 bytes per item on each side, plus the IDs);
+        run_psi_file spills them to disk instead.
+        """
+        if not self.socket:
+            self.log("Not connected.", level=WARNING)
+            return None
+
+        self.log(f"Starting Streaming PSI (chunk size {chunk_size})...")
+        alice_ids = self.df_alice["ID"].tolist()
+        total = len(alice_ids)
+        network_utils.send_msg(self.socket, {"command": "PSI_STREAM", "chunk_size": chunk_size,
+                                              "curve": self.psi.curve.name}, metrics=self.metrics)
+
+        # Blind and send H(x)^a chunk by chunk from a background thread
+        send_errors = []
+        send_thread = self._start_sender(self.psi.blind_chunks(alice_ids, chunk_size), send_errors)
+
+        # Receive A^ab and B^b chunks as they arrive
+        alice_chunks = []
+        bob_chunks = []
+        received = 0
+        done = set()
+        while len(done) < 2:
+            msg = network_utils.recv_msg(self.socket, metrics=self.metrics)
+            if msg is None:
+                send_thread.join()
+                self.log(f"Connection closed during streaming PSI{self._send_error_note(send_errors)}.", level=WARNING)
+                return None
+            if "error" in msg:
+                self.log(f"Bob returned an error: {msg['error']}", level=WARNING)
+                send_thread.join()
+                return None
+            stream = msg["stream"]
+            if msg.get("done"):
+                done.add(stream)
+            elif stream == "alice":
+                alice_chunks.append(msg["points"])
+                received += len(msg["points"])
+                if progress_callback and total:
+                    progress_callback(received / total)
+            else:
+                # B^ba = (H(y)^b)^a, collected once the stream is done
+                bob_chunks.append(self.psi.submit_reblind(msg["points"]))
+
+        send_thread.join()
+        if send_errors:
+            self.log(f"Streaming PSI failed: {send_errors[0]}", level=ERROR)
+            return None
+        if progress_callback: progress_callback(1.0)
+
+        bob_chunks = [future.result() for future in bob_chunks]
+        self._intersect(alice_ids, PointArray.concatenate(alice_chunks), PointArray.concatenate(bob_chunks))
+        self.log(f"Intersection found: {len(self.intersection_ids)} items.")
+        return self.intersection_ids
+
+    @timed_phase("psi_file")
+    def run_psi_file(self, work_dir=None, chunk_size=1 << 16, memory_bytes=DEFAULT_MEMORY_BYTES):
+        """
+        Out-of-core streaming PSI over the file given to load_file: IDs are read
+        and blinded chunk by chunk, A^ab and B^ba are spilled to memory-mapped
+        files and intersected with an external sort-merge in memory_bytes.
+        The result is written to <work_dir>/intersection.npy as Alice's
+        ascending row numbers (intersection_path); intersection_ids stays
+        empty and the later phases read the rows lazily (iter_intersection).
+        Returns the number of matches.
+        """
+        if not self.socket or not self.data_file:
+            self.log("Cannot run file PSI: No connection or no data file.", level=WARNING)
+            return None
+
+        work_dir = work_dir or self.cache_dir or tempfile.mkdtemp(prefix="alice_psi_")
+        os.makedirs(work_dir, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix="spill_", dir=work_dir)
+        alice_spill = SpillFile(os.path.join(spill_dir, "alice_ab.bin"))
+        bob_spill = SpillFile(os.path.join(spill_dir, "bob_ba.bin"))
+        self.log(f"Starting out-of-core PSI on {self.data_file} (chunk size {chunk_size})...")
+        network_utils.send_msg(self.socket, {"command": "PSI_STREAM", "chunk_size": chunk_size,
+                                              "curve": self.psi.curve.name}, metrics=self.metrics)
+
+        send_errors = []
+        send_thread = self._start_sender(
+            (self.psi.blind_many(ids) for ids in iter_id_chunks(self.data_file, chunk_size=chunk_size)), send_errors)
+        # B^ba chunks being re-blinded on the pool; at most `window` are held before spilling
+        window = 2 * self.psi.workers
+        pending = deque()
+        try:
+            # Chunks of the "alice" stream come back in order, so row i of the spill is row i of the file
+            done = set()
+            while len(done) < 2:
+                msg = network_utils.recv_msg(self.socket, metrics=self.metrics)
+                if msg is None:
+                    send_thread.join()
+                    self.log(f"Connection closed during out-of-core PSI{self._send_error_note(send_errors)}.",
+                             level=WARNING)
+                    return None
+                if "error" in msg:
+                    self.log(f"Bob returned an error: {msg['error']}", level=WARNING)
+                    send_thread.join()
+                    return None
+                stream = msg["stream"]
+                if msg.get("done"):
+                    done.add(stream)
+                elif stream == "alice":
+                    alice_spill.append(msg["points"])
+                else:
+                    pending.append(self.psi.submit_reblind(msg["points"]))
+                    while pending and (len(pending) >= window or pending[0].done()):
+                        bob_spill.append(pending.popleft().result())
+            while pending:
+                bob_spill.append(pending.popleft().result())
+
+            send_thread.join()
+            if send_errors:
+                self.log(f"Out-of-core PSI failed: {send_errors[0]}", level=ERROR)
+                return None
+
+            self.log(f"Intersecting {alice_spill.count} x {bob_spill.count} blinded values out of core...")
+            path = os.path.join(work_dir, "intersection.npy")
+            count = intersect_files(alice_spill.points(), bob_spill.points(), path, spill_dir, memory_bytes)
+        finally:
+            alice_spill.close()
+            bob_spill.close()
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+        self.intersection_ids = []
+        self.intersection_rows = None
+        self.intersection_path = path
+        self.joined_data = None
+        self.log(f"Intersection found: {count} items (row numbers in {path}).")
+        return count
+
+    def iter_intersection(self, columns=None, chunk_size=DEFAULT_READ_ROWS):
+        """
+        Alice's rows in the intersection as DataFrames, read lazily from the
+        data file after run_psi_file (a single chunk otherwise).
+        """
+        if self.intersection_path:
+            yield from iter_rows(self.data_file, load_indices(self.intersection_path), columns,
+                                 chunk_size, dtype={"ID": str})
+        elif self.intersection_ids:
+            rows = self.df_alice.iloc[self.intersection_rows]
+            yield rows if columns is None else rows[columns]
+
+    def iter_join(self, chunk_size=DEFAULT_READ_ROWS):
+        """
+        Joins the intersection with Bob's data one chunk (and one JOIN
+        request) at a time, yielding the joined DataFrames.
+        """
+        for rows in self.iter_intersection(chunk_size=chunk_size):
+            network_utils.send_msg(self.socket, {"command": "JOIN", "ids": rows["ID"].tolist()}, metrics=self.metrics)
+            msg = self._recv_reply()
+            if msg is None:
+                raise ConnectionError("JOIN failed")
+            yield self._merge_by_position(rows, msg["positions"], msg["columns"])
+
+    @timed_phase("join")
     def run_join(self):
-        if not self.socket or not self.intersection_ids:
-            self.log("Cannot join: No connection or no intersection.")
+        if not self.socket or not (self.intersection_ids or self.intersection_path):
+            self.log("Cannot join: No connection or no intersection.", level=WARNING)
             return None
 
+        if self.intersection_path:
+            # File-backed: join chunk by chunk (run_aggregation can also stream without this)
+            self.log("Requesting data for intersection chunk by chunk...")
+            try:
+                chunks = list(self.iter_join())
+            except ConnectionError:
+                return None
+            self.joined_data = pd.concat(chunks, ignore_index=True) if chunks else None
+            self.log(f"Joined {0 if self.joined_data is None else len(self.joined_data)} records.")
+            return self.joined_data
+
         self.log("Requesting data for intersection...")
-        network_utils.send_msg(self.socket, {"command": "JOIN", "ids": self.intersection_ids})
+        network_utils.send_msg(self.socket, {"command": "JOIN", "ids": self.intersection_ids}, metrics=self.metrics)
         
-        msg = network_utils.recv_msg(self.socket)
-        bob_data = msg["data"]
-        self.log(f"Received {len(bob_data)} records from Bob.")
-        
-        df_bob_data = pd.DataFrame(bob_data)
-        if not df_bob_data.empty:
-            self.joined_data = pd.merge(self.df_alice, df_bob_data, on="ID")
-        else:
-             self.joined_data = self.df_alice[self.df_alice["ID"].isin(self.intersection_ids)]
-             
+        msg = self._recv_reply()
+        if msg is None:
+            return None
+        self.log(f"Received {len(msg['positions'])} records from Bob.")
+        rows = self.df_alice.iloc[self.intersection_rows]
+        self.joined_data = self._merge_by_position(rows, msg["positions"], msg["columns"])
         return self.joined_data
 
+    @staticmethod
+    def _merge_by_position(rows, positions, columns):
+        """
+        Bob answers JOIN with the positions of the requested IDs he has and his
+        columns for them in that order, so they line up with our rows without a merge.
+        """
+        matched = rows.iloc[positions].reset_index(drop=True)
+        return pd.concat([matched, columns.reset_index(drop=True)], axis=1)
+
+    @timed_phase("aggregation")
     def run_aggregation(self):
+        if self.joined_data is None and self.intersection_path and self.socket:
+            # Stream the file-backed intersection through JOIN and combine partial sums
+            self.log("Aggregating data chunk by chunk...")
+            totals = None
+            try:
+                for joined in self.iter_join():
+                    joined["TotalComp"] = joined["Salary"] + joined["Bonus"]
+                    partial = joined.groupby("Department", observed=True)["TotalComp"].sum()
+                    totals = partial if totals is None else totals.add(partial, fill_value=0)
+            except ConnectionError:
+                return None
+            if totals is None:
+                totals = pd.Series(dtype="int64", name="TotalComp", index=pd.Index([], name="Department"))
+            self.aggregated_data = totals.reset_index()
+            return self.aggregated_data
+
         if self.joined_data is None:
-            self.log("Cannot aggregate: No joined data.")
+            self.log("Cannot aggregate: No joined data.", level=WARNING)
             return None
 
         self.log("Aggregating data...")
         self.joined_data["TotalComp"] = self.joined_data["Salary"] + self.joined_data["Bonus"]
-        self.aggregated_data = self.joined_data.groupby("Department")["TotalComp"].sum().reset_index()
+        self.aggregated_data = self.joined_data.groupby("Department", observed=True)["TotalComp"].sum().reset_index()
         return self.aggregated_data
 
-    def run_secure_aggregation(self, progress_callback=None):
-        if not self.socket or not self.intersection_ids:
-            self.log("Cannot run secure aggregation: No connection or no intersection.")
+    def _ensure_he_context(self, layout, precision, scheme):
+        """
+        Makes sure the session has an HE context sized to this job and that Bob
+        has it cached (HE_CONTEXT command), uploading the public context only if
+        he doesn't. Bob's reply to the query also carries his group stride
+        and the public bound on his values, which feed the layout and the
+        parameter planner; a new context is only generated when the planned
+        parameters change.
+        """
+        network_utils.send_msg(self.socket, {"command": "HE_CONTEXT", "context_id": self.he_context_id}, metrics=self.metrics)
+        msg = self._recv_reply()
+        if msg is None:
             return None
+        known = msg["known"]
 
-        self.log("Starting Secure Aggregation (TenSEAL CKKS)...")
-        
-        # 1. Generate Context
-        context = SecureAggregator.create_context()
+        # Every row takes one slot per segment; each segment gets `stride` result slots
+        stride = msg["group_stride"] if layout.by_bob else group_stride(1)
+        num_segments, num_slots, max_value = layout.plan(msg["value_bound"], scheme, stride)
+        num_values = len(layout.salaries) * num_segments
+        params = plan_he_params(num_values, num_slots, max_value, precision=precision, scheme=scheme)
+        if params != self.he_params:
+            self.log(f"Generating HE context: {params}, "
+                     f"~{params.ciphertext_bytes / 1024:.0f} KB x {params.num_ciphertexts(num_values)} ciphertext(s)")
+            self.he_params = params
+            with self.metrics.timer("he_op_seconds", op="keygen"):
+                self.he_context = SecureAggregator.create_context(params)
+            self._public_context = self.he_context.serialize(save_secret_key=False)
+            self.he_context_id = SecureAggregator.context_id(self._public_context)
+            known = False
+
+        if not known:
+            self.log(f"Uploading HE context ({len(self._public_context) / 1e6:.1f} MB)...")
+            network_utils.send_msg(self.socket, {
+                "command": "HE_CONTEXT",
+                "context_id": self.he_context_id,
+                "context": self._public_context
+            }, metrics=self.metrics)
+            if self._recv_reply() is None:
+                return None
+        else:
+            self.log("Bob already has this session's HE context.")
+        return self.he_context
+
+    @timed_phase("secure_aggregation")
+    def run_secure_aggregation(self, progress_callback=None, precision=DEFAULT_HE_PRECISION, scheme=SCHEME_CKKS,
+                               stats=None, group_by=None, bins=None):
+        """
+        scheme: "ckks" (approximate) or "bfv" (exact integer sums; salaries and
+        bonuses are integers). Bob follows whichever context he is given.
+        precision: absolute error tolerated on each decrypted department total
+        with CKKS; the parameters are planned from it and the size of the job.
+        stats: (value, aggregate) pairs computed in the same pass, e.g.
+        [("TotalComp", "mean"), ("Salary", "var"), "count"] (see aggregation.py).
+        By default only SUM(TotalComp), returned as column "TotalComp".
+        group_by: "Department" (Bob's) and/or columns of Alice's data, e.g.
+        ["Department", "Age"] with bins={"Age": [20, 30, 40, 50, 61]}.
+        Alice's columns stay on her side.
+        """
+        if not self.socket or not (self.intersection_ids or self.intersection_path):
+            self.log("Cannot run secure aggregation: No connection or no intersection.", level=WARNING)
+            return None
+
+        self.log(f"Starting Secure Aggregation (TenSEAL {scheme.upper()})...")
+        try:
+            layout = AggregationLayout(stats or DEFAULT_STATS, DEFAULT_GROUP_BY if group_by is None else group_by, bins)
+        except ValueError as e:
+            self.log(f"Cannot run secure aggregation: {e}", level=WARNING)
+            return None
         
-        # 2. Prepare Data
+        # 1. Prepare Data
         # Sort IDs to ensure alignment
-        sorted_ids = sorted(self.intersection_ids)
-        alice_subset = self.df_alice[self.df_alice["ID"].isin(sorted_ids)].set_index("ID")
-        alice_subset = alice_subset.reindex(sorted_ids)
-        salaries = alice_subset["Salary"].tolist()
+        columns = layout.alice_columns_needed()
+        if self.intersection_path:
+            # Only the intersecting IDs and the needed columns are read from the data file
+            alice_subset = pd.concat(list(self.iter_intersection(["ID"] + columns))).set_index("ID").sort_index()
+            sorted_ids = alice_subset.index.tolist()
+        else:
+            sorted_ids = sorted(self.intersection_ids)
+            alice_subset = self.df_alice[self.df_alice["ID"].isin(sorted_ids)].set_index("ID")
+            alice_subset = alice_subset.reindex(sorted_ids)
+        layout.set_rows(alice_subset[columns])
+        num_rows = len(sorted_ids)
+
+        # 2. Reuse the session's context if it fits the job; Bob only needs it uploaded once
+        context = self._ensure_he_context(layout, precision, scheme)
+        if context is None:
+            return None
         
-        # 3. Encrypt Vector
-        self.log(f"Encrypting {len(salaries)} salaries...")
-        enc_salaries = SecureAggregator.encrypt_vector(context, salaries)
-        
-        # 4. Send to Bob
-        self.log("Sending Encrypted Vectors to Bob...")
-        payload = {
-            "command": "SECURE_AGGREGATION",
-            "context": context.serialize(save_secret_key=False),
-            "enc_salaries": enc_salaries.serialize(),
-            "ids": sorted_ids # Necessary for alignment
-        }
-        network_utils.send_msg(self.socket, payload)
+        # 3./4. Encrypt and stream one ciphertext per chunk of rows (one segment
+        # of slots per row and quantity). The first message carries the context
+        # and the layout; "more" tells Bob whether chunks follow.
+        integer = scheme == SCHEME_BFV
+        chunk_size = layout.pack(self.he_params.slot_count, bfv=integer)
+        num_chunks = max(1, -(-num_rows // chunk_size))
+        self.log(f"Encrypting {num_rows} rows x {len(layout.segments)} segment(s) in {num_chunks} chunk(s)...")
+        for i in range(num_chunks):
+            start = i * chunk_size
+            t0 = time.perf_counter()
+            with self.metrics.timer("he_op_seconds", op="encrypt"):
+                enc_salaries = SecureAggregator.encrypt_vector(context, layout.encode(start, start + chunk_size, integer))
+            payload = {
+                "enc_salaries": enc_salaries.serialize(),
+                "ids": sorted_ids[start:start + chunk_size], # Necessary for alignment
+                "more": i + 1 < num_chunks
+            }
+            if i == 0:
+                payload.update({
+                    "command": "SECURE_AGGREGATION",
+                    "context_id": self.he_context_id,
+                    "layout": layout.wire()
+                })
+            network_utils.send_msg(self.socket, payload, metrics=self.metrics)
+            self.log(f"Chunk {i + 1}/{num_chunks}: encrypted and sent in {time.perf_counter() - t0:.2f}s", level=DEBUG)
+            if progress_callback:
+                progress_callback((i + 1) / num_chunks)
         
         # 5. Receive Results
         self.log("Waiting for Bob's Aggregation...")
-        msg = network_utils.recv_msg(self.socket)
-        serialized_results = msg["results"]
+        msg = self._recv_reply()
+        if msg is None:
+            return None
         
-        # 6. Decrypt
+        # 6. Decrypt once: slot j * stride + g of the packed result is segment j's total for group g
         self.log("Decrypting Results...")
-        decrypted_results = []
-        
-        for dept, enc_sum_bytes in serialized_results.items():
-            enc_sum = ts.ckks_vector_from(context, enc_sum_bytes)
-            # Decrypt returns a list (vector). Since we summed to a single value (conceptually)
-            # Or if Bob summed by mask, the result likely has the sum in the first slot or as a single element vector?
-            # If Bob did 'sum()', it returns a CKKSVector with 1 element.
-            val = enc_sum.decrypt()[0]
-            decrypted_results.append({"Department": dept, "TotalComp": val})
+        with self.metrics.timer("he_op_seconds", op="decrypt"):
+            slots = SecureAggregator.decrypt_packed(context, msg["packed_result"])
+        result = layout.decode(slots, msg["groups"], msg.get("group_stride", 1))
+        if stats is None:
+            result = result.rename(columns={stat_column(*DEFAULT_STATS[0]): "TotalComp"})
             
-        self.aggregated_data = pd.DataFrame(decrypted_results)
+        self.aggregated_data = result
         self.log("Secure Aggregation Complete.")
         return self.aggregated_data
 
     def close(self):
         if self.socket:
-            network_utils.send_msg(self.socket, {"command": "EXIT"})
+            network_utils.send_msg(self.socket, {"command": "EXIT"}, metrics=self.metrics)
             self.socket.close()
             self.socket = None
             self.log("Disconnected.")
+        self.psi.close()
+        if self.delta_psi is not None:
+            self.delta_psi.close()
 
 # For backward compatibility
 if __name__ == "__main__":
@@ -2,6 +2,11 @@ import streamlit as st
 from alice import AliceClient
 import pandas as pd
 import time
+from collections import deque
+from event_log import format_event
+
+# Log lines shown in the UI
+LOG_VIEW_LINES = 500
 
 st.set_page_config(page_title="Alice (Client)", layout="wide")
 
@@ -14,11 +19,15 @@ if 'connected' not in st.session_state:
     st.session_state.connected = False
 if 'data_generated' not in st.session_state:
     st.session_state.data_generated = False
+if 'log_cursor' not in st.session_state:
+    st.session_state.log_cursor = 0
+    st.session_state.log_lines = deque(maxlen=LOG_VIEW_LINES)
 
 # Sidebar
 st.sidebar.header("Connection")
 host = st.sidebar.text_input("Bob's Host", "127.0.0.1")
 port = st.sidebar.number_input("Bob's Port", value=5000)
+curve = st.sidebar.selectbox("Preferred Curve", ["x25519", "p256"])
 
 # 1. Generate Data
 st.header("1. Data Generation")
@@ -36,6 +45,7 @@ st.header("2. Connection")
 if st.button("Connect to Bob"):
     st.session_state.client.host = host
     st.session_state.client.port = port
+    st.session_state.client.curves = [curve] + [c for c in ["x25519", "p256"] if c != curve]
     if st.session_state.client.connect():
         st.session_state.connected = True
         st.success("Connected!")
@@ -48,6 +58,16 @@ if st.session_state.connected:
     
     # Scenario 1
     st.subheader("Scenario 1: Basic Intersection")
+    if st.button("Estimate Overlap (sampled)"):
+        with st.spinner("Estimating..."):
+            estimate = st.session_state.client.run_psi_cardinality()
+        if estimate:
+            st.info(f"Estimated intersection: ~{estimate.estimate:,.0f} items "
+                    f"({estimate.confidence:.0%} interval {estimate.low:,.0f} - {estimate.high:,.0f}, "
+                    f"sample rate {estimate.sample_rate:.3g}).")
+        else:
+            st.error("Estimate Failed.")
+    compact = st.checkbox("Compact transfer (truncated digests of Bob's set)")
     if st.button("Run PSI Protocol"):
         progress_bar = st.progress(0)
         status_text = st.empty()
@@ -56,7 +76,7 @@ if st.session_state.connected:
             progress_bar.progress(p)
             status_text.text(f"Progress: {int(p*100)}%")
             
-        intersection = st.session_state.client.run_psi(progress_callback=update_progress)
+        intersection = st.session_state.client.run_psi(progress_callback=update_progress, compact=compact)
         if intersection:
             st.success(f"Intersection found: {len(intersection)} items.")
             st.write("Sample Intersection IDs:", intersection[:10])
@@ -88,6 +108,8 @@ if st.session_state.connected:
                 st.error("Aggregation Failed. Run Join first.")
 
     with col2:
+        he_scheme = st.radio("HE Scheme", ["ckks", "bfv"], horizontal=True,
+                             help="CKKS gives approximate sums; BFV gives exact integer sums.")
         if st.button("Run Secure Aggregation (HE)"):
             progress_bar = st.progress(0)
             status_text = st.empty()
@@ -97,15 +119,27 @@ if st.session_state.connected:
                 status_text.text(f"Progress: {int(p*100)}%")
                 
             with st.spinner("Running Secure Aggregation..."):
-                agg = st.session_state.client.run_secure_aggregation(progress_callback=update_progress)
+                agg = st.session_state.client.run_secure_aggregation(progress_callback=update_progress, scheme=he_scheme)
             
             if agg is not None:
                 st.success("Secure Aggregation Complete!")
+                params = st.session_state.client.he_params
+                st.caption(f"{params.scheme.upper()} parameters: {params}")
                 st.dataframe(agg)
             else:
                 st.error("Secure Aggregation Failed. Run PSI first.")
 
+# Metrics
+st.header("Metrics")
+metrics = st.session_state.client.metrics.rows()
+if metrics:
+    st.dataframe(pd.DataFrame(metrics), use_container_width=True)
+else:
+    st.info("No metrics recorded yet.")
+
 # Logs
 st.header("Logs")
-logs = st.session_state.client.logs
-st.text_area("Client Logs", value="\n".join(logs[::-1]), height=200)
+# Only events past the cursor are fetched; the view keeps the newest LOG_VIEW_LINES
+events, st.session_state.log_cursor = st.session_state.client.events.since(st.session_state.log_cursor, LOG_VIEW_LINES)
+st.session_state.log_lines.extend(format_event(event) for event in events)
+st.text_area("Client Logs", value="\n".join(reversed(st.session_state.log_lines)), height=200)
@@ -0,0 +1,128 @@
+"""
+Benchmark for secure aggregation: CKKS (approximate) vs BFV (exact).
+
+For each size, random integer salaries and bonuses are summed per department
+the way Alice and Bob do it (encrypt in slot-sized chunks, add plaintext
+bonuses, packed group_sum, add the packed chunks, decrypt once), with
+parameters from plan_he_params. Reports ciphertext bytes, encrypt /
+evaluate / decrypt times and the largest error against the plaintext sums.
+
+With --stats, it also runs the multi-statistic layout from aggregation.py
+(count, mean, variance and std of TotalComp, variance of Salary) in one
+pass and shows what the extra statistics cost over the plain sum.
+
+Usage:
+    python bench_aggregation.py                        # 1k, 100k and 1M rows
+    python bench_aggregation.py --sizes 1000 --groups 5
+    python bench_aggregation.py --sizes 100000 --stats
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from psi_protocol import SecureAggregator, plan_he_params, SCHEME_CKKS, SCHEME_BFV
+from aggregation import AggregationLayout, segment_vectors, group_stride
+
+# The statistics of the --stats run
+MULTI_STATS = [("TotalComp", "sum"), ("TotalComp", "mean"), ("TotalComp", "var"), ("TotalComp", "std"),
+               ("Salary", "var"), "count"]
+
+def run(scheme, salaries, bonuses, groups, num_groups):
+    n = len(salaries)
+    params = plan_he_params(n, num_groups, max_value=int(salaries.max()) + int(bonuses.max()), scheme=scheme)
+    start = time.perf_counter()
+    context = SecureAggregator.create_context(params)
+    keygen = time.perf_counter() - start
+    chunk = params.slot_count
+
+    start = time.perf_counter()
+    chunks = [SecureAggregator.encrypt_vector(context, salaries[i:i + chunk].tolist()).serialize()
+              for i in range(0, n, chunk)]
+    encrypt = time.perf_counter() - start
+
+    start = time.perf_counter()
+    packed_sum = None
+    for i, data in zip(range(0, n, chunk), chunks):
+        enc_total = SecureAggregator.deserialize_vector(context, data) + bonuses[i:i + chunk].tolist()
+        packed = SecureAggregator.group_sum(context, enc_total, groups[i:i + chunk], num_groups)
+        packed_sum = packed if packed_sum is None else SecureAggregator.add_packed(context, packed_sum, packed)
+    result = SecureAggregator.serialize_ciphertext(packed_sum)
+    evaluate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slots = SecureAggregator.decrypt_packed(context, result)
+    decrypt = time.perf_counter() - start
+
+    expected = np.bincount(groups, weights=salaries + bonuses, minlength=num_groups)
+    error = float(np.max(np.abs(np.array(slots[:num_groups], dtype=float) - expected)))
+    return params, sum(len(c) for c in chunks), keygen, encrypt, evaluate, decrypt, error
+
+def run_stats(scheme, salaries, bonuses, groups, num_groups):
+    """
+    Same pipeline with MULTI_STATS laid out as segments of the same ciphertexts.
+    Returns (segments, total bytes, encrypt s, evaluate s, decrypt s).
+    """
+    n = len(salaries)
+    layout = AggregationLayout(MULTI_STATS)
+    layout.set_rows(pd.DataFrame({"Salary": salaries}))
+    stride = group_stride(num_groups)
+    num_segments, num_slots, max_value = layout.plan(1 << int(bonuses.max()).bit_length(), scheme, stride)
+    params = plan_he_params(n * num_segments, num_slots, max_value, scheme=scheme)
+    context = SecureAggregator.create_context(params)
+    integer = scheme == SCHEME_BFV
+    chunk = layout.pack(params.slot_count, bfv=integer)
+
+    start = time.perf_counter()
+    chunks = [SecureAggregator.encrypt_vector(context, layout.encode(i, i + chunk, integer)).serialize()
+              for i in range(0, n, chunk)]
+    encrypt = time.perf_counter() - start
+
+    start = time.perf_counter()
+    wire = layout.wire()
+    packed_sum = None
+    for i, data in zip(range(0, n, chunk), chunks):
+        enc = SecureAggregator.deserialize_vector(context, data)
+        index, slots, span, weights, addends = segment_vectors(wire, bonuses[i:i + chunk], groups[i:i + chunk], stride, integer)
+        if addends is not None:
+            enc = enc + addends.tolist()
+        packed = SecureAggregator.group_sum(context, enc, index, slots, weights, span)
+        packed_sum = packed if packed_sum is None else SecureAggregator.add_packed(context, packed_sum, packed)
+    result = SecureAggregator.serialize_ciphertext(packed_sum)
+    evaluate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    layout.decode(SecureAggregator.decrypt_packed(context, result), {g: g for g in range(num_groups)}, stride)
+    decrypt = time.perf_counter() - start
+    return num_segments, sum(len(c) for c in chunks), encrypt, evaluate, decrypt
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--stats", action="store_true", help="also run the multi-statistic layout")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>9} {'scheme':>6} {'N':>6} {'cts':>5} {'ct MB':>8} {'keygen s':>9} "
+          f"{'encrypt s':>10} {'evaluate s':>11} {'decrypt s':>10} {'max error':>10}")
+    for n in args.sizes:
+        # Same ranges as data_generator: salaries 30k-150k, bonuses 1k-20k
+        salaries = rng.integers(30000, 150001, n)
+        bonuses = rng.integers(1000, 20001, n)
+        groups = rng.integers(0, args.groups, n)
+        for scheme in (SCHEME_CKKS, SCHEME_BFV):
+            params, size, keygen, encrypt, evaluate, decrypt, error = run(scheme, salaries, bonuses, groups, args.groups)
+            print(f"{n:>9} {scheme:>6} {params.poly_modulus_degree:>6} {params.num_ciphertexts(n):>5} "
+                  f"{size / 1e6:>8.1f} {keygen:>9.2f} {encrypt:>10.2f} {evaluate:>11.2f} {decrypt:>10.3f} {error:>10.2g}")
+            if args.stats:
+                segments, multi_size, multi_encrypt, multi_evaluate, multi_decrypt = run_stats(
+                    scheme, salaries, bonuses, groups, args.groups)
+                # A separate run per statistic would also pay for keygen (and the context upload)
+                total, multi_total = encrypt + evaluate + decrypt, multi_encrypt + multi_evaluate + multi_decrypt
+                print(f"{'':>9} {'':>6} {len(MULTI_STATS)} statistics ({segments} segments): "
+                      f"{multi_size / 1e6:.1f} MB, {multi_encrypt:.2f} + {multi_evaluate:.2f} + {multi_decrypt:.3f} s, "
+                      f"{(multi_total - total) / (len(MULTI_STATS) - 1):.2f} s per extra statistic "
+                      f"(vs {keygen + total:.2f} s for a full run)")
+
+if __name__ == "__main__":
+    main()
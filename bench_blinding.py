@@ -0,0 +1,55 @@
+"""
+Micro-benchmark for the hash-to-curve + blinding step (H(x)^a), per curve backend.
+
+For every backend in curves.py it compares the original two-step path
+(hash_to_curve_public_key followed by a key exchange) against the fixed-base
+fast path PSIProtocol.blind(), and measures re-blinding of received points
+(reblind_many), which is what Bob does for every item Alice sends.
+On P-256 each received x-coordinate is decompressed first; X25519 uses it as is.
+
+Usage:
+    python bench_blinding.py                          # 10k and 1M IDs, all curves
+    python bench_blinding.py --sizes 10000            # custom sizes
+    python bench_blinding.py --curves x25519          # one backend
+"""
+import argparse
+import time
+from psi_protocol import PSIProtocol
+from curves import CURVES
+
+def legacy_blind(psi, items):
+    return [psi.apply_private_key(psi.hash_to_curve_public_key(x)) for x in items]
+
+def fast_blind(psi, items):
+    return [psi.blind(x) for x in items]
+
+def reblind(psi, points):
+    return [psi.apply_private_key(p) for p in points]
+
+def bench(fn, psi, items):
+    start = time.perf_counter()
+    out = fn(psi, items)
+    elapsed = time.perf_counter() - start
+    return out, len(items) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000])
+    parser.add_argument("--curves", nargs="+", default=list(CURVES), choices=list(CURVES))
+    args = parser.parse_args()
+
+    print(f"{'curve':>7} {'IDs':>10} {'legacy (items/s)':>17} {'blind (items/s)':>16} {'speedup':>8} {'reblind (items/s)':>18}")
+    for curve in args.curves:
+        psi = PSIProtocol(workers=1, curve=curve)
+        other = PSIProtocol(workers=1, curve=curve)
+        for n in args.sizes:
+            items = [f"{i:010d}@example.com" for i in range(n)]
+            before, before_rate = bench(legacy_blind, psi, items)
+            after, after_rate = bench(fast_blind, psi, items)
+            assert before == after, "fast path disagrees with legacy path"
+            _, reblind_rate = bench(reblind, other, after)
+            print(f"{curve:>7} {n:>10} {before_rate:>17,.0f} {after_rate:>16,.0f} "
+                  f"{after_rate / before_rate:>7.2f}x {reblind_rate:>18,.0f}")
+
+if __name__ == "__main__":
+    main()
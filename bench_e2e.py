@@ -0,0 +1,285 @@
+"""
+End-to-end benchmark: Alice against a localhost BobServer running in its own
+process, for every protocol phase (PSI, JOIN, insecure aggregation, CKKS and
+BFV secure aggregation) across data sizes and overlap ratios.
+
+Per phase it records wall time, CPU time of Alice and of Bob (including
+their worker processes), bytes Alice sent and received, and peak RSS of both
+sides. Results are written as JSON; with --baseline they are compared against
+an earlier run and the script exits with status 1 if any metric regressed by
+more than --tolerance.
+
+Usage:
+    python bench_e2e.py --sizes 1000 10000 --output bench.json
+    python bench_e2e.py --sizes 1000 10000 --baseline bench.json   # regression check
+    python bench_e2e.py                                           # 1k .. 1M rows
+
+CPU and peak-RSS figures come from /proc and are only available on Linux;
+elsewhere they are recorded as null.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from alice import AliceClient
+from bob import BobServer
+from data_generator import generate_data
+from psi_protocol import SCHEME_BFV, SCHEME_CKKS
+
+PHASES = ["psi", "join", "aggregation", "secure_aggregation", "secure_aggregation_bfv"]
+# Metrics compared against the baseline, with the absolute change ignored as noise
+METRICS = {
+    "wall_s": 0.05,
+    "cpu_alice_s": 0.05,
+    "cpu_bob_s": 0.05,
+    "bytes_sent": 4096,
+    "bytes_recv": 4096,
+    "peak_rss_alice_mb": 8,
+    "peak_rss_bob_mb": 8,
+}
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+class CountingSocket:
+    """
+    Wraps Alice's socket and counts the bytes going through it.
+    """
+    def __init__(self, sock):
+        self._sock = sock
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+        self.bytes_sent += len(data) if not isinstance(data, memoryview) else data.nbytes
+
+    def recv_into(self, buffer, nbytes=0):
+        count = self._sock.recv_into(buffer, nbytes)
+        self.bytes_recv += count
+        return count
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+def _process_tree(pid):
+    """
+    pid and all of its descendants (e.g. PSIProtocol pool workers).
+    """
+    pids = [pid]
+    for p in pids:
+        try:
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    pids.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def _cpu_seconds(pid):
+    """
+    User + system CPU time of the process tree, or None without /proc.
+    """
+    total = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            if p == pid:
+                return None
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / CLK_TCK
+
+def _peak_rss_mb(pid):
+    """
+    Peak resident set size (VmHWM) of the process tree, or None without /proc.
+    """
+    total = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            if p == pid:
+                return None
+    return total / 1024
+
+def _reset_peak_rss(pid):
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    for p in _process_tree(pid):
+        try:
+            with open(f"/proc/{p}/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+def _serve_bob(df_bob, port, mode, ready, stop):
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = BobServer(host="127.0.0.1", port=port, mode=mode)
+        server.load_data(df_bob)
+        server.start()
+        ready.set()
+        stop.wait()
+        server.stop()
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_case(rows, overlap, mode, verbose=False):
+    """
+    Runs every phase once for one (rows, overlap) case; returns one record per phase.
+    """
+    df_alice, df_bob = generate_data(num_rows=rows, overlap_ratio=overlap)
+    ctx = multiprocessing.get_context("spawn")
+    ready, stop = ctx.Event(), ctx.Event()
+    port = _free_port()
+    bob = ctx.Process(target=_serve_bob, args=(df_bob, port, mode, ready, stop), daemon=True)
+    bob.start()
+    if not ready.wait(timeout=3600):
+        raise RuntimeError("Bob did not start")
+
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    records = []
+    with quiet:
+        alice = AliceClient(port=port)
+        alice.df_alice = df_alice
+        # Bob's listener comes up on its own thread shortly after start()
+        for _ in range(50):
+            if alice.connect():
+                break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError("Could not connect to Bob")
+        alice.socket = counter = CountingSocket(alice.socket)
+
+        steps = {
+            "psi": alice.run_psi,
+            "join": alice.run_join,
+            "aggregation": alice.run_aggregation,
+            "secure_aggregation": lambda: alice.run_secure_aggregation(scheme=SCHEME_CKKS),
+            "secure_aggregation_bfv": lambda: alice.run_secure_aggregation(scheme=SCHEME_BFV),
+        }
+        me = os.getpid()
+        for phase in PHASES:
+            _reset_peak_rss(me)
+            _reset_peak_rss(bob.pid)
+            sent, recv = counter.bytes_sent, counter.bytes_recv
+            cpu_alice, cpu_bob = _cpu_seconds(me), _cpu_seconds(bob.pid)
+            start = time.perf_counter()
+            result = steps[phase]()
+            wall = time.perf_counter() - start
+            end_alice, end_bob = _cpu_seconds(me), _cpu_seconds(bob.pid)
+            records.append({
+                "rows": rows,
+                "overlap": overlap,
+                "phase": phase,
+                "ok": result is not None,
+                "wall_s": round(wall, 4),
+                "cpu_alice_s": None if cpu_alice is None else round(end_alice - cpu_alice, 4),
+                "cpu_bob_s": None if cpu_bob is None else round(end_bob - cpu_bob, 4),
+                "bytes_sent": counter.bytes_sent - sent,
+                "bytes_recv": counter.bytes_recv - recv,
+                "peak_rss_alice_mb": _peak_rss_mb(me),
+                "peak_rss_bob_mb": _peak_rss_mb(bob.pid),
+            })
+        alice.close()
+
+    stop.set()
+    bob.join(timeout=30)
+    return records
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of human-readable regressions of results against baseline.
+    """
+    base = {(r["rows"], r["overlap"], r["phase"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results["results"]:
+        old = base.get((r["rows"], r["overlap"], r["phase"]))
+        if old is None:
+            continue
+        # A phase that now fails is a regression, however fast it failed
+        if old.get("ok", True) and not r.get("ok", True):
+            regressions.append(f"{r['phase']} @ {r['rows']} rows, overlap {r['overlap']}: failed (was ok)")
+            continue
+        for metric, noise in METRICS.items():
+            new_value, old_value = r.get(metric), old.get(metric)
+            if new_value is None or old_value is None:
+                continue
+            if new_value > old_value * (1 + tolerance) and new_value - old_value > noise:
+                regressions.append(f"{r['phase']} @ {r['rows']} rows, overlap {r['overlap']}: "
+                                   f"{metric} {old_value} -> {new_value} "
+                                   f"(+{(new_value / old_value - 1) * 100 if old_value else float('inf'):.0f}%)")
+    return regressions
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--overlaps", type=float, nargs="+", default=[0.1, 0.5, 0.9])
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread", help="BobServer mode")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative increase of a metric counted as a regression (default 0.2)")
+    parser.add_argument("--verbose", action="store_true", help="show Alice's log")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "mode": args.mode,
+        },
+        "results": [],
+    }
+
+    print(f"{'rows':>9} {'overlap':>7} {'phase':>23} {'wall s':>8} {'cpu A s':>8} {'cpu B s':>8} "
+          f"{'sent MB':>8} {'recv MB':>8} {'rss A MB':>9} {'rss B MB':>9}")
+    fmt = lambda v, spec: "-" if v is None else format(v, spec)
+    for rows in args.sizes:
+        for overlap in args.overlaps:
+            for r in run_case(rows, overlap, args.mode, args.verbose):
+                results["results"].append(r)
+                print(f"{rows:>9} {overlap:>7} {r['phase'] + ('' if r['ok'] else ' (FAILED)'):>23} "
+                      f"{r['wall_s']:>8.2f} {fmt(r['cpu_alice_s'], '>8.2f')} {fmt(r['cpu_bob_s'], '>8.2f')} "
+                      f"{r['bytes_sent'] / 1e6:>8.2f} {r['bytes_recv'] / 1e6:>8.2f} "
+                      f"{fmt(r['peak_rss_alice_mb'], '>9.0f')} {fmt(r['peak_rss_bob_mb'], '>9.0f')}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION: {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%}).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import os
+import pickle
+import threading
+from collections import deque
+from point_array import PointArray
+
+# Blinded values kept in the change log for changes_since
+DEFAULT_MAX_CHANGE_ITEMS = 1 << 20
+
+class BlindedSetCache:
+    """
+    Keeps H(y)^b for every ID of one party, computed with a fixed PSIProtocol key.
+
+    Entries are only computed for IDs that are not cached yet, so adding or
+    removing rows touches only the affected entries. When a path is given the
+    cache is persisted there and reloaded on the next start, provided the key
+    fingerprint still matches (a rotated key invalidates the whole cache).
+    `version` increases whenever the set changes, so consumers of derived
+    structures (e.g. Alice's offline copy) can tell when they are stale.
+    Recent additions and removals are kept in a bounded in-memory log so
+    consumers can catch up from an older version (changes_since).
+    Versions handed to other parties go out as tokens (token()) that also
+    carry a random nonce of this cache's history: if the persisted cache is
+    lost and versions start over, old tokens no longer match.
+    """
+    def __init__(self, psi, path=None, max_change_items=DEFAULT_MAX_CHANGE_ITEMS):
+        self.psi = psi
+        self.path = path
+        self.fingerprint = psi.key_fingerprint()
+        # Row i of _points is the blinded value of _ids[i]; _rows maps ID -> row.
+        # Mutations build a new array (copy-on-write), so snapshots handed out
+        # to request handlers never change underneath them.
+        self._ids = []
+        self._rows = {}
+        self._points = PointArray.empty()
+        self.version = 0
+        self.nonce = os.urandom(8).hex()
+        self._lock = threading.Lock()
+        # (version, added points, removed points), oldest first; versions
+        # before _changes_from can no longer be replayed
+        self._changes = deque()
+        self._change_items = 0
+        self.max_change_items = max_change_items
+        if path:
+            self._load()
+        self._changes_from = self.version
+
+    @staticmethod
+    def path_for(cache_dir, psi, name="blinded"):
+        """
+        Default cache file location for a key: <cache_dir>/<name>_<fingerprint>.pkl
+        """
+        return os.path.join(cache_dir, f"{name}_{psi.key_fingerprint()}.pkl")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        if data.get("fingerprint") == self.fingerprint and "points" in data:
+            self._ids = data["ids"]
+            self._rows = {uid: i for i, uid in enumerate(self._ids)}
+            self._points = PointArray(data["points"])
+            self.version = data.get("version", 0)
+            # Caches saved before nonces existed keep the fresh one
+            self.nonce = data.get("nonce", self.nonce)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                "fingerprint": self.fingerprint,
+                "version": self.version,
+                "nonce": self.nonce,
+                "ids": list(self._ids),
+                "points": self._points.data
+            }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def sync(self, ids, progress_callback=None):
+        """
+        Makes the cache match exactly the given IDs.
+        Returns (num_added, num_removed).
+        """
+        ids = list(dict.fromkeys(ids))
+        wanted = set(ids)
+        with self._lock:
+            stale = [uid for uid in self._ids if uid not in wanted]
+        removed = self.remove(stale, save=False)
+        added = self.add(ids, progress_callback=progress_callback, save=False)
+        if added or removed:
+            self.save()
+        return added, removed
+
+    def add(self, ids, progress_callback=None, save=True):
+        """
+        Blinds and stores IDs that are not cached yet. Returns how many were added.
+        """
+        with self._lock:
+            missing = [uid for uid in dict.fromkeys(ids) if uid not in self._rows]
+        if missing:
+            blinded = self.psi.blind_many(missing, progress_callback=progress_callback)
+            with self._lock:
+                start = len(self._ids)
+                self._points = PointArray.concatenate([self._points, blinded])
+                self._ids.extend(missing)
+                self._rows.update((uid, start + i) for i, uid in enumerate(missing))
+                self.version += 1
+                self._log_change(blinded, PointArray.empty(blinded.width))
+            if save:
+                self.save()
+        return len(missing)
+
+    def remove(self, ids, save=True):
+        """
+        Drops IDs from the cache. Returns how many were removed.
+        Holes are filled with rows from the end, so only the moved rows are re-indexed.
+        """
+        with self._lock:
+            holes = sorted({self._rows[uid] for uid in ids if uid in self._rows})
+            if not holes:
+                return 0
+            data = self._points.data.copy()
+            removed = PointArray(data[holes])
+            new_size = len(self._ids) - len(holes)
+            hole_set = set(holes)
+            # Rows past new_size that survive move into holes below new_size
+            movers = [r for r in range(new_size, len(self._ids)) if r not in hole_set]
+            targets = [h for h in holes if h < new_size]
+            for uid in (self._ids[h] for h in holes):
+                del self._rows[uid]
+            for src, dst in zip(movers, targets):
+                data[dst] = data[src]
+                uid = self._ids[src]
+                self._ids[dst] = uid
+                self._rows[uid] = dst
+            del self._ids[new_size:]
+            self._points = PointArray(data[:new_size])
+            self.version += 1
+            self._log_change(PointArray.empty(removed.width), removed)
+        if save:
+            self.save()
+        return len(holes)
+
+    def clear(self):
+        """
+        Drops every entry; the version still moves on so offline copies go stale.
+        """
+        with self._lock:
+            self._ids = []
+            self._rows = {}
+            self._points = PointArray.empty()
+            self.version += 1
+            self._changes.clear()
+            self._change_items = 0
+            self._changes_from = self.version
+        self.save()
+
+    def _log_change(self, added, removed):
+        # Called with the lock held, right after self.version moved on
+        self._changes.append((self.version, added, removed))
+        self._change_items += len(added) + len(removed)
+        while self._changes and self._change_items > self.max_change_items:
+            version, old_added, old_removed = self._changes.popleft()
+            self._change_items -= len(old_added) + len(old_removed)
+            self._changes_from = version
+
+    def token(self, version=None) -> str:
+        """
+        Version token for other parties: "<nonce>:<version>" (current version by default).
+        """
+        return f"{self.nonce}:{self.version if version is None else version}"
+
+    def _parse_token(self, token):
+        # The version of a token from this cache's history, or None
+        nonce, _, version = str(token).partition(":")
+        if nonce != self.nonce or not version.isdigit():
+            return None
+        return int(version)
+
+    def changes_since(self, token):
+        """
+        Net change of the set after the version in `token`: returns (current
+        token, added points, removed points), or None if the token is from
+        another cache history or older than the change log reaches.
+        """
+        with self._lock:
+            version = self._parse_token(token)
+            if version is None or not self._changes_from <= version <= self.version:
+                return None
+            # point -> (present at `version`, present now); the first change
+            # to a point tells which state it started in
+            state = {}
+            for change_version, added, removed in self._changes:
+                if change_version <= version:
+                    continue
+                for point in removed:
+                    state[point] = (state.get(point, (True,))[0], False)
+                for point in added:
+                    state[point] = (state.get(point, (False,))[0], True)
+            return (self.token(),
+                    PointArray.from_list([p for p, (before, now) in state.items() if now and not before]),
+                    PointArray.from_list([p for p, (before, now) in state.items() if before and not now]))
+
+    def lookup(self, ids) -> PointArray:
+        """
+        Cached blinded values of the given IDs, which must all be cached.
+        """
+        with self._lock:
+            return self._points[[self._rows[uid] for uid in ids]]
+
+    def snapshot(self):
+        """
+        Returns (version, points) taken atomically.
+        """
+        with self._lock:
+            return self.version, self._points
+
+    def entries(self):
+        """
+        Returns (version, ids, points) taken atomically; points[i] belongs to ids[i].
+        """
+        with self._lock:
+            return self.version, list(self._ids), self._points
+
+    def points(self) -> PointArray:
+        """
+        All cached blinded values.
+        """
+        with self._lock:
+            return self._points
+
+    def __len__(self):
+        return len(self._ids)
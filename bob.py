@@ -1,56 +1,338 @@
+import asyncio
+import os
+import shutil
 import socket
+import tempfile
+import numpy as np
 import pandas as pd
-from psi_protocol import PSIProtocol, SecureAggregator
-from data_generator import generate_data
+from psi_protocol import PSIProtocol, SecureAggregator, HEContextCache, encrypt_payloads, digest_length, expected_false_positives, truncate_points, DEFAULT_MAX_FP, DEFAULT_MAX_QUERY_SIZE
+from blinded_cache import BlindedSetCache
+from curves import DEFAULT_CURVE, key_file_name, negotiate_curve
+from row_index import RowIndex, compact_columns, pack_rows
+from aggregation import segment_vectors, group_stride, DEFAULT_LAYOUT
+from cardinality import hash_ids, sample_mask, sample_rate_for
+from out_of_core import FileTable, SpillFile, DEFAULT_READ_ROWS, DEFAULT_MEMORY_BYTES
+from data_generator import generate_party, BOB
 import network_utils
-from tqdm import tqdm
+from event_log import EventLog, DEFAULT_LOG_CAPACITY, DEBUG, INFO, WARNING, ERROR
+from metrics import Metrics, MetricsServer
 import threading
 import time
-import tenseal as ts
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Commands Bob serves. Anything else is labelled "unknown" in metrics, so a
+# client can't create new label series at will
+COMMANDS = frozenset({
+    "PSI_HELLO", "PSI", "PSI_SETUP", "PSI_DELTA", "PSI_CARDINALITY", "PSI_STREAM",
+    "JOIN", "HE_CONTEXT", "SECURE_AGGREGATION", "EXIT"
+})
+
+# Public cap on |Bonus| announced to Alice for HE parameter planning, instead
+# of anything derived from the data
+DEFAULT_BONUS_BOUND = 2.0 ** 15
+
+def _command_label(command) -> str:
+    return command if isinstance(command, str) and command in COMMANDS else "unknown"
 
 class BobServer:
-    def __init__(self, host='0.0.0.0', port=5000):
+    def __init__(self, host='0.0.0.0', port=5000, workers=None, cache_dir=None,
+                 mode="thread", max_concurrency=4, queue_depth=16, request_timeout=300.0,
+                 he_workers=None, he_context_cache_size=8, metrics_port=None, metrics_host='127.0.0.1',
+                 curve=DEFAULT_CURVE, log_capacity=DEFAULT_LOG_CAPACITY, log_level="info",
+                 max_frame_bytes=network_utils.MAX_FRAME_BYTES, bonus_bound=DEFAULT_BONUS_BOUND):
+        """
+        cache_dir: if set, Bob's key and his blinded set H(y)^b are persisted
+                   there so restarts don't re-blind unchanged data.
+        mode: "thread" (one thread per connection) or "async" (sockets on an
+              asyncio event loop, PSI/HE work on a bounded executor).
+        max_concurrency, queue_depth, request_timeout: limits for "async" mode.
+        he_workers: threads evaluating secure-aggregation chunks in parallel.
+        he_context_cache_size: number of Alice HE contexts kept deserialized (LRU).
+        metrics_port: if set (0 = any free port), metrics are served in Prometheus text format on
+                      http://metrics_host:metrics_port/metrics while the server runs.
+        curve: PSI group ("p256" or "x25519", see curves.py). Clients learn it
+               in the PSI_HELLO handshake; set_curve switches it later.
+        log_capacity, log_level: size of the event ring buffer and the lowest level kept (None = off).
+                                 Apps tail it with events.since(cursor).
+        max_frame_bytes: largest message accepted from a client (None = no limit);
+                         a connection announcing a bigger one is dropped.
+        bonus_bound: public bound on |Bonus| given to Alice's parameter planner;
+                     secure aggregation is refused while the data exceeds it.
+        """
         self.host = host
         self.port = port
         self.running = False
         self.socket = None
         self.thread = None
-        self.psi = PSIProtocol()
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+        self.queue_depth = queue_depth
+        self.request_timeout = request_timeout
+        self.max_frame_bytes = max_frame_bytes
+        self.bonus_bound = bonus_bound
+        self.he_workers = he_workers or min(4, os.cpu_count() or 1)
+        self.he_contexts = HEContextCache(he_context_cache_size)
+        self._loop = None
         self.df_bob = None
-        self.logs = []
+        # ID -> row position index over df_bob, rebuilt whenever it changes
+        self.row_index = None
+        # File-backed dataset (load_file): lookup table and memory-mapped H(y)^b
+        self.cache_dir = cache_dir
+        self.table = None
+        self.file_points = None
+        # Bounded, thread-safe event buffer (see log() / logs)
+        self.events = EventLog(log_capacity, log_level)
+        self.metrics = Metrics(prefix="bob_")
+        self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port) if metrics_port is not None else None
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._init_psi(curve, workers)
+
+    def _init_psi(self, curve, workers):
+        """
+        Sets up the PSI key (kept in cache_dir, one file per curve), the
+        blinded-set cache and the derived payload key for a curve.
+        """
+        if self.cache_dir:
+            self.psi = PSIProtocol.from_key_file(os.path.join(self.cache_dir, key_file_name("bob_key", curve)),
+                                                  workers=workers, metrics=self.metrics, curve=curve)
+            cache_path = BlindedSetCache.path_for(self.cache_dir, self.psi, name="bob_blinded")
+        else:
+            self.psi = PSIProtocol(workers=workers, metrics=self.metrics, curve=curve)
+            cache_path = None
+        self.blinded_cache = BlindedSetCache(self.psi, cache_path)
+        # Second key for PSI with payload: rows are encrypted under keys from H(y)^b2
+        self.payload_psi = self.psi.derive("payload")
+        self._payload_keys = None
+
+    def set_curve(self, curve):
+        """
+        Switches PSI to another curve backend and re-blinds Bob's data under
+        that curve's key. Call it while the server is stopped.
+        """
+        if curve == self.psi.curve.name:
+            return
+        if self.table is not None:
+            raise ValueError("Cannot switch curves for file-backed data, reload the file instead")
+        old = (self.psi, self.payload_psi)
+        self._init_psi(curve, self.psi.workers)
+        for psi in old:
+            psi.close()
+        self.log(f"PSI curve is now {curve}.")
+        if self.df_bob is not None:
+            added, _ = self.blinded_cache.sync(self.df_bob["ID"])
+            self.log(f"Blinded set ready: {added} blinded.")
+
+    def _curve_error(self, msg):
+        """
+        Error reply for a PSI request blinded on a curve other than Bob's, else None.
+        """
+        curve = msg.get("curve", DEFAULT_CURVE)
+        if curve == self.psi.curve.name:
+            return None
+        return {"error": f"Request uses curve {curve} but Bob serves {self.psi.curve.name}, run PSI_HELLO first.",
+                "curve": self.psi.curve.name}
 
-    def log(self, message):
-        timestamp = time.strftime("%H:%M:%S")
-        entry = f"[{timestamp}] {message}"
-        print(entry)
-        self.logs.append(entry)
+    def log(self, message, level=INFO, **fields):
+        self.events.emit(level, message, **fields)
+
+    @property
+    def logs(self) -> list:
+        """
+        Formatted lines of the events still in the log, oldest first.
+        """
+        return self.events.lines()
 
     def generate_data(self):
         self.log("Generating data for Bob...")
-        _, self.df_bob = generate_data()
+        df_bob = generate_party(BOB)
+        return self.load_data(df_bob)
+
+    def load_data(self, df_bob):
+        """
+        Replaces Bob's dataset and brings the blinded set H(y)^b up to date.
+        Only IDs missing from the cache are blinded.
+        """
+        self._drop_file_data()
+        self._set_rows(df_bob)
         self.log(f"Bob has {len(self.df_bob)} rows.")
+        cached = len(self.blinded_cache)
+        added, removed = self.blinded_cache.sync(self.df_bob["ID"])
+        self.log(f"Blinded set ready: {added} blinded, {removed} dropped, {cached - removed} reused.")
         return self.df_bob
 
+    def load_file(self, path, chunk_size=DEFAULT_READ_ROWS, memory_bytes=DEFAULT_MEMORY_BYTES):
+        """
+        Serves a .csv / .parquet file that may not fit in memory. One chunked
+        pass blinds the IDs into a memory-mapped spill file and builds a
+        FileTable (ID index, Department and Bonus) for JOIN and aggregation,
+        under cache_dir or a temporary directory.
+        """
+        directory = tempfile.mkdtemp(prefix="bob_table_", dir=self.cache_dir)
+        spill = SpillFile(os.path.join(directory, "blinded.bin"))
+        self.log(f"Loading {path} out of core...")
+        try:
+            table = FileTable.build(path, directory, ["Department", "Bonus"], chunk_size=chunk_size,
+                                    memory_bytes=memory_bytes,
+                                    on_chunk=lambda chunk: spill.append(self.psi.blind_many(chunk["ID"].tolist())))
+            points = spill.points()
+        except Exception:
+            spill.close()
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        self._drop_file_data()
+        self.df_bob = None
+        self.row_index = None
+        # The in-memory blinded set no longer describes Bob's data
+        self.blinded_cache.clear()
+        self.table, self.file_points = table, points
+        self.log(f"Bob has {len(table)} rows (file-backed, {points.nbytes / 1e6:.0f} MB blinded set on disk).")
+        return table
+
+    def _drop_file_data(self):
+        if self.table is not None:
+            # Mapped files stay readable after unlinking, so in-flight requests are unaffected
+            shutil.rmtree(self.table.directory, ignore_errors=True)
+        self.table = None
+        self.file_points = None
+
+    def _blinded_snapshot(self):
+        """
+        (version token, H(y)^b) for the in-memory or the file-backed dataset.
+        """
+        if self.file_points is not None:
+            return self.blinded_cache.token(), self.file_points
+        version, points = self.blinded_cache.snapshot()
+        return self.blinded_cache.token(version), points
+
+    def _sampled_blinded(self, rate, seed, max_sample=None):
+        """
+        (number of rows, rate, H(y)^b of the IDs in the (rate, seed) sample)
+        for the in-memory or the file-backed dataset. With max_sample the rate
+        is first lowered so the sample stays about that size.
+        """
+        if self.file_points is not None:
+            size = len(self.file_points)
+        else:
+            _, ids, points = self.blinded_cache.entries()
+            size = len(points)
+        if max_sample is not None:
+            rate = min(rate, sample_rate_for(size, max_sample))
+        if self.file_points is not None:
+            hashes, rows = self.table.id_hashes()
+            rows = np.sort(np.asarray(rows[sample_mask(hashes, rate, seed)], dtype=np.int64))
+            return size, rate, self.file_points[rows]
+        return size, rate, points[np.nonzero(sample_mask(hash_ids(ids), rate, seed))[0]]
+
+    def _set_rows(self, df_bob):
+        """
+        Stores Bob's rows with compact dtypes (category Department, int32
+        Bonus) and rebuilds the ID -> row position index used by JOIN and
+        secure aggregation.
+        """
+        df_bob = compact_columns(df_bob)
+        self.row_index = RowIndex(df_bob)
+        self.df_bob = df_bob
+
+    def _locate(self, ids):
+        """
+        (positions, rows): the positions in ids that Bob has, and his
+        non-ID columns for them in the same order.
+        """
+        source = self.table if self.table is not None else self.row_index
+        return source.locate(ids)
+
+    def _psi_payload_reply(self, msg, addr, alice_blinded, alice_blinded_by_bob) -> list:
+        """
+        PSI with associated data: besides A^ab and B^b, Alice gets A^ab2 and
+        each of Bob's rows encrypted under a key from H(y)^b2, in the order of
+        B^b. She can unblind A^ab2 to H(x)^b2 only for her own items, so she
+        opens exactly the rows in the intersection and needs no JOIN.
+        """
+        if self.table is not None:
+            return [{"error": "PSI with payload is not supported for file-backed data."}]
+        version, ids, bob_blinded = self.blinded_cache.entries()
+        positions, rows = self._locate(ids)
+        if len(positions) != len(ids):
+            return [{"error": "Blinded set is out of sync with Bob's data."}]
+        # H(y)^b2 only changes with the data, so it is blinded once per version
+        cached = self._payload_keys
+        if cached is None or cached[0] != version:
+            cached = self._payload_keys = (version, self.payload_psi.blind_many(ids))
+        records, schema = pack_rows(rows)
+        payloads = encrypt_payloads(cached[1], records)
+        self.log(f"PSI with payload completed for {addr} ({payloads.width}-byte encrypted rows)")
+        return [
+            {"points": alice_blinded_by_bob, "key_points": self.payload_psi.reblind_many(alice_blinded)},
+            {"points": bob_blinded, "payloads": payloads, "schema": schema}
+        ]
+
+    def _departments(self) -> list:
+        if self.table is not None:
+            return sorted(self.table.categories["Department"])
+        return sorted(self.df_bob["Department"].unique())
+
+    def _max_bonus(self) -> float:
+        bonuses = self.table.column("Bonus") if self.table is not None else self.df_bob["Bonus"].to_numpy()
+        return float(np.abs(bonuses).max()) if len(bonuses) else 0.0
+
+    def add_rows(self, df_rows):
+        """
+        Appends rows to Bob's dataset, blinding only the new IDs.
+        """
+        if self.table is not None:
+            raise ValueError("add_rows is not supported for file-backed data, reload the file instead")
+        self._set_rows(pd.concat([self.df_bob, df_rows], ignore_index=True))
+        added = self.blinded_cache.add(df_rows["ID"])
+        self.log(f"Added {len(df_rows)} rows ({added} newly blinded).")
+
+    def remove_rows(self, ids):
+        """
+        Removes rows by ID and drops their blinded values.
+        """
+        if self.table is not None:
+            raise ValueError("remove_rows is not supported for file-backed data, reload the file instead")
+        ids = set(ids)
+        self._set_rows(self.df_bob[~self.df_bob["ID"].isin(ids)].reset_index(drop=True))
+        removed = self.blinded_cache.remove(ids)
+        self.log(f"Removed {removed} rows.")
+
     def start(self):
         if self.running:
             return
         
-        if self.df_bob is None:
+        if self.df_bob is None and self.table is None:
             self.generate_data()
 
         self.running = True
-        self.thread = threading.Thread(target=self._listen_loop)
+        target = self._run_async_loop if self.mode == "async" else self._listen_loop
+        self.thread = threading.Thread(target=target)
         self.thread.daemon = True
         self.thread.start()
-        self.log(f"Server started on {self.host}:{self.port}")
+        self.log(f"Server started on {self.host}:{self.port} ({self.mode} mode)")
+        if self.metrics_server:
+            self.metrics_server.start()
+            self.log(f"Metrics at http://{self.metrics_server.host}:{self.metrics_server.port}/metrics")
 
     def stop(self):
         self.running = False
+        if self.metrics_server:
+            self.metrics_server.stop()
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass # Loop already closed
         if self.socket:
             try:
                 self.socket.close()
             except:
                 pass
+        self.psi.close()
+        self.payload_psi.close()
         self.log("Server stopped.")
 
     def _listen_loop(self):
@@ -74,97 +356,567 @@ class BobServer:
                     except OSError:
                         break
         except Exception as e:
-            self.log(f"Server Error: {e}")
+            self.log(f"Server Error: {e}", level=ERROR)
         finally:
             self.running = False
 
+    def _handle_psi_stream(self, conn, chunk_size):
+        """
+        Re-blinds Alice's chunks as they arrive (stream "alice") while a second
+        thread streams Bob's cached H(y)^b (stream "bob") over the same socket.
+        Up to 2 * workers chunks are re-blinded at once on the PSI worker pool;
+        results go back in order as soon as they are ready.
+        """
+        send_lock = threading.Lock()
+        def send(msg):
+            with send_lock:
+                network_utils.send_msg(conn, msg, metrics=self.metrics)
+
+        def stream_bob_set():
+            _, bob_blinded = self._blinded_snapshot()
+            for i in range(0, len(bob_blinded), chunk_size):
+                send({"stream": "bob", "points": bob_blinded[i:i + chunk_size]})
+            send({"stream": "bob", "done": True})
+
+        bob_thread = threading.Thread(target=stream_bob_set, daemon=True)
+        bob_thread.start()
+        window = 2 * self.psi.workers
+        pending = deque()
+        try:
+            while True:
+                msg = self._recv(conn)
+                if msg is None:
+                    raise ConnectionError("Client closed connection during streaming PSI")
+                if msg.get("done"):
+                    if msg.get("error"):
+                        self.log(f"Alice aborted streaming PSI: {msg['error']}", level=WARNING)
+                    break
+                pending.append(self.psi.submit_reblind(msg["points"]))
+                while pending and (len(pending) >= window or pending[0].done()):
+                    send({"stream": "alice", "points": pending.popleft().result()})
+            while pending:
+                send({"stream": "alice", "points": pending.popleft().result()})
+            send({"stream": "alice", "done": True})
+        finally:
+            bob_thread.join()
+
+    def _aggregate_chunk(self, context, enc_bytes, ids, group_slots, chunk_no, layout=DEFAULT_LAYOUT):
+        """
+        Applies Bob's side of the aggregation layout to one encrypted chunk
+        (bonus addends and factors per segment, see aggregation.py) and sums
+        every segment per department into one packed ciphertext. The default
+        layout is a single segment, Enc(Salary) + Bonus, with the total for
+        dept in slot group_slots[dept].
+        Returns (packed ciphertext, departments present in the chunk).
+        """
+        t0 = time.perf_counter()
+        with self.metrics.timer("he_op_seconds", op="deserialize"):
+            enc_values = SecureAggregator.deserialize_vector(context, enc_bytes)
+        
+        # Prepare Bob's Bonuses aligned
+        positions, bob_rows = self._locate(ids)
+        if len(positions) != len(ids):
+            raise ValueError(f"Chunk {chunk_no}: {len(ids) - len(positions)} IDs are not in Bob's data")
+        departments = bob_rows["Department"]
+        if layout.get("group_by_department", True):
+            groups = departments.map(group_slots).to_numpy()
+            present = set(departments.unique())
+        else:
+            groups = np.zeros(len(ids), dtype=np.int64)
+            present = set(group_slots)
+        group_index, num_groups, span, weights, addends = segment_vectors(
+            layout, bob_rows["Bonus"].to_numpy(), groups, group_stride(len(group_slots)),
+            SecureAggregator.is_bfv(context))
+        
+        # Homomorphic Addition: Enc(Salary) + Bonus (and the other addends)
+        if addends is not None:
+            with self.metrics.timer("he_op_seconds", op="add_plain"):
+                enc_values = enc_values + addends.tolist()
+        
+        # Aggregate by Department: every segment's group sums in a single ciphertext
+        with self.metrics.timer("he_op_seconds", op="group_sum"):
+            packed = SecureAggregator.group_sum(context, enc_values, group_index, num_groups, weights, span)
+
+        # Per-chunk totals go to metrics (he_op_seconds{op="chunk"}); the log line is for debugging
+        elapsed = time.perf_counter() - t0
+        self.metrics.observe("he_op_seconds", elapsed, op="chunk")
+        self.log(f"Chunk {chunk_no}: aggregated {len(ids)} rows in {elapsed:.2f}s", level=DEBUG)
+        return packed, present
+
+    def _process_command(self, msg, addr, recv=None) -> list:
+        """
+        Runs one request/response command (PSI, JOIN, SECURE_AGGREGATION) and
+        returns the reply messages in the order they go on the wire.
+        Shared by the threaded and asyncio server modes. `recv` returns the
+        next message from the client, for commands whose request spans
+        several messages (chunked SECURE_AGGREGATION).
+        Records per-command latency and outcome.
+        """
+        command = _command_label(msg.get("command"))
+        status = "error"
+        try:
+            with self.metrics.timer("command_seconds", command=command):
+                replies = self._dispatch_command(msg, addr, recv)
+            if command != "unknown" and not any(isinstance(r, dict) and "error" in r for r in replies):
+                status = "ok"
+            return replies
+        finally:
+            self.metrics.inc("commands_total", command=command, status=status)
+
+    def _dispatch_command(self, msg, addr, recv=None) -> list:
+        command = msg.get("command")
+
+        if command in ("PSI", "PSI_SETUP", "PSI_DELTA", "PSI_CARDINALITY"):
+            error = self._curve_error(msg)
+            if error:
+                self.log(f"{command} from {addr} rejected: {error['error']}", level=WARNING)
+                return [error]
+
+        if command == "PSI_HELLO":
+            # Handshake: pick the first curve Alice offers that Bob serves
+            curve = negotiate_curve(msg.get("curves", [DEFAULT_CURVE]), [self.psi.curve.name])
+            if curve is None:
+                self.log(f"No common curve with {addr} (offered {msg.get('curves')}).", level=WARNING)
+                return [{"error": f"No common curve, Bob serves {self.psi.curve.name}.", "curve": self.psi.curve.name}]
+            self.log(f"PSI_HELLO from {addr}: using {curve}")
+            return [{"curve": curve, "epoch": self.psi.key_fingerprint()}]
+
+        elif command == "PSI":
+            self.log(f"PSI Request from {addr}")
+            alice_blinded = msg.get("points")
+            
+            # Compute A^b (Alice's items blinded by Bob)
+            alice_blinded_by_bob = self.psi.reblind_many(alice_blinded)
+            
+            # Send B^b = H(y)^b (precomputed when data was loaded)
+            version, bob_blinded = self._blinded_snapshot()
+
+            if msg.get("unbalanced"):
+                # Online phase: Alice already holds our offline set, only A^b goes back
+                self.log(f"Unbalanced PSI (online phase) completed for {addr}")
+                return [{
+                    "points": alice_blinded_by_bob,
+                    "epoch": self.psi.key_fingerprint(),
+                    "version": version
+                }]
+
+            if msg.get("payload"):
+                return self._psi_payload_reply(msg, addr, alice_blinded, alice_blinded_by_bob)
+
+            if msg.get("compact"):
+                # Truncated digests of H(y)^b; Alice unblinds A^ab to A^b and checks membership
+                num_bytes = digest_length(len(alice_blinded), len(bob_blinded), msg.get("max_fp", DEFAULT_MAX_FP))
+                expected_fp = expected_false_positives(len(alice_blinded), len(bob_blinded), num_bytes)
+                self.log(f"Compact PSI: {num_bytes}-byte digests, expected false positives {expected_fp:.2e}")
+                self.log(f"PSI Protocol completed for {addr}")
+                return [
+                    {"points": alice_blinded_by_bob},
+                    {"digests": truncate_points(bob_blinded, num_bytes), "digest_bytes": num_bytes}
+                ]
+            
+            self.log(f"PSI Protocol completed for {addr}")
+            return [{"points": alice_blinded_by_bob}, {"points": bob_blinded}]
+
+        elif command == "PSI_SETUP":
+            # Offline phase of unbalanced PSI: ship digests of H(y)^b once per key epoch/data version
+            self.log(f"PSI_SETUP Request from {addr}")
+            epoch = self.psi.key_fingerprint()
+            version, bob_blinded = self._blinded_snapshot()
+            if msg.get("epoch") == epoch and msg.get("version") == version:
+                self.log(f"Offline set for {addr} is up to date.")
+                return [{"epoch": epoch, "version": version, "unchanged": True}]
+
+            max_query_size = msg.get("max_query_size", DEFAULT_MAX_QUERY_SIZE)
+            num_bytes = digest_length(max_query_size, len(bob_blinded), msg.get("max_fp", DEFAULT_MAX_FP))
+            self.log(f"Sending offline set to {addr}: {len(bob_blinded)} {num_bytes}-byte digests "
+                     f"(epoch {epoch}, version {version}).")
+            return [{
+                "epoch": epoch,
+                "version": version,
+                "digest_bytes": num_bytes,
+                "digests": truncate_points(bob_blinded, num_bytes)
+            }]
+
+        elif command == "PSI_DELTA":
+            # Incremental PSI: Alice sends H(x)^a only for IDs she has no A^ab for and
+            # catches up on B^b from the data version she last saw
+            epoch = self.psi.key_fingerprint()
+            if msg.get("epoch") not in (None, epoch):
+                self.log(f"PSI_DELTA from {addr} is for an old key epoch, asking for a full refresh.")
+                return [{"epoch": epoch, "stale": True}]
+            reply = {"epoch": epoch, "points": self.psi.reblind_many(msg["points"])}
+            changes = None
+            if msg.get("epoch") is not None and self.table is None:
+                changes = self.blinded_cache.changes_since(msg.get("version"))
+            if changes is None:
+                reply["version"], reply["full"] = self._blinded_snapshot()
+                self.log(f"PSI_DELTA for {addr}: {len(reply['points'])} re-blinded, full set of {len(reply['full'])}")
+            else:
+                reply["version"], reply["added"], reply["removed"] = changes
+                self.log(f"PSI_DELTA for {addr}: {len(reply['points'])} re-blinded, "
+                         f"{len(reply['added'])} added / {len(reply['removed'])} removed since version {msg.get('version')}")
+            return [reply]
+
+        elif command == "PSI_CARDINALITY":
+            # Approximate overlap size: both sides keep only the IDs in the same
+            # hash-based sample, and Alice counts matches between her sample and ours.
+            # Samples are nested (lower rate = subset), so if our set is the larger
+            # one we sample at a lower rate and Alice's extra items just don't match
+            seed = msg["seed"]
+            bob_size, rate, bob_sample = self._sampled_blinded(msg["sample_rate"], seed, msg.get("max_sample"))
+            alice_blinded_by_bob = self.psi.reblind_many(msg["points"])
+            # Shuffled, so Alice learns how many of her items match but not which
+            shuffled = alice_blinded_by_bob[np.random.default_rng().permutation(len(alice_blinded_by_bob))]
+            num_bytes = digest_length(len(shuffled), len(bob_sample), msg.get("max_fp", DEFAULT_MAX_FP))
+            self.log(f"PSI_CARDINALITY for {addr}: sample rate {rate:.3g}, "
+                     f"{len(shuffled)} of Alice's / {len(bob_sample)} of {bob_size} of Bob's items")
+            return [{
+                "points": shuffled,
+                "digests": truncate_points(bob_sample, num_bytes),
+                "digest_bytes": num_bytes,
+                "bob_size": bob_size,
+                "sample_rate": rate
+            }]
+
+        elif command == "JOIN":
+            self.log(f"JOIN Request from {addr}")
+            # Indexed lookup; rows go back as columns in request order, so Alice
+            # lines them up with her own rows by position
+            positions, rows = self._locate(msg.get("ids"))
+            self.log(f"Sent {len(rows)} records to {addr}")
+            return [{"positions": positions.astype(np.int32), "columns": rows}]
+
+        elif command == "HE_CONTEXT":
+            # Session negotiation: Alice asks whether her context is cached and uploads it only if not
+            if msg.get("context") is not None:
+                with self.metrics.timer("he_op_seconds", op="load_context"):
+                    context_id = self.he_contexts.put(msg["context"])
+                if msg.get("context_id") not in (None, context_id):
+                    return [{"error": "HE context does not match its ID."}]
+                self.log(f"Cached HE context {context_id[:12]} from {addr} ({len(self.he_contexts)} cached)")
+                return [{"context_id": context_id, "known": True}]
+            # Workload hints for Alice's parameter planner, none of them taken from
+            # the values: the configured bonus bound, and the group stride that the
+            # aggregation result reveals anyway
+            if self._max_bonus() > self.bonus_bound:
+                self.log(f"Bonuses exceed the configured bound {self.bonus_bound}, raise bonus_bound "
+                         f"to aggregate.", level=WARNING)
+                return [{"error": "Bob's data exceeds his configured value bound."}]
+            context_id = msg.get("context_id")
+            return [{
+                "context_id": context_id,
+                "known": context_id in self.he_contexts,
+                "group_stride": group_stride(len(self._departments())),
+                "value_bound": float(self.bonus_bound)
+            }]
+
+        elif command == "SECURE_AGGREGATION":
+            self.log(f"SECURE_AGGREGATION Request from {addr}")
+            
+            # Look up the session's cached context (or take an embedded one);
+            # the salary vector arrives as one or more ciphertext chunks
+            if msg.get("context") is not None:
+                context = self.he_contexts.get(self.he_contexts.put(msg["context"]))
+            else:
+                context = self.he_contexts.get(msg.get("context_id"))
+            if context is None:
+                # Drain the remaining chunks so the connection stays in sync
+                chunk = msg
+                while chunk is not None and chunk.get("more"):
+                    chunk = recv() if recv else None
+                self.log(f"Unknown HE context {msg.get('context_id')} from {addr}", level=WARNING)
+                return [{"error": "Unknown HE context, register it with HE_CONTEXT first."}]
+            # The scheme (CKKS or BFV) follows from the context Alice registered
+            self.log(f"Aggregating with {'BFV (exact)' if SecureAggregator.is_bfv(context) else 'CKKS'}")
+            # Fixed department -> slot layout shared by all chunks; several statistics
+            # arrive as segments of the same ciphertexts (default: one, Salary + Bonus)
+            layout = msg.get("layout") or DEFAULT_LAYOUT
+            if layout.get("group_by_department", True):
+                group_slots = {dept: i for i, dept in enumerate(self._departments())}
+            else:
+                group_slots = {"*": 0}
+            packed_sum = None
+            present = set()
+            num_chunks = 0
+            num_rows = 0
+
+            def merge(future):
+                nonlocal packed_sum
+                packed, depts = future.result()
+                present.update(depts)
+                packed_sum = packed if packed_sum is None else SecureAggregator.add_packed(context, packed_sum, packed)
+
+            # Evaluate chunks in parallel while later ones are still arriving;
+            # at most 2 * he_workers chunks are held in memory at once.
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=self.he_workers) as pool:
+                chunk = msg
+                while True:
+                    num_chunks += 1
+                    num_rows += len(chunk["ids"])
+                    pending.append(pool.submit(
+                        self._aggregate_chunk, context, chunk["enc_salaries"], chunk["ids"], group_slots, num_chunks,
+                        layout
+                    ))
+                    while len(pending) >= 2 * self.he_workers:
+                        merge(pending.popleft())
+                    if not chunk.get("more"):
+                        break
+                    chunk = recv() if recv else None
+                    if chunk is None:
+                        raise ConnectionError("Client closed connection during secure aggregation")
+                while pending:
+                    merge(pending.popleft())
+
+            self.log(f"Received encrypted salary vector size: {num_rows} ({num_chunks} chunk(s))")
+            self.log(f"Aggregated records into {len(present)} groups x {len(layout['segments'])} segment(s) "
+                     f"(one packed ciphertext).")
+            return [{
+                "packed_result": SecureAggregator.serialize_ciphertext(packed_sum),
+                "groups": {dept: group_slots[dept] for dept in sorted(present)},
+                "group_stride": group_stride(len(group_slots))
+            }]
+
+        return []
+
+    def _recv(self, conn):
+        return network_utils.recv_msg(conn, metrics=self.metrics, max_bytes=self.max_frame_bytes,
+                                      allow_pickle=False)
+
     def _handle_client(self, conn, addr):
         try:
             while True:
-                msg = network_utils.recv_msg(conn)
+                msg = self._recv(conn)
                 if not msg:
                     break
                 
                 command = msg.get("command")
                 
-                if command == "PSI":
-                    self.log(f"PSI Request from {addr}")
-                    alice_blinded = msg.get("points")
-                    
-                    # Compute A^b (Alice's items blinded by Bob)
-                    alice_blinded_by_bob = []
-                    for p in alice_blinded:
-                         # p is x-coord bytes. Treat as PubKey.
-                         res = self.psi.apply_private_key(p)
-                         alice_blinded_by_bob.append(res)
-
-                    network_utils.send_msg(conn, {"points": alice_blinded_by_bob})
-                    
-                    # Send B^b = H(y)^b
-                    bob_ids = self.df_bob["ID"].tolist()
-                    bob_points = [self.psi.hash_to_curve_public_key(uid) for uid in bob_ids]
-                    bob_blinded = [self.psi.apply_private_key(p) for p in bob_points]
-                    
-                    network_utils.send_msg(conn, {"points": bob_blinded})
-                    self.log(f"PSI Protocol completed for {addr}")
-                    
-                elif command == "JOIN":
-                    self.log(f"JOIN Request from {addr}")
-                    ids_to_join = msg.get("ids")
-                    mask = self.df_bob["ID"].isin(ids_to_join)
-                    joined_data = self.df_bob[mask].to_dict('records')
-                    network_utils.send_msg(conn, {"data": joined_data})
-                    self.log(f"Sent {len(joined_data)} records to {addr}")
-
-                elif command == "SECURE_AGGREGATION":
-                    self.log(f"SECURE_AGGREGATION Request from {addr}")
-                    
-                    # Deserialize Context and Vector
-                    context = SecureAggregator.deserialize_context(msg.get("context"))
-                    enc_salaries = SecureAggregator.deserialize_vector(context, msg.get("enc_salaries"))
-                    ids = msg.get("ids") # Alignment list
-                    
-                    self.log(f"Received encrypted salary vector size: {len(ids)}")
-                    
-                    # Prepare Bob's Bonuses aligned
-                    bob_subset = self.df_bob[self.df_bob["ID"].isin(ids)].set_index("ID")
-                    bob_subset = bob_subset.reindex(ids)
-                    bonuses = bob_subset["Bonus"].tolist()
-                    departments = bob_subset["Department"].tolist()
-                    
-                    # Homomorphic Addition: Enc(Salary) + Bonus
-                    enc_total = enc_salaries + bonuses
-                    
-                    # Aggregate by Department
-                    grouped_sums = {}
-                    unique_depts = set(departments)
-                    
-                    for dept in unique_depts:
-                         # Create mask for this department
-                         mask = [1 if d == dept else 0 for d in departments]
-                         # Enc(Total) * Mask -> keeps only dept values, others 0
-                         # Sum() -> Sum of dept values
-                         enc_dept = enc_total * mask
-                         enc_dept_sum = enc_dept.sum()
-                         
-                         grouped_sums[dept] = enc_dept_sum.serialize()
-                         
-                    self.log(f"Aggregated records into {len(grouped_sums)} departments.")
-                    
-                    network_utils.send_msg(conn, {"results": grouped_sums})
-                    self.log("Sent aggregated results to Alice.")
-                    
+                if command == "PSI_STREAM":
+                    self.log(f"Streaming PSI Request from {addr}")
+                    error = self._curve_error(msg)
+                    if error:
+                        # Skip the chunks Alice already sent so the connection stays in sync
+                        network_utils.send_msg(conn, error, metrics=self.metrics)
+                        chunk = msg
+                        while chunk is not None and not chunk.get("done"):
+                            chunk = self._recv(conn)
+                        self.log(f"Streaming PSI from {addr} rejected: {error['error']}", level=WARNING)
+                        self.metrics.inc("commands_total", command=command, status="error")
+                        continue
+                    status = "error"
+                    try:
+                        with self.metrics.timer("command_seconds", command=command):
+                            self._handle_psi_stream(conn, msg.get("chunk_size", 1024))
+                        status = "ok"
+                    finally:
+                        self.metrics.inc("commands_total", command=command, status=status)
+                    self.log(f"Streaming PSI completed for {addr}")
+
                 elif command == "EXIT":
                     self.log(f"Client {addr} disconnected.")
                     break
+
+                else:
+                    recv = lambda: self._recv(conn)
+                    for reply in self._process_command(msg, addr, recv):
+                        network_utils.send_msg(conn, reply, metrics=self.metrics)
                     
+        except network_utils.FrameTooLarge as e:
+            self.log(f"Dropping client {addr}: {e}", level=WARNING, addr=str(addr))
         except Exception as e:
-            self.log(f"Error handling client {addr}: {e}")
+            self.log(f"Error handling client {addr}: {e}", level=ERROR, addr=str(addr))
             import traceback
             traceback.print_exc()
         finally:
             conn.close()
 
+    # --- asyncio server mode ---
+
+    def _run_async_loop(self):
+        try:
+            asyncio.run(self._serve_async())
+        except Exception as e:
+            self.log(f"Server Error: {e}", level=ERROR)
+        finally:
+            self.running = False
+
+    async def _serve_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._pending = 0
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="bob-worker")
+        self._executor = executor
+        server = await asyncio.start_server(
+            self._handle_client_async, self.host, self.port, reuse_address=True
+        )
+        try:
+            async with server:
+                await self._stop_event.wait()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._loop = None
+
+    def _admit(self):
+        """
+        Takes a slot of the async server's admission bound (max_concurrency
+        running + queue_depth waiting). Returns False, after counting the
+        rejection, when all are taken; otherwise _release must follow.
+        """
+        if self._pending >= self.max_concurrency + self.queue_depth:
+            self.log("Server busy: request rejected (queue full).", level=WARNING)
+            self.metrics.inc("requests_rejected_total", reason="busy")
+            return False
+        self._pending += 1
+        self.metrics.set("requests_in_flight", self._pending)
+        return True
+
+    def _release(self, *_):
+        self._pending -= 1
+        self.metrics.set("requests_in_flight", self._pending)
+
+    async def _run_bounded(self, fn, *args):
+        """
+        Runs CPU-heavy work on the bounded executor. At most max_concurrency
+        jobs run at once and at most queue_depth more wait for a slot; beyond
+        that, or after request_timeout seconds, an error reply is returned.
+        Returns (replies, timed_out).
+
+        A worker thread can't be stopped, so on a timeout the job keeps its
+        slot until it really finishes (a job still queued is skipped), and
+        the caller must close the connection: the job may still be reading
+        follow-up messages from it.
+        """
+        if not self._admit():
+            return [{"error": "Server busy, try again later."}], False
+        submitted = time.perf_counter()
+        abandoned = threading.Event()
+        def job():
+            if abandoned.is_set():
+                return []
+            self.metrics.observe("queue_wait_seconds", time.perf_counter() - submitted)
+            return fn(*args)
+        future = self._loop.run_in_executor(self._executor, job)
+        future.add_done_callback(self._release)
+        try:
+            # shield: a timeout must not cancel (and so release) the still-running job
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.request_timeout), False
+        except asyncio.TimeoutError:
+            abandoned.set()
+            self.log(f"Request timed out after {self.request_timeout}s.", level=WARNING)
+            self.metrics.inc("requests_rejected_total", reason="timeout")
+            return [{"error": f"Request timed out after {self.request_timeout}s."}], True
+
+    async def _recv_async(self, reader):
+        return await network_utils.recv_msg_async(reader, metrics=self.metrics, max_bytes=self.max_frame_bytes,
+                                                  allow_pickle=False)
+
+    async def _handle_psi_stream_async(self, reader, writer, chunk_size):
+        """
+        asyncio version of _handle_psi_stream; chunks are re-blinded on the PSI
+        worker pool (or the executor without one), up to 2 * workers at once.
+        """
+        write_lock = asyncio.Lock()
+        async def send(msg):
+            async with write_lock:
+                await network_utils.send_msg_async(writer, msg, metrics=self.metrics)
+
+        async def stream_bob_set():
+            _, bob_blinded = self._blinded_snapshot()
+            for i in range(0, len(bob_blinded), chunk_size):
+                await send({"stream": "bob", "points": bob_blinded[i:i + chunk_size]})
+            await send({"stream": "bob", "done": True})
+
+        async def send_next():
+            points = await asyncio.wait_for(asyncio.wrap_future(pending.popleft()), timeout=self.request_timeout)
+            await send({"stream": "alice", "points": points})
+
+        bob_task = asyncio.create_task(stream_bob_set())
+        window = 2 * self.psi.workers
+        pending = deque()
+        try:
+            while True:
+                msg = await self._recv_async(reader)
+                if msg is None:
+                    raise ConnectionError("Client closed connection during streaming PSI")
+                if msg.get("done"):
+                    if msg.get("error"):
+                        self.log(f"Alice aborted streaming PSI: {msg['error']}", level=WARNING)
+                    break
+                pending.append(self.psi.submit_reblind(msg["points"], executor=self._executor))
+                while pending and (len(pending) >= window or pending[0].done()):
+                    await send_next()
+            while pending:
+                await send_next()
+            await send({"stream": "alice", "done": True})
+            await bob_task
+        finally:
+            bob_task.cancel()
+
+    async def _handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        self.log(f"Connected by {addr}")
+        try:
+            while True:
+                msg = await self._recv_async(reader)
+                if not msg:
+                    break
+
+                command = msg.get("command")
+
+                if command == "PSI_STREAM":
+                    self.log(f"Streaming PSI Request from {addr}")
+                    error = self._curve_error(msg)
+                    busy = error is None and not self._admit()
+                    if busy:
+                        error = {"error": "Server busy, try again later."}
+                    elif error is None:
+                        # The stream holds an admission slot for its whole duration
+                        status = "error"
+                        try:
+                            with self.metrics.timer("command_seconds", command=command):
+                                await self._handle_psi_stream_async(reader, writer, msg.get("chunk_size", 1024))
+                            status = "ok"
+                        finally:
+                            self._release()
+                            self.metrics.inc("commands_total", command=command, status=status)
+                        self.log(f"Streaming PSI completed for {addr}")
+                        continue
+                    # Skip the chunks Alice already sent so the connection stays in sync
+                    await network_utils.send_msg_async(writer, error, metrics=self.metrics)
+                    chunk = msg
+                    while chunk is not None and not chunk.get("done"):
+                        chunk = await self._recv_async(reader)
+                    self.log(f"Streaming PSI from {addr} rejected: {error['error']}", level=WARNING)
+                    if not busy:
+                        # Busy rejections are already in requests_rejected_total
+                        self.metrics.inc("commands_total", command=command, status="error")
+
+                elif command == "EXIT":
+                    self.log(f"Client {addr} disconnected.")
+                    break
+
+                else:
+                    # Lets the worker thread read follow-up messages through the event loop
+                    loop = self._loop
+                    recv = lambda: asyncio.run_coroutine_threadsafe(
+                        self._recv_async(reader), loop
+                    ).result(timeout=self.request_timeout)
+                    replies, timed_out = await self._run_bounded(self._process_command, msg, addr, recv)
+                    for reply in replies:
+                        await network_utils.send_msg_async(writer, reply, metrics=self.metrics)
+                    if timed_out:
+                        # The abandoned job may still read from this connection; stop serving it
+                        self.log(f"Closing connection to {addr} after a timeout.", level=WARNING)
+                        break
+
+        except network_utils.FrameTooLarge as e:
+            self.log(f"Dropping client {addr}: {e}", level=WARNING, addr=str(addr))
+        except Exception as e:
+            self.log(f"Error handling client {addr}: {e}", level=ERROR, addr=str(addr))
+        finally:
+            writer.close()
+
 # For backward compatibility if run directly
 if __name__ == "__main__":
     server = BobServer()
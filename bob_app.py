@@ -1,7 +1,13 @@
 import streamlit as st
 from bob import BobServer
+from metrics import MetricsServer
+from event_log import format_event
 import time
 import pandas as pd
+from collections import deque
+
+# Log lines shown in the UI
+LOG_VIEW_LINES = 500
 
 st.set_page_config(page_title="Bob (Server)", layout="wide")
 
@@ -12,11 +18,19 @@ if 'server' not in st.session_state:
     st.session_state.server = BobServer()
 if 'server_running' not in st.session_state:
     st.session_state.server_running = False
+if 'log_cursor' not in st.session_state:
+    st.session_state.log_cursor = 0
+    st.session_state.log_lines = deque(maxlen=LOG_VIEW_LINES)
 
 # Sidebar Controls
 st.sidebar.header("Server Control")
 host = st.sidebar.text_input("Host", "0.0.0.0")
 port = st.sidebar.number_input("Port", value=5000)
+mode = st.sidebar.selectbox("Server Mode", ["thread", "async"])
+curve = st.sidebar.selectbox("PSI Curve", ["p256", "x25519"])
+max_concurrency = st.sidebar.number_input("Max Concurrent Jobs (async)", min_value=1, value=4)
+serve_metrics = st.sidebar.checkbox("Serve Prometheus Metrics", value=True)
+metrics_port = st.sidebar.number_input("Metrics Port (0 = any free port)", min_value=0, value=9108)
 
 col1, col2 = st.sidebar.columns(2)
 
@@ -24,6 +38,11 @@ if col1.button("Start Server"):
     if not st.session_state.server_running:
         st.session_state.server.host = host
         st.session_state.server.port = port
+        st.session_state.server.mode = mode
+        st.session_state.server.max_concurrency = int(max_concurrency)
+        st.session_state.server.set_curve(curve)
+        if serve_metrics and st.session_state.server.metrics_server is None:
+            st.session_state.server.metrics_server = MetricsServer(st.session_state.server.metrics, port=int(metrics_port))
         st.session_state.server.start()
         st.session_state.server_running = True
         st.success("Server Started")
@@ -41,17 +60,36 @@ if st.session_state.server.df_bob is not None:
 else:
     st.info("Data will be generated when server starts.")
 
+# Metrics
+st.subheader("Server Metrics")
+if st.session_state.server.metrics_server is not None and st.session_state.server_running:
+    st.caption(f"Prometheus endpoint: http://127.0.0.1:{st.session_state.server.metrics_server.port}/metrics")
+metrics_placeholder = st.empty()
+
+def show_metrics():
+    rows = st.session_state.server.metrics.rows()
+    if rows:
+        metrics_placeholder.dataframe(pd.DataFrame(rows), use_container_width=True)
+    else:
+        metrics_placeholder.info("No metrics recorded yet.")
+
 # Logs
 st.subheader("Server Logs")
 log_placeholder = st.empty()
 
-# Auto-refresh logs
+def show_logs():
+    # Only events past the cursor are fetched; the view keeps the newest LOG_VIEW_LINES
+    events, st.session_state.log_cursor = st.session_state.server.events.since(st.session_state.log_cursor, LOG_VIEW_LINES)
+    st.session_state.log_lines.extend(format_event(event) for event in events)
+    log_placeholder.text_area("Logs", value="\n".join(reversed(st.session_state.log_lines)), height=300)
+
+# Auto-refresh logs and metrics
 while st.session_state.server_running:
-    logs = st.session_state.server.logs
-    log_placeholder.text_area("Logs", value="\n".join(logs[::-1]), height=300)
+    show_metrics()
+    show_logs()
     time.sleep(1)
     st.rerun()
 
 # If not running, show static logs
-logs = st.session_state.server.logs
-log_placeholder.text_area("Logs", value="\n".join(logs[::-1]), height=300)
+show_metrics()
+show_logs()
@@ -0,0 +1,62 @@
+import math
+from collections import namedtuple
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+
+# Items Alice blinds and sends by default; the sample rate follows from her set size
+DEFAULT_CARDINALITY_SAMPLE = 10_000
+DEFAULT_CONFIDENCE = 0.95
+
+CardinalityEstimate = namedtuple("CardinalityEstimate", [
+    "estimate", "low", "high", "confidence", "sample_rate", "sampled_matches", "alice_size", "bob_size"
+])
+
+def hash_ids(ids) -> np.ndarray:
+    """
+    64-bit hashes of IDs (pandas' hash_array, the same hash FileTable indexes by).
+    """
+    return pd.util.hash_array(np.asarray(ids, dtype=object))
+
+def _mix64(x):
+    # splitmix64 finalizer, so every seed gives an independent-looking order
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+def sample_mask(hashes, rate, seed) -> np.ndarray:
+    """
+    Which IDs (given by hash_ids) are in the sample for (rate, seed). Both
+    parties compute it on their own IDs, so an ID in both sets is either
+    sampled on both sides or on neither.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if rate >= 1:
+        return np.ones(len(hashes), dtype=bool)
+    threshold = np.uint64(min(int(rate * 2**64), 2**64 - 1))
+    return _mix64(hashes ^ np.uint64(seed)) < threshold
+
+def sample_rate_for(num_items, max_sample=DEFAULT_CARDINALITY_SAMPLE) -> float:
+    return min(1.0, max_sample / max(num_items, 1))
+
+def estimate_cardinality(matches, rate, alice_size, bob_size, confidence=DEFAULT_CONFIDENCE) -> CardinalityEstimate:
+    """
+    Scales the matches found in the sample up to the full sets. Every common
+    ID is sampled independently with probability rate, so matches is
+    Binomial(|A ∩ B|, rate); the bounds are the normal approximation of that,
+    clipped to [matches, min(|A|, |B|)]. With no matches the upper bound is
+    -ln(1 - confidence) / rate (about 3 / rate at 95%).
+    """
+    limit = min(alice_size, bob_size)
+    if rate >= 1:
+        return CardinalityEstimate(matches, matches, matches, confidence, 1.0, matches, alice_size, bob_size)
+    estimate = matches / rate
+    if matches:
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        spread = z * math.sqrt(matches * (1 - rate)) / rate
+        low, high = estimate - spread, estimate + spread
+    else:
+        low, high = 0.0, -math.log(1 - confidence) / rate
+    return CardinalityEstimate(min(estimate, limit), max(low, matches), min(high, limit), confidence, rate,
+                               matches, alice_size, bob_size)
@@ -0,0 +1,198 @@
+import hashlib
+import os
+from cryptography.hazmat.primitives.asymmetric import ec, x25519
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+# SECP256R1 Curve Parameters (for manual point reconstruction)
+P = 0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff
+A = -3
+B = 0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b
+# Group order
+N = 0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551
+
+# Order of the prime-order subgroup of Curve25519
+L = 2**252 + 27742317777372353535851937790883648493
+# Number of extra base points X25519Curve keeps for scalars it can't encode directly
+X25519_EXTRA_BASES = 64
+
+CURVE_P256 = "p256"
+CURVE_X25519 = "x25519"
+DEFAULT_CURVE = CURVE_P256
+# Curves a client offers in the PSI handshake by default, most preferred first
+CURVE_PREFERENCE = (CURVE_X25519, CURVE_P256)
+
+class P256Curve:
+    """
+    NIST P-256. Points travel as 32-byte x-coordinates, so every point received
+    has to be decompressed (a modular square root) before it can be multiplied.
+    """
+    name = CURVE_P256
+    order = N
+    point_bytes = 32
+
+    def __init__(self):
+        self.curve = ec.SECP256R1()
+
+    def generate_scalar(self) -> int:
+        return ec.generate_private_key(self.curve).private_numbers().private_value
+
+    def is_valid_scalar(self, k: int) -> bool:
+        return 0 < k < N
+
+    def private_key(self, k: int):
+        return ec.derive_private_key(k, self.curve, default_backend())
+
+    def scalar_from_key(self, key) -> int:
+        return key.private_numbers().private_value
+
+    def public_bytes(self, key) -> bytes:
+        return key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.CompressedPoint
+        )
+
+    def base_mult(self, k: int) -> bytes:
+        """
+        x(k * G), using OpenSSL's precomputed table for G.
+        """
+        # Compressed encoding is 0x02/0x03 || x
+        return self.public_bytes(self.private_key(k))[1:]
+
+    def exchange(self, key, point) -> bytes:
+        """
+        x(priv * P) for P given as x-coordinate bytes or as a public key.
+        """
+        if isinstance(point, bytes):
+            point = self._bytes_to_public_key(point)
+        return key.exchange(ec.ECDH(), point)
+
+    def _bytes_to_public_key(self, x_bytes: bytes) -> ec.EllipticCurvePublicKey:
+        """
+        Reconstructs a PublicKey from just the X-coordinate bytes.
+        Solves y^2 = x^3 + ax + b for y.
+        """
+        x = int.from_bytes(x_bytes, 'big')
+        rhs = (pow(x, 3, P) + A*x + B) % P
+        # Compute square root using Tonelli-Shanks or simple exponentiation if p = 3 mod 4
+        # P = 3 mod 4 for P-256.
+        y = pow(rhs, (P + 1) // 4, P)
+
+        # Verify
+        if (y*y) % P != rhs:
+            raise ValueError("Point not on curve")
+
+        public_numbers = ec.EllipticCurvePublicNumbers(x, y, self.curve)
+        return public_numbers.public_key(default_backend())
+
+class X25519Curve:
+    """
+    Curve25519 through X25519. Points are 32-byte little-endian u-coordinates
+    and the Montgomery ladder works on u alone, so received points are used
+    as they are, without decompression.
+
+    X25519 clamps every scalar (bit 254 set, low 3 bits cleared), so it can
+    only apply scalars of the form 2^254 + 8t. On the prime-order subgroup,
+    where all our points live, that still covers about half of the residues
+    mod L. Keys are picked so that the key and its inverse can both be
+    applied directly. For other scalars (priv * H(x) in blind) base_mult
+    falls back to a few fixed base points r*G and applies k / r instead.
+    """
+    name = CURVE_X25519
+    order = L
+    point_bytes = 32
+
+    def __init__(self):
+        self._inv8 = pow(8, -1, L)
+        self._bases = None
+
+    def encode(self, k: int):
+        """
+        32-byte X25519 scalar that acts as k on the prime-order subgroup,
+        or None if there is none.
+        """
+        t = (k - 2**254) * self._inv8 % L
+        if t >= 2**251:
+            return None
+        return (2**254 + 8 * t).to_bytes(32, 'little')
+
+    def generate_scalar(self) -> int:
+        while True:
+            k = int.from_bytes(os.urandom(40), 'big') % (L - 1) + 1
+            if self.is_valid_scalar(k):
+                return k
+
+    def is_valid_scalar(self, k: int) -> bool:
+        return 0 < k < L and self.encode(k) is not None and self.encode(pow(k, -1, L)) is not None
+
+    def private_key(self, k: int):
+        return x25519.X25519PrivateKey.from_private_bytes(self.encode(k))
+
+    def scalar_from_key(self, key) -> int:
+        return int.from_bytes(key.private_bytes_raw(), 'little') % L
+
+    def public_bytes(self, key) -> bytes:
+        return key.public_key().public_bytes_raw()
+
+    def _extra_bases(self):
+        # [(r^-1 mod L, x(r * G))] for fixed, encodable r
+        if self._bases is None:
+            bases = []
+            counter = 0
+            while len(bases) < X25519_EXTRA_BASES:
+                r = int.from_bytes(hashlib.sha256(b"x25519-base" + counter.to_bytes(4, 'big')).digest(), 'big') % L
+                counter += 1
+                if r and self.encode(r) is not None:
+                    bases.append((pow(r, -1, L), self.base_mult(r)))
+            self._bases = bases
+        return self._bases
+
+    def base_mult(self, k: int) -> bytes:
+        """
+        u(k * G). One fixed-base multiplication when k can be encoded,
+        otherwise one ladder step from the first extra base r*G for which k / r can.
+        """
+        scalar = self.encode(k)
+        if scalar is not None:
+            return x25519.X25519PrivateKey.from_private_bytes(scalar).public_key().public_bytes_raw()
+        for r_inv, base in self._extra_bases():
+            scalar = self.encode(k * r_inv % L)
+            if scalar is not None:
+                return x25519.X25519PrivateKey.from_private_bytes(scalar).exchange(
+                    x25519.X25519PublicKey.from_public_bytes(base))
+        raise ValueError("Scalar cannot be applied with X25519")
+
+    def exchange(self, key, point) -> bytes:
+        return key.exchange(x25519.X25519PublicKey.from_public_bytes(bytes(point)))
+
+CURVES = {
+    CURVE_P256: P256Curve,
+    CURVE_X25519: X25519Curve
+}
+
+def get_curve(curve=None):
+    """
+    Curve backend by name (or passed through if it already is one).
+    """
+    if curve is None:
+        curve = DEFAULT_CURVE
+    if not isinstance(curve, str):
+        return curve
+    if curve not in CURVES:
+        raise ValueError(f"Unknown curve {curve!r}, expected one of {sorted(CURVES)}")
+    return CURVES[curve]()
+
+def negotiate_curve(offered, supported):
+    """
+    First of the client's offered curves that the server supports, or None.
+    """
+    for name in offered:
+        if name in supported:
+            return name
+    return None
+
+def key_file_name(prefix: str, curve=None) -> str:
+    """
+    File name for a party's persisted key; P-256 keeps the original name so existing caches stay valid.
+    """
+    name = get_curve(curve).name
+    return f"{prefix}.pem" if name == CURVE_P256 else f"{prefix}_{name}.pem"
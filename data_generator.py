@@ -1,69 +1,214 @@
+"""
+Synthetic data for Alice and Bob.
+
+IDs, names and numbers are generated with NumPy in fixed-size blocks, each
+seeded from (seed, party, block), so the same seed always gives the same
+rows regardless of chunk size, and each party can generate its own side
+without the other's. Large datasets can be streamed to CSV or Parquet
+without holding them in memory.
+
+Usage:
+    python data_generator.py                                   # preview 1000 rows per side
+    python data_generator.py --party alice --rows 10000000 --out alice.parquet
+    python data_generator.py --party bob --rows 10000000 --out bob.csv
+"""
+import argparse
+import numpy as np
 import pandas as pd
-import random
-import string
+
+ALICE = "alice"
+BOB = "bob"
+PARTIES = (ALICE, BOB)
+
+DEPARTMENTS = ["HR", "Engineering", "Sales", "Marketing", "Finance"]
+ID_ALPHABET = np.frombuffer(b"abcdefghijklmnopqrstuvwxyz0123456789", dtype=np.uint8)
+ID_SUFFIX = np.frombuffer(b"@example.com", dtype=np.uint8)
+NAME_ALPHABET = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", dtype=np.uint8)
+
+# IDs are 10 characters that encode the row's global index, so they are unique
+# by construction: the low 5 base-36 digits go through a bijection mod 36^5,
+# the high 5 are salted with a hash of the low ones so they still look random
+ID_HIGH_CHARS = 5
+ID_LOW_CHARS = 5
+ID_LOW_SPACE = 36 ** ID_LOW_CHARS
+ID_SPACE = 36 ** (ID_HIGH_CHARS + ID_LOW_CHARS)
+# Rows generated per RNG block; chunking never changes the data
+BLOCK_ROWS = 1 << 16
+DEFAULT_CHUNK_ROWS = 1 << 20
+
+def _split(num_rows, overlap_ratio):
+    num_overlap = int(num_rows * overlap_ratio)
+    if 2 * num_rows - num_overlap > ID_SPACE:
+        raise ValueError(f"At most {ID_SPACE} distinct IDs can be generated")
+    return num_overlap
+
+def _coprime_multiplier(rng, modulus):
+    while True:
+        a = int(rng.integers(1, modulus)) if modulus > 1 else 1
+        if np.gcd(a, modulus) == 1:
+            return a
+
+class _Layout:
+    """
+    Maps a party's row number to a global ID index. Indices [0, overlap) are
+    shared, Alice owns [overlap, n) and Bob [n, 2n - overlap). Rows visit the
+    party's indices in a seeded affine order (the old generator's shuffle).
+    """
+    def __init__(self, party, num_rows, overlap_ratio, seed):
+        if party not in PARTIES:
+            raise ValueError(f"party must be one of {PARTIES}")
+        self.num_rows = num_rows
+        self.num_overlap = _split(num_rows, overlap_ratio)
+        self.offset = 0 if party == ALICE else num_rows - self.num_overlap
+        rng = np.random.default_rng([seed, 3, PARTIES.index(party)])
+        self.mul = _coprime_multiplier(rng, max(num_rows, 1))
+        self.add = int(rng.integers(0, max(num_rows, 1)))
+        id_rng = np.random.default_rng([seed, 4])
+        self.id_mul = _coprime_multiplier(id_rng, ID_LOW_SPACE)
+        self.id_add = int(id_rng.integers(0, ID_LOW_SPACE))
+
+    def global_index(self, rows):
+        local = (rows * self.mul + self.add) % self.num_rows
+        return np.where(local < self.num_overlap, local, local + self.offset)
+
+def _mix(x):
+    """
+    splitmix64 finalizer, vectorized (uint64 arithmetic wraps around).
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def _ids(layout, seed, index):
+    """
+    ID strings for the given global indices.
+    """
+    n = len(index)
+    chars = np.empty((n, ID_HIGH_CHARS + ID_LOW_CHARS + len(ID_SUFFIX)), dtype=np.uint8)
+    low = (index % ID_LOW_SPACE * layout.id_mul + layout.id_add) % ID_LOW_SPACE
+    # Salt is a hash of (seed, low), so both parties agree on shared IDs and
+    # (high, low) still maps back to a single index
+    salt = _mix(low.astype(np.uint64) + np.uint64(seed * 0x9E3779B97F4A7C15 % 2**64)) % np.uint64(ID_LOW_SPACE)
+    high = (index // ID_LOW_SPACE + salt.astype(np.int64)) % ID_LOW_SPACE
+    for i in range(ID_HIGH_CHARS - 1, -1, -1):
+        chars[:, i] = ID_ALPHABET[high % 36]
+        high //= 36
+    for i in range(ID_LOW_CHARS - 1, -1, -1):
+        chars[:, ID_HIGH_CHARS + i] = ID_ALPHABET[low % 36]
+        low //= 36
+    chars[:, ID_HIGH_CHARS + ID_LOW_CHARS:] = ID_SUFFIX
+    return chars.view(f"S{chars.shape[1]}").ravel().astype(str).astype(object)
+
+def _block(party, layout, seed, block):
+    start = block * BLOCK_ROWS
+    stop = min(start + BLOCK_ROWS, layout.num_rows)
+    rows = np.arange(start, stop, dtype=np.int64)
+    n = len(rows)
+    rng = np.random.default_rng([seed, PARTIES.index(party), 0, block])
+    ids = _ids(layout, seed, layout.global_index(rows))
+
+    if party == ALICE:
+        # Columns: ID, Name, Age, Salary
+        names = NAME_ALPHABET[rng.integers(0, 26, (n, 5))]
+        return pd.DataFrame({
+            "ID": ids,
+            "Name": names.view("S5").ravel().astype(str).astype(object),
+            "Age": rng.integers(20, 61, n),
+            "Salary": rng.integers(30000, 150001, n),
+        })
+    # Columns: ID, Department, Bonus
+    return pd.DataFrame({
+        "ID": ids,
+        "Department": np.array(DEPARTMENTS, dtype=object)[rng.integers(0, len(DEPARTMENTS), n)],
+        "Bonus": rng.integers(1000, 20001, n),
+    })
+
+def iter_party_chunks(party, num_rows=1000, overlap_ratio=0.5, seed=42, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Yields one party's rows as DataFrames of at most chunk_size rows.
+    """
+    layout = _Layout(party, num_rows, overlap_ratio, seed)
+    blocks_per_chunk = max(1, chunk_size // BLOCK_ROWS)
+    num_blocks = -(-num_rows // BLOCK_ROWS)
+    pending = []
+    for block in range(num_blocks):
+        pending.append(_block(party, layout, seed, block))
+        if len(pending) == blocks_per_chunk:
+            yield pd.concat(pending, ignore_index=True)
+            pending = []
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
+
+def generate_party(party, num_rows=1000, overlap_ratio=0.5, seed=42):
+    """
+    Generates one party's DataFrame ("alice" or "bob") without the other side.
+    """
+    chunks = list(iter_party_chunks(party, num_rows, overlap_ratio, seed))
+    if not chunks:
+        return _block(party, _Layout(party, 0, overlap_ratio, seed), seed, 0)
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+def write_party(party, path, num_rows=1000, overlap_ratio=0.5, seed=42, chunk_size=DEFAULT_CHUNK_ROWS):
+    """
+    Streams one party's rows to a .csv or .parquet file chunk by chunk.
+    Parquet needs pyarrow. Returns the number of rows written.
+    """
+    chunks = iter_party_chunks(party, num_rows, overlap_ratio, seed, chunk_size)
+    written = 0
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing Parquet requires pyarrow (pip install pyarrow)")
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                written += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, header=(i == 0), index=False)
+                written += len(chunk)
+    else:
+        raise ValueError("Output path must end in .csv or .parquet")
+    return written
 
 def generate_data(num_rows=1000, overlap_ratio=0.5, seed=42):
     """
     Generates data for Alice and Bob.
     Returns two DataFrames: df_alice, df_bob
     """
-    random.seed(seed)
-    
-    # Total unique IDs needed
-    # Overlap = 1000 * 0.5 = 500
-    # Alice unique = 500
-    # Bob unique = 500
-    # Total = 1500
-    
-    num_overlap = int(num_rows * overlap_ratio)
-    num_unique_alice = num_rows - num_overlap
-    num_unique_bob = num_rows - num_overlap
-    
-    # Generate IDs
-    def random_id():
-        return ''.join(random.choices(string.ascii_lowercase + string.digits, k=10)) + "@example.com"
-    
-    common_ids = [random_id() for _ in range(num_overlap)]
-    alice_only_ids = [random_id() for _ in range(num_unique_alice)]
-    bob_only_ids = [random_id() for _ in range(num_unique_bob)]
-    
-    alice_ids = common_ids + alice_only_ids
-    bob_ids = common_ids + bob_only_ids
-    
-    # Shuffle
-    random.shuffle(alice_ids)
-    random.shuffle(bob_ids)
-    
-    # Create Alice Data
-    # Columns: ID, Name, Age, Salary
-    alice_data = []
-    for uid in alice_ids:
-        alice_data.append({
-            "ID": uid,
-            "Name": ''.join(random.choices(string.ascii_uppercase, k=5)),
-            "Age": random.randint(20, 60),
-            "Salary": random.randint(30000, 150000)
-        })
-    
-    # Create Bob Data
-    # Columns: ID, Department, Bonus
-    bob_data = []
-    departments = ["HR", "Engineering", "Sales", "Marketing", "Finance"]
-    for uid in bob_ids:
-        bob_data.append({
-            "ID": uid,
-            "Department": random.choice(departments),
-            "Bonus": random.randint(1000, 20000)
-        })
-        
-    df_alice = pd.DataFrame(alice_data)
-    df_bob = pd.DataFrame(bob_data)
-    
+    # Overlap = 1000 * 0.5 = 500 shared IDs, 500 unique to each side
+    df_alice = generate_party(ALICE, num_rows, overlap_ratio, seed)
+    df_bob = generate_party(BOB, num_rows, overlap_ratio, seed)
     return df_alice, df_bob
 
 if __name__ == "__main__":
-    a, b = generate_data()
-    print(f"Alice: {len(a)} rows")
-    print(f"Bob: {len(b)} rows")
-    print("Sample Alice:", a.head())
-    print("Sample Bob:", b.head())
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--party", choices=PARTIES)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="write the party's rows to this .csv / .parquet file")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    if args.out:
+        if not args.party:
+            parser.error("--out needs --party")
+        rows = write_party(args.party, args.out, args.rows, args.overlap, args.seed, args.chunk_size)
+        print(f"Wrote {rows} {args.party} rows to {args.out}")
+    else:
+        a, b = generate_data(args.rows, args.overlap, args.seed)
+        print(f"Alice: {len(a)} rows")
+        print(f"Bob: {len(b)} rows")
+        print("Sample Alice:", a.head())
+        print("Sample Bob:", b.head())
@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import namedtuple
+
+# Severity levels (same numbers as the logging module)
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+# Events kept by default; older ones are overwritten
+DEFAULT_LOG_CAPACITY = 10_000
+
+# seq is the event's position in the log since it was created, so it doubles as a cursor
+Event = namedtuple("Event", ["seq", "timestamp", "level", "message", "fields"])
+
+def format_event(event) -> str:
+    """
+    One display line: "[HH:MM:SS] message", with the level for warnings and errors.
+    """
+    stamp = time.strftime("%H:%M:%S", time.localtime(event.timestamp))
+    if event.level >= WARNING:
+        return f"[{stamp}] {LEVEL_NAMES.get(event.level, event.level)}: {event.message}"
+    return f"[{stamp}] {event.message}"
+
+class EventLog:
+    """
+    Thread-safe, fixed-capacity buffer of structured events (level, message
+    and keyword fields). Once full, each new event overwrites the oldest, so
+    memory stays bounded however long a server runs.
+
+    Events below `level` are dropped before any work is done, and
+    level=None turns the log into a no-op. Readers keep a cursor and call
+    since(cursor) to fetch only the events they haven't seen yet.
+    """
+    def __init__(self, capacity=DEFAULT_LOG_CAPACITY, level=INFO, echo=True):
+        """
+        level: lowest level kept ("debug", "info", ... or a number); None disables the log.
+        echo: also print each kept event to stdout.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        self.echo = echo
+        self._lock = threading.Lock()
+        self._events = [None] * capacity
+        self._next = 0
+
+    def enabled_for(self, level) -> bool:
+        return self.level is not None and level >= self.level
+
+    def emit(self, level, message, **fields):
+        if self.level is None or level < self.level:
+            return
+        with self._lock:
+            event = Event(self._next, time.time(), level, message, fields)
+            self._events[self._next % self.capacity] = event
+            self._next += 1
+        if self.echo:
+            print(format_event(event))
+
+    def debug(self, message, **fields):
+        self.emit(DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.emit(INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.emit(WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.emit(ERROR, message, **fields)
+
+    def since(self, cursor=0, limit=None):
+        """
+        Events with seq >= cursor that are still in the buffer, oldest first,
+        and the cursor for the next call. If the buffer wrapped past cursor,
+        the first event's seq is larger than cursor (the gap was overwritten).
+        limit keeps only the newest `limit` of them.
+        """
+        with self._lock:
+            end = self._next
+            start = max(cursor, end - self.capacity, 0)
+            if limit is not None:
+                start = max(start, end - limit)
+            events = [self._events[seq % self.capacity] for seq in range(start, end)]
+        return events, end
+
+    def tail(self, n):
+        """
+        The newest n events, oldest first.
+        """
+        return self.since(0, limit=n)[0]
+
+    def lines(self, cursor=0, limit=None) -> list:
+        """
+        Formatted lines of since(cursor, limit).
+        """
+        return [format_event(event) for event in self.since(cursor, limit)[0]]
+
+    @property
+    def cursor(self) -> int:
+        """
+        Cursor just past the newest event.
+        """
+        with self._lock:
+            return self._next
+
+    def __len__(self):
+        with self._lock:
+            return min(self._next, self.capacity)
@@ -0,0 +1,174 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+SIZE_BUCKETS = (256, 4096, 65536, 1 << 20, 16 << 20, 64 << 20, 256 << 20, math.inf)
+
+# HELP text for the metrics recorded by AliceClient / BobServer / PSIProtocol
+HELP = {
+    "items_blinded_total": "Items run through a blinding operation (blind, reblind, unblind).",
+    "blind_seconds": "Duration of one batch blinding call.",
+    "blind_rate_items_per_second": "Throughput of the most recent batch blinding call.",
+    "message_bytes": "Size of framed protocol messages, by direction.",
+    "network_bytes_total": "Bytes of framed protocol messages, by direction.",
+    "command_seconds": "Time to process one protocol command (Bob).",
+    "commands_total": "Protocol commands processed, by status (Bob).",
+    "queue_wait_seconds": "Time a request waited for a free worker slot (Bob, async mode).",
+    "requests_in_flight": "Requests currently queued or running (Bob, async mode).",
+    "requests_rejected_total": "Requests rejected because the queue was full or they timed out.",
+    "he_op_seconds": "Duration of homomorphic-encryption operations, by op.",
+    "phase_seconds": "Duration of a client protocol phase (Alice).",
+}
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    # Label values in the text format escape backslash, double quote and newline
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Metrics:
+    """
+    Minimal thread-safe registry of counters, gauges and histograms with
+    Prometheus-style labels. Metric names get `prefix` prepended on export.
+    """
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # (name, labels) -> [per-bucket counts, sum, count]
+        self._histograms = {}
+        self._buckets = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            buckets = self._buckets.setdefault(name, buckets)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the duration of the with-block in histogram `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def rows(self) -> list:
+        """
+        One dict per series (metric, labels, type, value / count / mean),
+        e.g. for a pandas DataFrame in the Streamlit apps.
+        """
+        with self._lock:
+            rows = []
+            for (name, key), value in sorted(self._counters.items()):
+                rows.append({"metric": self.prefix + name, "labels": _format_labels(key), "type": "counter",
+                             "value": value, "count": None, "mean": None})
+            for (name, key), value in sorted(self._gauges.items()):
+                rows.append({"metric": self.prefix + name, "labels": _format_labels(key), "type": "gauge",
+                             "value": value, "count": None, "mean": None})
+            for (name, key), (_, total, count) in sorted(self._histograms.items()):
+                rows.append({"metric": self.prefix + name, "labels": _format_labels(key), "type": "histogram",
+                             "value": total, "count": count, "mean": total / count if count else None})
+            return rows
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        seen = set()
+        with self._lock:
+            def header(name, kind):
+                if name not in seen:
+                    seen.add(name)
+                    if name in HELP:
+                        lines.append(f"# HELP {self.prefix}{name} {HELP[name]}")
+                    lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+            for (name, key), value in sorted(self._counters.items()):
+                header(name, "counter")
+                lines.append(f"{self.prefix}{name}{_format_labels(key)} {value}")
+            for (name, key), value in sorted(self._gauges.items()):
+                header(name, "gauge")
+                lines.append(f"{self.prefix}{name}{_format_labels(key)} {value}")
+            for (name, key), (counts, total, count) in sorted(self._histograms.items()):
+                header(name, "histogram")
+                cumulative = 0
+                for bound, c in zip(self._buckets[name], counts):
+                    cumulative += c
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{self.prefix}{name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.prefix}{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.prefix}{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    """
+    Serves a Metrics registry as plain text on http://host:port/metrics.
+    """
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Keep scrapes out of stdout
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
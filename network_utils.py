@@ -1,40 +1,277 @@
+import asyncio
 import socket
 import struct
 import pickle
+import json
+import numpy as np
+import pandas as pd
+from point_array import PointArray
+from metrics import SIZE_BUCKETS
 
-def send_msg(sock, data):
+# Frame header: 1-byte frame type + 8-byte payload length
+HEADER = struct.Struct('!BQ')
+
+# Frame types
+FRAME_PICKLE = 0  # Fallback: payload is a pickled object
+FRAME_BINARY = 1  # Dict message: JSON metadata followed by raw binary buffers
+
+# Buffer kinds inside a FRAME_BINARY payload
+BUF_RECORDS = "records"    # PointArray / list of equal-length bytes as one contiguous buffer
+BUF_BYTES = "bytes"        # a single raw blob (e.g. a serialized HE context or ciphertext)
+BUF_BYTES_MAP = "bytes_map"  # dict of str -> raw blob
+BUF_ARRAY = "array"        # 1-D numeric NumPy array
+BUF_COLUMNS = "columns"    # DataFrame of numeric / categorical columns, one buffer per column
+
+META_LEN = struct.Struct('!I')
+
+# Default cap on one incoming frame for servers; the length comes from an
+# untrusted header and the whole payload is allocated up front
+MAX_FRAME_BYTES = 1 << 30
+
+class FrameTooLarge(ValueError):
     """
-    Sends data (any picklable object) over the socket.
-    Prefixes with 4-byte length.
+    A frame header announced more than the receiver's max_bytes. The stream
+    can't be resynchronized, so the connection should be closed.
     """
-    serialized = pickle.dumps(data)
-    length = len(serialized)
-    sock.sendall(struct.pack('!I', length))
-    sock.sendall(serialized)
 
-def recv_msg(sock):
+def send_msg(sock, data, metrics=None):
+    """
+    Sends data over the socket.
+    Dict messages whose values are JSON scalars/lists, bytes blobs, lists of
+    fixed-width bytes, dicts of bytes, numeric arrays or DataFrames of
+    numeric/categorical columns go out as a binary frame; bulk values are
+    sent as raw buffers and never pickled; NumPy scalars become JSON numbers.
+    Anything else falls back to pickle, which BobServer does not accept.
+    metrics: optional Metrics registry recording the frame size.
+    """
+    parts = encode_frame(data)
+    for part in parts:
+        sock.sendall(part)
+    _record_size(metrics, "sent", parts)
+
+def recv_msg(sock, metrics=None, max_bytes=None, allow_pickle=True):
     """
     Receives data from the socket.
+    max_bytes: if set, raises FrameTooLarge for frames announcing a larger
+               payload, before anything is allocated for it.
+    allow_pickle: servers set this to False so a peer can't make them unpickle
+                  arbitrary objects; pickle frames then raise ValueError.
     """
-    # Read length
-    raw_len = recvall(sock, 4)
-    if not raw_len:
+    # Read header
+    raw_header = recvall(sock, HEADER.size)
+    if not raw_header:
         return None
-    length = struct.unpack('!I', raw_len)[0]
+    frame_type, length = HEADER.unpack(raw_header)
+    _check_length(length, max_bytes)
     # Read data
     data = recvall(sock, length)
-    if not data:
+    if data is None:
         return None
-    return pickle.loads(data)
+    _record_size(metrics, "recv", [raw_header, data])
+    return decode_frame(frame_type, data, allow_pickle)
+
+async def send_msg_async(writer, data, metrics=None):
+    """
+    asyncio counterpart of send_msg for a StreamWriter.
+    """
+    parts = encode_frame(data)
+    for part in parts:
+        writer.write(part)
+    await writer.drain()
+    _record_size(metrics, "sent", parts)
+
+async def recv_msg_async(reader, metrics=None, max_bytes=None, allow_pickle=True):
+    """
+    asyncio counterpart of recv_msg for a StreamReader.
+    """
+    try:
+        raw_header = await reader.readexactly(HEADER.size)
+        frame_type, length = HEADER.unpack(raw_header)
+        _check_length(length, max_bytes)
+        data = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    _record_size(metrics, "recv", [raw_header, data])
+    return decode_frame(frame_type, data, allow_pickle)
+
+def _check_length(length, max_bytes):
+    if max_bytes is not None and length > max_bytes:
+        raise FrameTooLarge(f"Frame of {length} bytes exceeds the {max_bytes}-byte limit")
+
+def _record_size(metrics, direction, parts):
+    if metrics is None:
+        return
+    size = sum(memoryview(p).nbytes for p in parts)
+    metrics.observe("message_bytes", size, buckets=SIZE_BUCKETS, direction=direction)
+    metrics.inc("network_bytes_total", size, direction=direction)
+
+def encode_frame(data):
+    """
+    Returns the list of buffers making up one frame. The header and metadata
+    are coalesced into the first buffer; bulk buffers follow as-is.
+    """
+    parts = _encode_binary(data)
+    if parts is None:
+        serialized = pickle.dumps(data)
+        return [HEADER.pack(FRAME_PICKLE, len(serialized)) + serialized]
+
+    length = sum(len(p) for p in parts)
+    head = HEADER.pack(FRAME_BINARY, length) + parts[0] + parts[1]
+    return [head] + parts[2:]
+
+def decode_frame(frame_type, data, allow_pickle=True):
+    if frame_type == FRAME_BINARY:
+        return _decode_binary(memoryview(data))
+    if frame_type == FRAME_PICKLE:
+        if not allow_pickle:
+            raise ValueError("Pickle frames are not accepted")
+        return pickle.loads(data)
+    raise ValueError(f"Unknown frame type {frame_type}")
 
 def recvall(sock, n):
     """
-    Helper to receive exactly n bytes.
+    Helper to receive exactly n bytes into a preallocated buffer.
     """
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if not count:
             return None
-        data += packet
-    return data
+        received += count
+    return buf
+
+def _is_records(value):
+    if not isinstance(value, list) or not value:
+        return False
+    first = value[0]
+    if not isinstance(first, (bytes, bytearray)):
+        return False
+    width = len(first)
+    return all(isinstance(v, (bytes, bytearray)) and len(v) == width for v in value)
+
+def _is_numeric(array):
+    return isinstance(array, np.ndarray) and array.ndim == 1 and array.dtype.kind in "biuf"
+
+def _array_buffer(array):
+    return memoryview(np.ascontiguousarray(array)).cast('B')
+
+def _column_specs(frame):
+    """
+    (specs, buffers) for a DataFrame sent column by column, or None if a
+    column is neither numeric nor categorical with string categories.
+    """
+    specs = []
+    buffers = []
+    for name, column in frame.items():
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories = column.cat.categories
+            if not all(isinstance(c, str) for c in categories):
+                return None
+            codes = column.cat.codes.to_numpy()
+            specs.append({"name": name, "dtype": codes.dtype.str, "categories": list(categories)})
+            buffers.append(_array_buffer(codes))
+        else:
+            values = column.to_numpy()
+            if not _is_numeric(values):
+                return None
+            specs.append({"name": name, "dtype": values.dtype.str})
+            buffers.append(_array_buffer(values))
+    return specs, buffers
+
+def _json_scalar(value):
+    # NumPy scalars (e.g. a count taken from an array) travel as plain JSON numbers
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _encode_binary(data):
+    """
+    Returns [meta_len, meta, buffer...] for a binary frame, or None if the
+    message needs the pickle fallback.
+    """
+    if not isinstance(data, dict):
+        return None
+
+    fields = {}
+    specs = []
+    buffers = []
+    for key, value in data.items():
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            specs.append({"key": key, "kind": BUF_BYTES, "size": len(value)})
+            buffers.append(value)
+        elif isinstance(value, PointArray):
+            specs.append({"key": key, "kind": BUF_RECORDS, "width": value.width, "count": len(value)})
+            buffers.append(value.buffer())
+        elif _is_records(value):
+            width = len(value[0])
+            specs.append({"key": key, "kind": BUF_RECORDS, "width": width, "count": len(value)})
+            buffers.append(b"".join(value))
+        elif isinstance(value, dict) and value and all(isinstance(v, (bytes, bytearray)) for v in value.values()):
+            keys = list(value)
+            specs.append({"key": key, "kind": BUF_BYTES_MAP, "keys": keys,
+                          "sizes": [len(value[k]) for k in keys]})
+            buffers.extend(value[k] for k in keys)
+        elif _is_numeric(value):
+            specs.append({"key": key, "kind": BUF_ARRAY, "dtype": value.dtype.str, "count": len(value)})
+            buffers.append(_array_buffer(value))
+        elif isinstance(value, pd.DataFrame):
+            columns = _column_specs(value)
+            if columns is None:
+                return None
+            specs.append({"key": key, "kind": BUF_COLUMNS, "count": len(value), "columns": columns[0]})
+            buffers.extend(columns[1])
+        else:
+            fields[key] = value
+
+    try:
+        meta = json.dumps({"fields": fields, "buffers": specs}, default=_json_scalar).encode('utf-8')
+    except (TypeError, ValueError):
+        return None
+    return [META_LEN.pack(len(meta)), meta] + buffers
+
+def _decode_binary(view):
+    (meta_len,) = META_LEN.unpack_from(view, 0)
+    offset = META_LEN.size
+    meta = json.loads(bytes(view[offset:offset + meta_len]))
+    offset += meta_len
+
+    msg = meta["fields"]
+    for spec in meta["buffers"]:
+        kind = spec["kind"]
+        if kind == BUF_BYTES:
+            size = spec["size"]
+            msg[spec["key"]] = bytes(view[offset:offset + size])
+            offset += size
+        elif kind == BUF_RECORDS:
+            # Zero-copy view over the received buffer
+            width, count = spec["width"], spec["count"]
+            msg[spec["key"]] = PointArray.from_buffer(view[offset:offset + width * count], width)
+            offset += width * count
+        elif kind == BUF_BYTES_MAP:
+            values = {}
+            for k, size in zip(spec["keys"], spec["sizes"]):
+                values[k] = bytes(view[offset:offset + size])
+                offset += size
+            msg[spec["key"]] = values
+        elif kind == BUF_ARRAY:
+            dtype = np.dtype(spec["dtype"])
+            size = dtype.itemsize * spec["count"]
+            msg[spec["key"]] = np.frombuffer(view[offset:offset + size], dtype=dtype)
+            offset += size
+        elif kind == BUF_COLUMNS:
+            # Zero-copy numeric columns; categoricals are rebuilt from their codes
+            columns = {}
+            for column in spec["columns"]:
+                dtype = np.dtype(column["dtype"])
+                size = dtype.itemsize * spec["count"]
+                values = np.frombuffer(view[offset:offset + size], dtype=dtype)
+                offset += size
+                if "categories" in column:
+                    values = pd.Categorical.from_codes(values, column["categories"])
+                columns[column["name"]] = values
+            msg[spec["key"]] = pd.DataFrame(columns, index=pd.RangeIndex(spec["count"]), copy=False)
+        else:
+            raise ValueError(f"Unknown buffer kind {kind}")
+    return msg
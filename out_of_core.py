@@ -0,0 +1,390 @@
+"""
+Building blocks for PSI over data files larger than RAM.
+
+Data files (.csv or .parquet) are read in chunks, blinded values are spilled
+to flat files that are read back memory-mapped, and the intersection is an
+external sort-merge: both sides are partitioned by the top bits of the
+64-bit key prefix into buckets that fit in memory, each bucket pair is
+merged with PointArray.isin, and the matching row numbers are written out
+as an ascending .npy file that later phases read lazily (iter_rows).
+"""
+import os
+import numpy as np
+import pandas as pd
+from point_array import PointArray, POINT_BYTES
+
+# Rows per chunk read from a data file
+DEFAULT_READ_ROWS = 1 << 18
+# Working memory for one external-sort bucket (and its temporaries)
+DEFAULT_MEMORY_BYTES = 256 << 20
+
+def iter_file_chunks(path, columns=None, chunk_size=DEFAULT_READ_ROWS, dtype=None):
+    """
+    Yields a .csv or .parquet file as DataFrames of at most chunk_size rows,
+    in file order. dtype is passed to pandas for CSV (Parquet is typed).
+    Parquet needs pyarrow.
+    """
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet requires pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif path.endswith(".csv"):
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size, dtype=dtype)
+    else:
+        raise ValueError("Data file must end in .csv or .parquet")
+
+def iter_id_chunks(path, id_column="ID", chunk_size=DEFAULT_READ_ROWS):
+    """
+    Yields the ID column of a data file as lists of strings, chunk by chunk.
+    """
+    for chunk in iter_file_chunks(path, [id_column], chunk_size, dtype={id_column: str}):
+        yield chunk[id_column].tolist()
+
+def iter_rows(path, indices, columns=None, chunk_size=DEFAULT_READ_ROWS, dtype=None):
+    """
+    Yields the rows of a data file at the given ascending row numbers (e.g.
+    a memory-mapped intersection file) in one sequential pass, as
+    DataFrames indexed by row number.
+    """
+    pos = 0
+    start = 0
+    for chunk in iter_file_chunks(path, columns, chunk_size, dtype):
+        if pos >= len(indices):
+            break
+        stop = start + len(chunk)
+        end = int(np.searchsorted(indices, stop))
+        if end > pos:
+            take = np.asarray(indices[pos:end], dtype=np.int64)
+            rows = chunk.iloc[take - start]
+            rows.index = take
+            yield rows
+        pos = end
+        start = stop
+
+def load_indices(path) -> np.ndarray:
+    """
+    Memory-maps a row-number file written by intersect_files.
+    """
+    return np.load(path, mmap_mode="r")
+
+class SpillFile:
+    """
+    Append-only file of fixed-width records (blinded points), read back as a
+    memory-mapped PointArray.
+    """
+    def __init__(self, path, width=POINT_BYTES):
+        self.path = path
+        self.width = width
+        self.count = 0
+        self._file = open(path, "wb")
+
+    def append(self, points):
+        points = PointArray.from_list(points, self.width)
+        if points.width != self.width:
+            raise ValueError(f"Expected {self.width}-byte records, got {points.width}")
+        self._file.write(points.buffer())
+        self.count += len(points)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def points(self) -> PointArray:
+        self.close()
+        return PointArray.from_file(self.path, self.width)
+
+def _read_records(path, dtype):
+    if not os.path.getsize(path):
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+def _num_buckets(total_bytes, memory_bytes):
+    # Power of two, so each bucket is a range of the top key bits
+    buckets = 1
+    while total_bytes > buckets * memory_bytes:
+        buckets *= 2
+    return buckets
+
+def _partition(chunks, key_of, num_buckets, prefix, work_dir):
+    """
+    Splits record chunks (structured arrays) into num_buckets files by the
+    top bits of key_of(chunk), a uint64 array. Returns the file paths.
+    """
+    shift = np.uint64(64 - (num_buckets.bit_length() - 1))
+    paths = [os.path.join(work_dir, f"{prefix}_{b}.bin") for b in range(num_buckets)]
+    files = [open(p, "wb") for p in paths]
+    try:
+        for chunk in chunks:
+            if num_buckets == 1:
+                files[0].write(chunk.tobytes())
+                continue
+            buckets = (key_of(chunk) >> shift).astype(np.int64)
+            order = np.argsort(buckets, kind="stable")
+            bounds = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+            chunk = chunk[order]
+            for b in range(num_buckets):
+                if bounds[b] < bounds[b + 1]:
+                    files[b].write(chunk[bounds[b]:bounds[b + 1]].tobytes())
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+def _point_key(records):
+    return PointArray(records["point"])._keys()
+
+def intersect_files(alice_points, bob_points, out_path, work_dir, memory_bytes=DEFAULT_MEMORY_BYTES) -> int:
+    """
+    External sort-merge intersection of two (memory-mapped) PointArrays.
+    Writes the row numbers of alice_points that occur in bob_points to
+    out_path (.npy, ascending int64) and returns how many there are.
+    Temporary bucket files go to work_dir and are removed afterwards.
+    """
+    width = alice_points.width
+    alice_dtype = np.dtype([("row", "<u8"), ("point", "u1", (width,))])
+    bob_dtype = np.dtype([("point", "u1", (width,))])
+    num_alice = len(alice_points)
+    # isin needs a few times the bucket size for keys, sort order and masks
+    total = num_alice * alice_dtype.itemsize + len(bob_points) * bob_dtype.itemsize
+    num_buckets = _num_buckets(4 * total, memory_bytes)
+    chunk_rows = max(1, memory_bytes // (4 * alice_dtype.itemsize))
+
+    def alice_chunks():
+        for start in range(0, num_alice, chunk_rows):
+            part = alice_points.data[start:start + chunk_rows]
+            records = np.empty(len(part), dtype=alice_dtype)
+            records["row"] = np.arange(start, start + len(part), dtype=np.uint64)
+            records["point"] = part
+            yield records
+
+    def bob_chunks():
+        for start in range(0, len(bob_points), chunk_rows):
+            yield np.ascontiguousarray(bob_points.data[start:start + chunk_rows]).view(bob_dtype).ravel()
+
+    temp_paths = []
+    try:
+        alice_paths = _partition(alice_chunks(), _point_key, num_buckets, "alice", work_dir)
+        temp_paths += alice_paths
+        bob_paths = _partition(bob_chunks(), _point_key, num_buckets, "bob", work_dir)
+        temp_paths += bob_paths
+
+        # Merge bucket pairs; matches are spread by row range so they can be sorted bucket by bucket
+        rows_per_bucket = max(1, -(-num_alice // num_buckets))
+        match_paths = [os.path.join(work_dir, f"match_{b}.bin") for b in range(num_buckets)]
+        temp_paths += match_paths
+        match_files = [open(p, "wb") for p in match_paths]
+        total_matches = 0
+        try:
+            for alice_path, bob_path in zip(alice_paths, bob_paths):
+                a = np.fromfile(alice_path, dtype=alice_dtype)
+                b = np.fromfile(bob_path, dtype=bob_dtype)
+                rows = a["row"][PointArray(a["point"]).isin(PointArray(b["point"]))]
+                total_matches += len(rows)
+                targets = rows // np.uint64(rows_per_bucket)
+                for t in np.unique(targets):
+                    match_files[int(t)].write(rows[targets == t].tobytes())
+        finally:
+            for f in match_files:
+                f.close()
+
+        if not total_matches:
+            np.save(out_path, np.empty(0, dtype=np.int64))
+            return 0
+        out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.int64, shape=(total_matches,))
+        offset = 0
+        for path in match_paths:
+            rows = np.sort(np.fromfile(path, dtype=np.uint64))
+            out[offset:offset + len(rows)] = rows
+            offset += len(rows)
+        out.flush()
+        del out
+        return total_matches
+    finally:
+        for path in temp_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class FileTable:
+    """
+    Random-access view of a data file for lookups by ID, built in one
+    chunked pass without loading the file: a sorted (64-bit ID hash, row)
+    index, the IDs themselves (to rule out hash collisions) and the
+    requested columns are written to `directory` and memory-mapped. Text
+    columns are dictionary-encoded, so they should have few distinct values
+    (e.g. Department).
+    """
+    def __init__(self, directory, columns, categories, num_rows):
+        self.directory = directory
+        self.columns = columns
+        self.categories = categories
+        self.num_rows = num_rows
+        self._keys = _read_records(os.path.join(directory, "index_keys.bin"), np.uint64)
+        self._rows = _read_records(os.path.join(directory, "index_rows.bin"), np.uint64)
+        # IDs as UTF-8 in row order; id_ends[r] is where row r's ID ends
+        self._id_bytes = _read_records(os.path.join(directory, "ids.bin"), np.uint8)
+        self._id_ends = _read_records(os.path.join(directory, "id_ends.bin"), np.uint64)
+        self._data = {}
+        for name, dtype in columns.items():
+            self._data[name] = _read_records(os.path.join(directory, f"col_{name}.bin"), dtype)
+
+    @staticmethod
+    def _hash(ids):
+        return pd.util.hash_array(np.asarray(ids, dtype=object))
+
+    @classmethod
+    def build(cls, path, directory, columns, id_column="ID", chunk_size=DEFAULT_READ_ROWS,
+              memory_bytes=DEFAULT_MEMORY_BYTES, on_chunk=None):
+        """
+        Reads path chunk by chunk, calling on_chunk(df) for each chunk (e.g.
+        to blind its IDs in the same pass), and writes the table to directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        index_dtype = np.dtype([("key", "<u8"), ("row", "<u8")])
+        unsorted_path = os.path.join(directory, "index_unsorted.bin")
+        col_files = {name: open(os.path.join(directory, f"col_{name}.bin"), "wb") for name in columns}
+        codes = {}
+        dtypes = {}
+        num_rows = 0
+        id_end = 0
+        try:
+            with open(unsorted_path, "wb") as index_file, \
+                 open(os.path.join(directory, "ids.bin"), "wb") as ids_file, \
+                 open(os.path.join(directory, "id_ends.bin"), "wb") as ends_file:
+                for chunk in iter_file_chunks(path, [id_column] + list(columns), chunk_size, dtype={id_column: str}):
+                    if on_chunk is not None:
+                        on_chunk(chunk)
+                    records = np.empty(len(chunk), dtype=index_dtype)
+                    records["key"] = cls._hash(chunk[id_column])
+                    records["row"] = np.arange(num_rows, num_rows + len(chunk), dtype=np.uint64)
+                    index_file.write(records.tobytes())
+                    encoded = [str(i).encode("utf-8") for i in chunk[id_column]]
+                    ends = id_end + np.cumsum([len(e) for e in encoded], dtype=np.uint64)
+                    ids_file.write(b"".join(encoded))
+                    ends_file.write(ends.tobytes())
+                    id_end = int(ends[-1]) if len(ends) else id_end
+                    for name in columns:
+                        values = chunk[name]
+                        if pd.api.types.is_numeric_dtype(values):
+                            array = values.to_numpy()
+                        else:
+                            # Chunk-local codes remapped onto the codes seen so far
+                            seen = codes.setdefault(name, {})
+                            local, uniques = pd.factorize(values)
+                            mapping = np.array([seen.setdefault(u, len(seen)) for u in uniques], dtype=np.int32)
+                            array = mapping[local] if len(mapping) else np.empty(0, dtype=np.int32)
+                        if dtypes.setdefault(name, array.dtype) != array.dtype:
+                            array = array.astype(dtypes[name])
+                        col_files[name].write(np.ascontiguousarray(array).tobytes())
+                    num_rows += len(chunk)
+        finally:
+            for f in col_files.values():
+                f.close()
+
+        # External sort of the index by hash: partition by top bits, sort each bucket
+        try:
+            unsorted = _read_records(unsorted_path, index_dtype)
+            num_buckets = _num_buckets(3 * unsorted.nbytes, memory_bytes)
+            chunk_rows = max(1, memory_bytes // (4 * index_dtype.itemsize))
+            chunks = (np.asarray(unsorted[i:i + chunk_rows]) for i in range(0, len(unsorted), chunk_rows))
+            bucket_paths = _partition(chunks, lambda r: r["key"], num_buckets, "index", directory)
+            del unsorted
+            with open(os.path.join(directory, "index_keys.bin"), "wb") as keys_file, \
+                 open(os.path.join(directory, "index_rows.bin"), "wb") as rows_file:
+                for bucket_path in bucket_paths:
+                    records = np.sort(np.fromfile(bucket_path, dtype=index_dtype), order="key", kind="stable")
+                    keys_file.write(np.ascontiguousarray(records["key"]).tobytes())
+                    rows_file.write(np.ascontiguousarray(records["row"]).tobytes())
+                    os.remove(bucket_path)
+        finally:
+            if os.path.exists(unsorted_path):
+                os.remove(unsorted_path)
+
+        categories = {name: list(seen) for name, seen in codes.items()}
+        column_dtypes = {name: dtypes.get(name, np.int32 if name in codes else np.int64) for name in columns}
+        return cls(directory, column_dtypes, categories, num_rows)
+
+    def __len__(self):
+        return self.num_rows
+
+    def id_hashes(self):
+        """
+        (ID hashes, rows): the index, sorted by hash; rows[i] is the row of the ID with hash hashes[i].
+        """
+        return self._keys, self._rows
+
+    def column(self, name) -> np.ndarray:
+        """
+        Memory-mapped values of a numeric column (codes for text columns).
+        """
+        return self._data[name]
+
+    def _values(self, name, rows):
+        values = np.asarray(self._data[name][rows])
+        if name in self.categories:
+            return pd.Categorical.from_codes(values, self.categories[name])
+        return values
+
+    def locate(self, ids):
+        """
+        Returns (positions, rows): the positions in ids that are present, and
+        the table's columns for them in the same order (same contract as
+        RowIndex.locate).
+        """
+        ids = list(ids)
+        keys = self._hash(ids)
+        found = np.zeros(len(keys), dtype=bool)
+        pos = np.zeros(len(keys), dtype=np.int64)
+        if len(self._keys) and len(keys):
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            found = np.asarray(self._keys[pos]) == keys
+            # Equal hashes don't mean equal IDs: check the ID, and on a mismatch
+            # try the other rows with the same hash (adjacent in the index)
+            candidates = np.nonzero(found)[0]
+            matched = self._ids_match(np.asarray(self._rows[pos[candidates]], dtype=np.int64),
+                                      [ids[i] for i in candidates])
+            for i in candidates[~matched]:
+                p = pos[i]
+                while p < len(self._keys) and self._keys[p] == keys[i] and self._id_at(self._rows[p]) != ids[i]:
+                    p += 1
+                if p < len(self._keys) and self._keys[p] == keys[i]:
+                    pos[i] = p
+                else:
+                    found[i] = False
+        rows = np.asarray(self._rows[pos[found]], dtype=np.int64)
+        return np.nonzero(found)[0], pd.DataFrame({name: self._values(name, rows) for name in self.columns})
+
+    def _ids_match(self, rows, ids) -> np.ndarray:
+        """
+        Whether the ID stored for rows[i] equals ids[i], compared as UTF-8
+        bytes without decoding the stored IDs.
+        """
+        encoded = [str(i).encode("utf-8") for i in ids]
+        ends = np.asarray(self._id_ends[rows], dtype=np.int64)
+        starts = np.where(rows > 0, np.asarray(self._id_ends[np.maximum(rows - 1, 0)], dtype=np.int64), 0)
+        lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+        match = ends - starts == lengths
+        check = np.nonzero(match & (lengths > 0))[0]
+        if len(check):
+            seg_starts = np.concatenate([[0], np.cumsum(lengths[check])[:-1]])
+            offsets = np.repeat(starts[check] - seg_starts, lengths[check]) + np.arange(lengths[check].sum())
+            query = np.frombuffer(b"".join(encoded[i] for i in check), dtype=np.uint8)
+            match[check] = np.logical_and.reduceat(np.asarray(self._id_bytes[offsets]) == query, seg_starts)
+        return match
+
+    def _id_at(self, row):
+        start = int(self._id_ends[row - 1]) if row else 0
+        return bytes(self._id_bytes[start:int(self._id_ends[row])]).decode("utf-8")
+
+    def lookup(self, ids) -> pd.DataFrame:
+        """
+        Rows for the given IDs (those present in the table), in request order.
+        """
+        ids = np.asarray(list(ids), dtype=object)
+        positions, rows = self.locate(ids)
+        return pd.concat([pd.DataFrame({"ID": ids[positions]}), rows], axis=1)
@@ -0,0 +1,199 @@
+import os
+import numpy as np
+
+# Width of a P-256 x-coordinate
+POINT_BYTES = 32
+
+class PointArray:
+    """
+    Fixed-width container for blinded values (x-coordinates or digests),
+    stored as one contiguous n x width uint8 NumPy array instead of a list
+    of individual bytes objects (~32 bytes per point rather than ~100).
+
+    Iterating or indexing with an int yields bytes, so it can be passed
+    wherever a list of points was used before.
+    """
+    def __init__(self, data: np.ndarray):
+        if data.ndim != 2 or data.dtype != np.uint8:
+            raise ValueError("PointArray expects an n x width uint8 array")
+        self.data = data
+
+    @classmethod
+    def empty(cls, width=POINT_BYTES):
+        return cls(np.empty((0, width), dtype=np.uint8))
+
+    @classmethod
+    def from_list(cls, points, width=None):
+        """
+        Builds an array from a list of equal-length bytes.
+        """
+        if isinstance(points, PointArray):
+            return points
+        if not points:
+            return cls.empty(width or POINT_BYTES)
+        width = width or len(points[0])
+        return cls.from_buffer(b"".join(points), width)
+
+    @classmethod
+    def from_buffer(cls, buffer, width=POINT_BYTES):
+        """
+        Wraps a bytes-like buffer of concatenated records without copying.
+        """
+        flat = np.frombuffer(buffer, dtype=np.uint8)
+        if flat.size % width:
+            raise ValueError(f"Buffer size {flat.size} is not a multiple of {width}")
+        return cls(flat.reshape(-1, width))
+
+    @classmethod
+    def from_file(cls, path, width=POINT_BYTES):
+        """
+        Memory-maps a file of concatenated records read-only, so large sets
+        are paged in by the OS instead of living on the heap.
+        """
+        size = os.path.getsize(path)
+        if size % width:
+            raise ValueError(f"File size {size} is not a multiple of {width}")
+        if not size:
+            return cls.empty(width)
+        return cls(np.memmap(path, dtype=np.uint8, mode="r", shape=(size // width, width)))
+
+    @classmethod
+    def concatenate(cls, arrays, width=POINT_BYTES):
+        arrays = [a.data for a in arrays if len(a)]
+        if not arrays:
+            return cls.empty(width)
+        return cls(np.concatenate(arrays))
+
+    @property
+    def width(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.data[index].tobytes()
+        return PointArray(self.data[index])
+
+    def __iter__(self):
+        buf = self.tobytes()
+        width = self.width
+        for i in range(0, len(buf), width):
+            yield buf[i:i + width]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            other = PointArray.from_list(list(other), self.width)
+        if not isinstance(other, PointArray):
+            return NotImplemented
+        return self.data.shape == other.data.shape and bool(np.array_equal(self.data, other.data))
+
+    def __repr__(self):
+        return f"PointArray(n={len(self)}, width={self.width})"
+
+    def tolist(self) -> list:
+        return list(self)
+
+    def tobytes(self) -> bytes:
+        return self.data.tobytes()
+
+    def buffer(self):
+        """
+        Contiguous memoryview over the records (zero-copy when already contiguous).
+        """
+        if not self.data.size:
+            return memoryview(b"") # cast() rejects zero-length shapes
+        return memoryview(np.ascontiguousarray(self.data)).cast('B')
+
+    def truncate(self, num_bytes: int) -> "PointArray":
+        """
+        Keeps the first num_bytes of every record.
+        """
+        return PointArray(np.ascontiguousarray(self.data[:, :num_bytes]))
+
+    def _keys(self) -> np.ndarray:
+        """
+        First 8 bytes of every record as big-endian uint64 (zero padded),
+        used as a sort/merge key.
+        """
+        if self.width >= 8:
+            prefix = np.ascontiguousarray(self.data[:, :8])
+        else:
+            prefix = np.zeros((len(self), 8), dtype=np.uint8)
+            prefix[:, :self.width] = self.data
+        # Native byte order sorts/searches faster than '>u8'
+        return prefix.view('>u8').ravel().astype(np.uint64)
+
+    def _void(self) -> np.ndarray:
+        return np.ascontiguousarray(self.data).view(f'V{self.width}').ravel()
+
+    def isin(self, other: "PointArray") -> np.ndarray:
+        """
+        Boolean mask: which of our records also occur in other.
+        Sorted merge on a 64-bit prefix, then an exact check of the candidates.
+        """
+        if self.width != other.width:
+            raise ValueError("Cannot compare PointArrays of different widths")
+        mask = np.zeros(len(self), dtype=bool)
+        if not len(self) or not len(other):
+            return mask
+
+        keys = self._keys()
+        other_keys = other._keys()
+        order = np.argsort(other_keys, kind='stable')
+        sorted_keys = other_keys[order]
+        pos = np.searchsorted(sorted_keys, keys)
+        pos[pos == len(sorted_keys)] = 0
+        candidates = np.nonzero(sorted_keys[pos] == keys)[0]
+        if self.width <= 8:
+            mask[candidates] = True
+            return mask
+
+        # Full comparison against the first record with the same prefix
+        same = np.all(self.data[candidates] == other.data[order[pos[candidates]]], axis=1)
+        mask[candidates[same]] = True
+        # Prefix collisions (astronomically rare for random points): exact fallback
+        unresolved = candidates[~same]
+        if len(unresolved):
+            mask[unresolved] = np.isin(self[unresolved]._void(), other._void())
+        return mask
+
+    def find(self, other: "PointArray") -> np.ndarray:
+        """
+        Row of other holding each of our records, or -1 where there is none
+        (same sorted merge as isin, keeping the matching position).
+        """
+        if self.width != other.width:
+            raise ValueError("Cannot compare PointArrays of different widths")
+        found = np.full(len(self), -1, dtype=np.int64)
+        if not len(self) or not len(other):
+            return found
+
+        keys = self._keys()
+        other_keys = other._keys()
+        order = np.argsort(other_keys, kind='stable')
+        sorted_keys = other_keys[order]
+        pos = np.searchsorted(sorted_keys, keys)
+        pos[pos == len(sorted_keys)] = 0
+        candidates = np.nonzero(sorted_keys[pos] == keys)[0]
+        rows = order[pos[candidates]]
+        same = np.all(self.data[candidates] == other.data[rows], axis=1)
+        found[candidates[same]] = rows[same]
+        # Prefix collisions: check every record of other with the same prefix
+        for i in candidates[~same]:
+            for row in np.nonzero(other_keys == keys[i])[0]:
+                if np.array_equal(self.data[i], other.data[row]):
+                    found[i] = row
+                    break
+        return found
+
+    def intersect_indices(self, other: "PointArray") -> np.ndarray:
+        """
+        Indices of our records that also occur in other, in ascending order.
+        """
+        return np.nonzero(self.isin(other))[0]
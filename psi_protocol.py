@@ -1,70 +1,371 @@
 import hashlib
+import math
+import os
 import pickle
+import threading
+import time
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+import tempfile
 import tenseal as ts
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
+import tenseal.sealapi as sealapi
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from point_array import PointArray, POINT_BYTES
+from curves import get_curve, N, DEFAULT_CURVE
 
-# SECP256R1 Curve Parameters (for manual point reconstruction)
-P = 0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff
-A = -3
-B = 0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b
+# Smallest/largest truncated digest used for compact transfer of blinded sets
+MIN_DIGEST_BYTES = 4
+MAX_DIGEST_BYTES = 32
+# Default bound on the expected number of false matches in compact mode
+DEFAULT_MAX_FP = 1e-6
+# Largest Alice query an unbalanced-PSI offline set is sized for by default
+DEFAULT_MAX_QUERY_SIZE = 100_000
+
+def digest_length(n_alice: int, n_bob: int, max_fp: float) -> int:
+    """
+    Number of bytes to keep from each blinded value so that the expected number
+    of false matches, n_alice * n_bob / 2^bits, stays below max_fp.
+    """
+    pairs = max(n_alice, 1) * max(n_bob, 1)
+    bits = math.ceil(math.log2(pairs / max_fp))
+    return min(max(math.ceil(bits / 8), MIN_DIGEST_BYTES), MAX_DIGEST_BYTES)
+
+def expected_false_positives(n_alice: int, n_bob: int, num_bytes: int) -> float:
+    return n_alice * n_bob / 2 ** (8 * num_bytes)
+
+def truncate_points(points, num_bytes: int) -> PointArray:
+    """
+    Keeps the first num_bytes of each x-coordinate (x-coordinates of blinded
+    points are uniformly distributed, so a prefix behaves like a hash digest).
+    """
+    return PointArray.from_list(points).truncate(num_bytes)
+
+# PSI with payload: each record is nonce || AES-GCM ciphertext || tag
+PAYLOAD_NONCE_BYTES = 12
+PAYLOAD_TAG_BYTES = 16
+
+def payload_key(point: bytes) -> bytes:
+    """
+    AES-256 key for the payload of the item whose payload-key point is `point`.
+    """
+    return hashlib.sha256(b"psi-payload" + bytes(point)).digest()
+
+def encrypt_payloads(key_points, records: np.ndarray) -> PointArray:
+    """
+    Encrypts row i of records (n x width uint8) under payload_key(key_points[i]).
+    Output records are fixed-width, so ciphertexts don't leak row contents by length.
+    """
+    out = []
+    for point, record in zip(PointArray.from_list(key_points), records):
+        nonce = os.urandom(PAYLOAD_NONCE_BYTES)
+        out.append(nonce + AESGCM(payload_key(point)).encrypt(nonce, record.tobytes(), None))
+    width = records.shape[1] + PAYLOAD_NONCE_BYTES + PAYLOAD_TAG_BYTES
+    return PointArray.from_list(out, width)
+
+def decrypt_payloads(key_points, ciphertexts):
+    """
+    Inverse of encrypt_payloads. Returns (ok, records): ok[i] is False where
+    the key doesn't open ciphertext i (e.g. a false match).
+    """
+    ciphertexts = PointArray.from_list(ciphertexts)
+    width = ciphertexts.width - PAYLOAD_NONCE_BYTES - PAYLOAD_TAG_BYTES
+    records = np.zeros((len(ciphertexts), width), dtype=np.uint8)
+    ok = np.zeros(len(ciphertexts), dtype=bool)
+    for i, (point, data) in enumerate(zip(PointArray.from_list(key_points), ciphertexts)):
+        try:
+            plain = AESGCM(payload_key(point)).decrypt(data[:PAYLOAD_NONCE_BYTES], data[PAYLOAD_NONCE_BYTES:], None)
+        except InvalidTag:
+            continue
+        records[i] = np.frombuffer(plain, dtype=np.uint8)
+        ok[i] = True
+    return ok, records
+
+# Items per task handed to the worker pool (also the progress granularity)
+DEFAULT_CHUNK_SIZE = 1024
+
+# Per-process protocol instance used by pool workers (set by _init_worker)
+_worker_psi = None
+
+def _init_worker(private_value, curve):
+    global _worker_psi
+    _worker_psi = PSIProtocol(private_value=private_value, workers=1, curve=curve)
+
+def _blind_chunk(items):
+    return _worker_psi._blind_chunk(items)
+
+def _reblind_chunk(points):
+    return _worker_psi._reblind_chunk(points)
 
 class PSIProtocol:
-    def __init__(self):
-        self.curve = ec.SECP256R1()
-        self.private_key = ec.generate_private_key(self.curve)
-
-    def hash_to_curve_public_key(self, data: str) -> ec.EllipticCurvePublicKey:
-        """
-        Maps a string to a PublicKey on the curve. This is effectively H(x) * G.
-        """
-        digest = hashes.Hash(hashes.SHA256())
-        digest.update(data.encode('utf-8'))
-        h = digest.finalize()
-        scalar = int.from_bytes(h, 'big') 
-        # Modulo group order isn't strictly necessary for `derive` but good practice
-        # However deriving from a huge scalar is handled by cryptography logic usually.
-        # But to be safe, let's keep it raw (cryptography handles valid range or error).
-        # Actually `derive_private_key` expects integer. 
-        # For P-256 scalar must be < Order.
-        # Let's simple mod P (approximation of order for now, or just use large enough?)
-        # Order N is close to P.
-        N = 0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551
-        scalar = scalar % N
-        return ec.derive_private_key(scalar, self.curve, default_backend()).public_key()
-    
+    def __init__(self, private_value=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, metrics=None,
+                 curve=DEFAULT_CURVE):
+        """
+        private_value: optional secret scalar (a fresh key is generated if None).
+        workers: size of the process pool used by blind_many/reblind_many.
+                 None means os.cpu_count(), 1 disables the pool.
+        metrics: optional Metrics registry for blinding counts, durations and rates.
+        curve: group backend from curves.py ("p256" or "x25519"); both parties must use the same one.
+        """
+        self.curve = get_curve(curve)
+        if private_value is None:
+            private_value = self.curve.generate_scalar()
+        elif not self.curve.is_valid_scalar(private_value):
+            raise ValueError(f"Private value is not a usable {self.curve.name} key")
+        self.private_key = self.curve.private_key(private_value)
+        # Cached scalar for the fixed-base fast path in blind()
+        self._private_value = private_value
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._inverse = None
+        self.metrics = metrics
+
+    @classmethod
+    def from_key_file(cls, path, **kwargs):
+        """
+        Loads the private key from a PEM file, generating and saving a new one
+        if the file does not exist yet. Lets a party keep its key across restarts.
+        """
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                key = serialization.load_pem_private_key(f.read(), password=None)
+            return cls(private_value=get_curve(kwargs.get("curve")).scalar_from_key(key), **kwargs)
+
+        psi = cls(**kwargs)
+        psi.save_private_key(path)
+        return psi
+
+    def save_private_key(self, path):
+        pem = self.private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        )
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+
+    def derive(self, label: str) -> "PSIProtocol":
+        """
+        Independent key derived from this one (e.g. Bob's payload-key blinding),
+        so it is as persistent as this key without a file of its own.
+        """
+        order = self.curve.order
+        counter = 0
+        while True:
+            # Retry with a counter until the curve accepts the scalar (always on the first try for P-256)
+            seed = label.encode() + (counter.to_bytes(4, "big") if counter else b"") + self._private_value.to_bytes(32, "big")
+            private_value = int.from_bytes(hashlib.sha256(seed).digest(), "big") % (order - 1) + 1
+            if self.curve.is_valid_scalar(private_value):
+                break
+            counter += 1
+        return PSIProtocol(private_value=private_value, workers=self.workers, chunk_size=self.chunk_size,
+                           metrics=self.metrics, curve=self.curve)
+
+    def key_fingerprint(self) -> str:
+        """
+        Short identifier of the key, derived from the public key only.
+        """
+        return hashlib.sha256(self.curve.public_bytes(self.private_key)).hexdigest()[:16]
+
+    @staticmethod
+    def hash_to_scalar(data: str, order: int = N) -> int:
+        """
+        Hashes a string to a scalar h with H(x) = h * G.
+        """
+        h = hashlib.sha256(data.encode('utf-8')).digest()
+        # The scalar must be < Order.
+        return int.from_bytes(h, 'big') % order
+
+    def hash_to_curve_public_key(self, data: str) -> bytes:
+        """
+        Maps a string to a point on the curve. This is effectively H(x) * G.
+        Returns the point's coordinate bytes.
+        """
+        return self.curve.base_mult(self.hash_to_scalar(data, self.curve.order))
+
+    def blind(self, data: str) -> bytes:
+        """
+        Fast path for apply_private_key(hash_to_curve_public_key(data)).
+        Since H(x) = h * G, we have priv * H(x) = (priv * h mod order) * G, so the
+        blinded point costs one fixed-base multiplication (OpenSSL keeps a
+        precomputed table for G) instead of two key constructions and two
+        scalar multiplications. Returns the x-coordinate bytes.
+        """
+        order = self.curve.order
+        return self.curve.base_mult((self._private_value * self.hash_to_scalar(data, order)) % order)
+
     def apply_private_key(self, public_key_or_point_bytes) -> bytes:
         """
         Performs ECDH: Returns x-coordinate of (MyPriv * InputPub).
         Result is bytes.
         """
-        if isinstance(public_key_or_point_bytes, bytes):
-            public_key = self._bytes_to_public_key(public_key_or_point_bytes)
+        return self.curve.exchange(self.private_key, public_key_or_point_bytes)
+
+    # Chunk results are returned as one concatenated bytes object, which is
+    # cheap to ship back from pool workers and wraps directly into a PointArray.
+    def _blind_chunk(self, items) -> bytes:
+        return b"".join([self.blind(x) for x in items])
+
+    def _reblind_chunk(self, points) -> bytes:
+        return b"".join([self.apply_private_key(p) for p in points])
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Workers rebuild the key from the raw scalar (key objects don't pickle)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self._private_value, self.curve.name)
+                )
+            return self._pool
+
+    def _iter_chunks(self, local_fn, pool_fn, items, chunk_size=None, window=None):
+        """
+        Yields a PointArray with the result of each chunk of items, in input order.
+        With a worker pool at most `window` chunks are in flight, so results
+        can be consumed (e.g. sent over the network) while later chunks are
+        still being computed. items may be any iterable and is read lazily,
+        one chunk at a time, so the inputs and results held here stay bounded
+        by the window.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        if isinstance(items, PointArray):
+            chunks = (items[i:i + chunk_size] for i in range(0, len(items), chunk_size))
         else:
-            public_key = public_key_or_point_bytes
-            
-        shared_key = self.private_key.exchange(ec.ECDH(), public_key)
-        return shared_key
+            it = iter(items)
+            chunks = iter(lambda: list(islice(it, chunk_size)), [])
+        small = hasattr(items, "__len__") and len(items) <= chunk_size
+
+        if self.workers <= 1 or small:
+            for chunk in chunks:
+                yield PointArray.from_buffer(local_fn(chunk))
+            return
 
-    def _bytes_to_public_key(self, x_bytes: bytes) -> ec.EllipticCurvePublicKey:
+        pool = self._get_pool()
+        window = window or 2 * self.workers
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(pool_fn, chunk))
+            if len(pending) >= window:
+                yield PointArray.from_buffer(pending.popleft().result())
+        while pending:
+            yield PointArray.from_buffer(pending.popleft().result())
+
+    def _map_chunks(self, local_fn, pool_fn, items, progress_callback=None) -> PointArray:
         """
-        Reconstructs a PublicKey from just the X-coordinate bytes.
-        Solves y^2 = x^3 + ax + b for y.
+        Runs items through _iter_chunks and writes the results, in input order,
+        into one preallocated PointArray.
         """
-        x = int.from_bytes(x_bytes, 'big')
-        rhs = (pow(x, 3, P) + A*x + B) % P
-        # Compute square root using Tonelli-Shanks or simple exponentiation if p = 3 mod 4
-        # P = 3 mod 4 for P-256.
-        y = pow(rhs, (P + 1) // 4, P)
-        
-        # Verify
-        if (y*y) % P != rhs:
-            raise ValueError("Point not on curve")
-            
-        public_numbers = ec.EllipticCurvePublicNumbers(x, y, self.curve)
-        return public_numbers.public_key(default_backend())
+        if not hasattr(items, "__len__"):
+            items = list(items)
+        total = len(items)
+
+        out = np.empty((total, POINT_BYTES), dtype=np.uint8)
+        done = 0
+        for chunk_result in self._iter_chunks(local_fn, pool_fn, items):
+            out[done:done + len(chunk_result)] = chunk_result.data
+            done += len(chunk_result)
+            if progress_callback and total:
+                progress_callback(done / total)
+
+        if progress_callback: progress_callback(1.0)
+        return PointArray(out)
+
+    def _record(self, op, count, seconds):
+        if self.metrics is None:
+            return
+        self.metrics.inc("items_blinded_total", count, op=op)
+        self.metrics.observe("blind_seconds", seconds, op=op)
+        if seconds > 0:
+            self.metrics.set("blind_rate_items_per_second", count / seconds, op=op)
+
+    def blind_many(self, items, progress_callback=None) -> PointArray:
+        """
+        Computes priv * H(x) for every item. Returns x-coordinates in input order.
+        """
+        start = time.perf_counter()
+        out = self._map_chunks(self._blind_chunk, _blind_chunk, items, progress_callback)
+        self._record("blind", len(out), time.perf_counter() - start)
+        return out
+
+    def reblind_many(self, points, progress_callback=None) -> PointArray:
+        """
+        Applies the private key to already-blinded x-coordinates, in input order.
+        """
+        start = time.perf_counter()
+        out = self._map_chunks(self._reblind_chunk, _reblind_chunk, points, progress_callback)
+        self._record("reblind", len(out), time.perf_counter() - start)
+        return out
+
+    def blind_chunks(self, items, chunk_size=None):
+        """
+        Streaming variant of blind_many: yields one PointArray per chunk.
+        """
+        for chunk in self._iter_chunks(self._blind_chunk, _blind_chunk, items, chunk_size):
+            if self.metrics is not None:
+                self.metrics.inc("items_blinded_total", len(chunk), op="blind")
+            yield chunk
+
+    def submit_reblind(self, points, executor=None) -> Future:
+        """
+        Starts re-blinding one chunk (e.g. a streamed message) and returns a
+        Future for the PointArray, so consecutive chunks run in parallel on
+        the worker pool however small each one is. Without a pool the work
+        runs on `executor` if given (to keep an event loop free), else right away.
+        """
+        points = PointArray.from_list(points)
+        def wrap(buffer):
+            if self.metrics is not None:
+                self.metrics.inc("items_blinded_total", len(points), op="reblind")
+            return PointArray.from_buffer(buffer)
+
+        if self.workers <= 1 or not len(points):
+            if executor is not None:
+                return executor.submit(lambda: wrap(self._reblind_chunk(points)))
+            future = Future()
+            future.set_result(wrap(self._reblind_chunk(points)))
+            return future
+
+        out = Future()
+        def done(pool_future):
+            try:
+                out.set_result(wrap(pool_future.result()))
+            except Exception as e:
+                out.set_exception(e)
+        self._get_pool().submit(_reblind_chunk, points).add_done_callback(done)
+        return out
+
+    def unblind_many(self, points, progress_callback=None) -> PointArray:
+        """
+        Removes this party's blinding: applies priv^-1 mod the group order, so
+        x(priv * P) becomes x(P). Used by Alice to turn H(x)^ab back into H(x)^b.
+        """
+        if self._inverse is None:
+            self._inverse = PSIProtocol(
+                private_value=pow(self._private_value, -1, self.curve.order),
+                workers=self.workers,
+                chunk_size=self.chunk_size,
+                curve=self.curve
+            )
+        start = time.perf_counter()
+        out = self._inverse.reblind_many(points, progress_callback)
+        self._record("unblind", len(out), time.perf_counter() - start)
+        return out
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        if self._inverse is not None:
+            self._inverse.close()
 
     def serialize(self, val) -> bytes:
         if isinstance(val, bytes):
@@ -75,30 +376,398 @@ class PSIProtocol:
     def deserialize(self, data: bytes):
         return pickle.loads(data)
 
+# CKKS ring dimension; a ciphertext packs POLY_MODULUS_DEGREE / 2 values
+POLY_MODULUS_DEGREE = 8192
+
+# Largest total coefficient modulus (bits) per ring dimension for 128-bit
+# security (HomomorphicEncryption.org standard, as enforced by SEAL)
+MAX_COEFF_MODULUS_BITS = {1024: 27, 2048: 54, 4096: 109, 8192: 218, 16384: 438, 32768: 881}
+# SEAL primes are at most 60 bits
+MAX_PRIME_BITS = 60
+# Largest ring the planner grows into just to fit a whole vector in one ciphertext
+# (bigger rings mean fewer ciphertexts but a much larger context to upload)
+MAX_PLANNED_DEGREE = 8192
+# Default absolute error tolerated on decrypted sums (CKKS)
+DEFAULT_HE_PRECISION = 0.01
+
+# Aggregation schemes: CKKS (approximate reals) or BFV (exact integers mod t)
+SCHEME_CKKS = "ckks"
+SCHEME_BFV = "bfv"
+
+class HEParams:
+    """
+    One HE parameter set: scheme, ring dimension and coefficient modulus chain
+    (data primes followed by the special key-switching prime), plus the scale
+    for CKKS or the bit size of the batching plain modulus for BFV. depth is
+    the number of multiplications the chain was planned for.
+    """
+    def __init__(self, poly_modulus_degree, coeff_mod_bit_sizes, scale_bits=None,
+                 scheme=SCHEME_CKKS, plain_modulus_bits=None, depth=1):
+        self.scheme = scheme
+        self.depth = depth
+        self.poly_modulus_degree = poly_modulus_degree
+        self.coeff_mod_bit_sizes = list(coeff_mod_bit_sizes)
+        self.scale_bits = scale_bits
+        self.plain_modulus_bits = plain_modulus_bits
+
+    @property
+    def slot_count(self) -> int:
+        # BFV batching packs one integer per coefficient, CKKS one complex per two
+        if self.scheme == SCHEME_BFV:
+            return self.poly_modulus_degree
+        return self.poly_modulus_degree // 2
+
+    @property
+    def plain_modulus(self) -> int:
+        """
+        BFV plain modulus: a prime = 1 mod 2N of plain_modulus_bits bits, so
+        integers are batched one per slot. Sums are exact as long as they stay below it.
+        """
+        return sealapi.PlainModulus.Batching(self.poly_modulus_degree, self.plain_modulus_bits).value()
+
+    @property
+    def ciphertext_bytes(self) -> int:
+        """
+        Estimated size of a fresh ciphertext: two polynomials with one 64-bit
+        word per coefficient per data prime (serialization compresses a bit).
+        """
+        return 2 * self.poly_modulus_degree * (len(self.coeff_mod_bit_sizes) - 1) * 8
+
+    def num_ciphertexts(self, num_values: int) -> int:
+        return max(1, -(-num_values // self.slot_count))
+
+    def _key(self):
+        return (self.scheme, self.poly_modulus_degree, self.coeff_mod_bit_sizes,
+                self.scale_bits, self.plain_modulus_bits)
+
+    def __eq__(self, other):
+        if not isinstance(other, HEParams):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __repr__(self):
+        if self.scheme == SCHEME_BFV:
+            return (f"HEParams(scheme=bfv, poly_modulus_degree={self.poly_modulus_degree}, "
+                    f"coeff_mod_bit_sizes={self.coeff_mod_bit_sizes}, plain_modulus=2^{self.plain_modulus_bits})")
+        return (f"HEParams(poly_modulus_degree={self.poly_modulus_degree}, "
+                f"coeff_mod_bit_sizes={self.coeff_mod_bit_sizes}, scale=2^{self.scale_bits})")
+
+# Parameters used before the planner existed (and still the create_context default)
+DEFAULT_HE_PARAMS = HEParams(POLY_MODULUS_DEGREE, [60, 40, 40, 60], 40)
+
+def plan_he_params(num_values: int, num_groups: int = 1, max_value: float = 1.0, depth: int = 1,
+                   precision: float = DEFAULT_HE_PRECISION,
+                   max_poly_modulus_degree: int = MAX_PLANNED_DEGREE,
+                   scheme: str = SCHEME_CKKS) -> HEParams:
+    """
+    Picks the smallest 128-bit secure parameters for summing num_values
+    values of magnitude <= max_value into num_groups packed group sums with
+    `depth` multiplications, to within `precision` (absolute, CKKS only).
+
+    - The result can be as large as num_values * max_value; after `depth`
+      rescales the remaining modulus must hold it at the scale, so the base
+      primes get scale + log2(max sum) bits (split into <= 60-bit primes).
+    - CKKS error grows with the magnitude of the values and, more slowly, with
+      the ring dimension; the scale is chosen so that it stays below precision.
+    - BFV sums are exact modulo the plain modulus t, which must exceed twice
+      the max sum (signed decoding). Every plaintext multiplication costs about
+      log2(t) + log2(N) bits of noise budget, which sizes the modulus chain.
+    - group_sum needs the next power of two >= num_groups slots (per row for BFV).
+    The ring is then grown (up to max_poly_modulus_degree) while the vector
+    does not fit in one ciphertext; longer vectors are chunked.
+    Raises ValueError if no parameter set fits.
+    """
+    max_sum = max(num_values, 1) * max(abs(max_value), 1.0)
+    sum_bits = math.ceil(math.log2(max_sum)) + 1
+    group_slots = 1 << max(0, (num_groups - 1).bit_length())
+
+    def split(bits, min_prime_bits):
+        count = -(-bits // MAX_PRIME_BITS)
+        return [max(-(-bits // count), min_prime_bits)] * count
+
+    def ckks_chain(degree):
+        # Primes much smaller than this run out of candidates = 1 mod 2*degree
+        min_prime_bits = degree.bit_length() + 12
+        # Empirical: error ~ 2^(noise_bits - scale_bits), 1-2 bits of margin included
+        noise_bits = max(math.log2(degree) / 2 + 16, sum_bits + 1)
+        scale_bits = max(math.ceil(noise_bits - math.log2(precision)), min_prime_bits)
+        if scale_bits > MAX_PRIME_BITS:
+            return None
+        base = split(scale_bits + sum_bits, min_prime_bits)
+        # The special prime must be at least as large as any data prime
+        chain = base + [scale_bits] * depth + [max(base + [scale_bits])]
+        return HEParams(degree, chain, scale_bits, depth=depth)
+
+    def bfv_chain(degree):
+        plain_bits = max(sum_bits + 1, degree.bit_length() + 5)
+        if plain_bits > MAX_PRIME_BITS:
+            return None
+        # Empirical: encryption leaves ~log2(q) - log2(t) - log2(N) + 5 bits of
+        # budget, each plaintext multiplication (plus the rotations) takes
+        # log2(t) + log2(N) + 5; keep a few bits to spare
+        log_n = math.log2(degree)
+        data = split(math.ceil((depth + 1) * (plain_bits + log_n) + 6), degree.bit_length() + 12)
+        return HEParams(degree, data + [max(data)], scheme=SCHEME_BFV, plain_modulus_bits=plain_bits, depth=depth)
+
+    chain_for = bfv_chain if scheme == SCHEME_BFV else ckks_chain
+    feasible = []
+    for degree, max_bits in sorted(MAX_COEFF_MODULUS_BITS.items()):
+        params = chain_for(degree)
+        if params is None or sum(params.coeff_mod_bit_sizes) > max_bits or degree // 2 < group_slots:
+            continue
+        feasible.append(params)
+    if not feasible:
+        raise ValueError(f"No secure {scheme.upper()} parameters for {num_values} values up to {max_value} "
+                         f"in {num_groups} groups at depth {depth} and precision {precision}")
+
+    chosen = feasible[0]
+    for params in feasible[1:]:
+        if chosen.slot_count >= num_values or params.poly_modulus_degree > max_poly_modulus_degree:
+            break
+        chosen = params
+    return chosen
+
 class SecureAggregator:
     def __init__(self):
         pass
+
+    @staticmethod
+    def slot_count(poly_modulus_degree=POLY_MODULUS_DEGREE) -> int:
+        """
+        Number of values one CKKS ciphertext can hold. Longer vectors are
+        split into chunks of this size, one ciphertext each.
+        """
+        return poly_modulus_degree // 2
         
     @staticmethod
-    def create_context():
-        # CKKS for vector float operations
-        context = ts.context(
-            ts.SCHEME_TYPE.CKKS,
-            poly_modulus_degree=8192,
-            coeff_mod_bit_sizes=[60, 40, 40, 60]
-        )
-        context.global_scale = 2**40
+    def create_context(params: HEParams = None):
+        """
+        CKKS (vector float operations) or BFV (exact integer batching) context,
+        with Galois keys for rotations.
+        params defaults to DEFAULT_HE_PARAMS; see plan_he_params to size it to a job.
+        """
+        params = params or DEFAULT_HE_PARAMS
+        if params.scheme == SCHEME_BFV:
+            context = ts.context(
+                ts.SCHEME_TYPE.BFV,
+                poly_modulus_degree=params.poly_modulus_degree,
+                plain_modulus=params.plain_modulus,
+                coeff_mod_bit_sizes=params.coeff_mod_bit_sizes
+            )
+        else:
+            context = ts.context(
+                ts.SCHEME_TYPE.CKKS,
+                poly_modulus_degree=params.poly_modulus_degree,
+                coeff_mod_bit_sizes=params.coeff_mod_bit_sizes
+            )
+            context.global_scale = 2**params.scale_bits
         context.generate_galois_keys()
         return context
         
     @staticmethod
     def encrypt_vector(context, vector: list):
+        if SecureAggregator.is_bfv(context):
+            return ts.bfv_vector(context, [int(v) for v in vector])
         return ts.ckks_vector(context, vector)
         
+    @staticmethod
+    def context_id(data: bytes) -> str:
+        """
+        Content hash identifying a serialized public context.
+        """
+        return hashlib.sha256(data).hexdigest()
+
     @staticmethod
     def deserialize_context(data: bytes):
         return ts.context_from(data)
         
     @staticmethod
     def deserialize_vector(context, data: bytes):
+        if SecureAggregator.is_bfv(context):
+            return ts.bfv_vector_from(context, data)
         return ts.ckks_vector_from(context, data)
+
+    @staticmethod
+    def group_sum(context, enc_vector, group_index, num_groups: int, weights=None, span=None):
+        """
+        Packed group-by: returns a single SEAL ciphertext whose slot g holds
+        the sum of the entries of enc_vector with group_index == g.
+        weights: optional plaintext factor per entry (sum of weight * entry).
+        They replace the 0/1 masks, so they cost no extra multiplication.
+        span: sum blocks of `span` slots (a power of two dividing the SIMD row)
+        separately instead, into slot block * span + g. The last P - 1 slots
+        of every block must be zero, since rotations move entries up to that far.
+
+        Each row i must end up in a slot congruent to its group g modulo
+        P (the next power of two >= num_groups), i.e. be rotated right by
+        d = (g - i) mod P. Rows are bucketed by d with plaintext masks; the
+        rotations are split baby-step/giant-step (d = k + b) so only about
+        2*sqrt(P) ciphertext rotations are needed, and a final rotate-and-add
+        fold over strides P, 2P, ... sums each residue class into slot g.
+        One plaintext multiplication in total, so the depth is the same as
+        the old one-mask-per-group approach, which needed a rotation-heavy
+        sum() and a separate ciphertext for every group.
+
+        For BFV the N slots form a 2 x N/2 matrix whose rows rotate
+        independently, so the same steps run on both rows with rotate_rows and
+        a final column rotation adds the rows together. The masks are plain
+        0/1 integers and there is nothing to rescale.
+
+        TenSEAL does not expose rotations, so this works on the underlying
+        SEAL ciphertext through tenseal.sealapi.
+        """
+        seal_context = context.seal_context().data
+        evaluator = sealapi.Evaluator(seal_context)
+        galois_keys = context.galois_keys().data
+        ct = enc_vector.ciphertext()[0]
+
+        bfv = SecureAggregator.is_bfv(context)
+        if bfv:
+            encoder = sealapi.BatchEncoder(seal_context)
+            rows, row_size = 2, encoder.slot_count() // 2
+            rotate, rotate_inplace = evaluator.rotate_rows, evaluator.rotate_rows_inplace
+            def encode(mask, plain):
+                encoder.encode(mask.astype(np.int64).tolist(), plain)
+        else:
+            encoder = sealapi.CKKSEncoder(seal_context)
+            rows, row_size = 1, ct.poly_modulus_degree() // 2
+            rotate, rotate_inplace = evaluator.rotate_vector, evaluator.rotate_vector_inplace
+            def encode(mask, plain):
+                encoder.encode(mask.tolist(), ct.parms_id(), context.global_scale, plain)
+
+        group_index = np.asarray(group_index)
+        n = len(group_index)
+        weights = np.ones(n) if weights is None else np.asarray(weights)
+        P = 1 << max(0, (num_groups - 1).bit_length())
+        B = 1 << ((P.bit_length()) // 2)  # baby-step size, ~sqrt(P)
+        shift = (group_index - np.arange(n) % row_size) % P
+        present = set(np.unique(shift).tolist())
+
+        baby_steps = {0: ct}
+        def rotated(b):
+            if b not in baby_steps:
+                out = sealapi.Ciphertext()
+                rotate(ct, -b, galois_keys, out)
+                baby_steps[b] = out
+            return baby_steps[b]
+
+        result = None
+        for k in range(0, P, B):
+            inner = None
+            for b in range(B):
+                if k + b not in present:
+                    continue
+                # rot(ct * mask, -(k+b)) == rot(rot(ct, -b) * roll(mask, b), -k)
+                mask = np.zeros(rows * row_size, dtype=weights.dtype)
+                selected = shift == k + b
+                mask[:n][selected] = weights[selected]
+                plain = sealapi.Plaintext()
+                encode(np.roll(mask.reshape(rows, row_size), b, axis=1).ravel(), plain)
+                term = sealapi.Ciphertext()
+                evaluator.multiply_plain(rotated(b), plain, term)
+                if inner is None:
+                    inner = term
+                else:
+                    evaluator.add_inplace(inner, term)
+            if inner is None:
+                continue
+            if not bfv:
+                evaluator.rescale_to_next_inplace(inner)
+            if k:
+                rotate_inplace(inner, -k, galois_keys)
+            if result is None:
+                result = inner
+            else:
+                evaluator.add_inplace(result, inner)
+
+        stride = P
+        while stride < (span or row_size):
+            folded = sealapi.Ciphertext()
+            rotate(result, stride, galois_keys, folded)
+            evaluator.add_inplace(result, folded)
+            stride *= 2
+        if bfv and not span:
+            swapped = sealapi.Ciphertext()
+            evaluator.rotate_columns(result, galois_keys, swapped)
+            evaluator.add_inplace(result, swapped)
+        return result
+
+    @staticmethod
+    def is_bfv(context) -> bool:
+        return context.seal_context().data.key_context_data().parms().scheme().name == "BFV"
+
+    @staticmethod
+    def add_packed(context, a, b):
+        """
+        Adds two packed group_sum results (e.g. from different chunks) into a.
+        """
+        sealapi.Evaluator(context.seal_context().data).add_inplace(a, b)
+        return a
+
+    @staticmethod
+    def serialize_ciphertext(ct) -> bytes:
+        # sealapi only offers file-based save/load
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ct")
+            ct.save(path)
+            with open(path, 'rb') as f:
+                return f.read()
+
+    @staticmethod
+    def decrypt_packed(context, data: bytes) -> list:
+        """
+        Decrypts a serialized group_sum result; slot g is the sum for group g
+        (exact Python ints for BFV, floats for CKKS).
+        """
+        seal_context = context.seal_context().data
+        ct = sealapi.Ciphertext()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ct")
+            with open(path, 'wb') as f:
+                f.write(data)
+            ct.load(seal_context, path)
+        plain = sealapi.Plaintext()
+        sealapi.Decryptor(seal_context, context.secret_key().data).decrypt(ct, plain)
+        if SecureAggregator.is_bfv(context):
+            return sealapi.BatchEncoder(seal_context).decode_int64(plain)
+        return sealapi.CKKSEncoder(seal_context).decode_double(plain)
+
+class HEContextCache:
+    """
+    Thread-safe LRU cache of deserialized public HE contexts keyed by
+    SecureAggregator.context_id, so repeat aggregations from the same session
+    skip re-sending and re-deserializing multi-megabyte Galois keys.
+    """
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, context_id):
+        with self._lock:
+            context = self._contexts.get(context_id)
+            if context is not None:
+                self._contexts.move_to_end(context_id)
+            return context
+
+    def put(self, data: bytes) -> str:
+        """
+        Deserializes and stores a context; returns its content-hash ID.
+        """
+        context_id = SecureAggregator.context_id(data)
+        if self.get(context_id) is not None:
+            return context_id
+        context = SecureAggregator.deserialize_context(data)
+        with self._lock:
+            self._contexts[context_id] = context
+            self._contexts.move_to_end(context_id)
+            while len(self._contexts) > self.capacity:
+                self._contexts.popitem(last=False)
+        return context_id
+
+    def __contains__(self, context_id):
+        with self._lock:
+            return context_id in self._contexts
+
+    def __len__(self):
+        return len(self._contexts)
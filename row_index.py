@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+INT32 = np.iinfo(np.int32)
+
+def compact_columns(df, id_column="ID"):
+    """
+    Returns df with text columns (other than the ID) as category and integer
+    columns downcast to int32 when their values fit.
+    """
+    compact = {}
+    for name, column in df.items():
+        if name == id_column or isinstance(column.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(column):
+            if column.dtype != np.int32 and (not len(column) or (column.min() >= INT32.min and column.max() <= INT32.max)):
+                compact[name] = column.astype(np.int32)
+        elif not pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+            compact[name] = column.astype("category")
+    return df.assign(**compact) if compact else df
+
+class RowIndex:
+    """
+    Prebuilt ID -> row position index over a DataFrame, so lookups cost
+    O(len(ids)) instead of a scan of the whole frame. For duplicate IDs the
+    first row wins.
+    """
+    def __init__(self, df, id_column="ID"):
+        first = ~df[id_column].duplicated()
+        self.index = pd.Index(df[id_column][first])
+        self.positions = np.nonzero(first.to_numpy())[0]
+        self.columns = df.drop(columns=[id_column])
+
+    def locate(self, ids):
+        """
+        Returns (positions, rows): the positions in ids that are present, and
+        the other columns of their rows in the same order.
+        """
+        hits = self.index.get_indexer(list(ids))
+        found = np.nonzero(hits >= 0)[0]
+        return found, self.columns.iloc[self.positions[hits[found]]].reset_index(drop=True)
+
+def pack_rows(frame):
+    """
+    Packs numeric / categorical columns into one fixed-width record per row.
+    Returns (records as an n x width uint8 array, schema); categorical
+    columns are stored as their codes and the schema carries the categories.
+    """
+    fields = []
+    values = []
+    schema = []
+    for name, column in frame.items():
+        spec = {"name": name}
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            spec["categories"] = [str(c) for c in column.cat.categories]
+            column = column.cat.codes
+        array = column.to_numpy()
+        if array.dtype.kind not in "biuf":
+            raise ValueError(f"Column {name} is neither numeric nor categorical")
+        spec["dtype"] = array.dtype.str
+        fields.append((name, array.dtype))
+        values.append(array)
+        schema.append(spec)
+    records = np.empty(len(frame), dtype=fields)
+    for (name, _), array in zip(fields, values):
+        records[name] = array
+    return records.view(np.uint8).reshape(len(frame), records.dtype.itemsize), schema
+
+def unpack_rows(records, schema) -> pd.DataFrame:
+    """
+    Inverse of pack_rows.
+    """
+    dtype = np.dtype([(spec["name"], np.dtype(spec["dtype"])) for spec in schema])
+    rows = np.ascontiguousarray(records).view(dtype).ravel() if len(records) else np.empty(0, dtype=dtype)
+    columns = {}
+    for spec in schema:
+        column = rows[spec["name"]]
+        if "categories" in spec:
+            column = pd.Categorical.from_codes(column, spec["categories"])
+        columns[spec["name"]] = column
+    return pd.DataFrame(columns)
@@ -1,5 +1,19 @@
-from psi_protocol import PSIProtocol, SecureAggregator
+from point_array import PointArray
+from psi_protocol import encrypt_payloads, decrypt_payloads, PSIProtocol, SecureAggregator, HEContextCache, plan_he_params, SCHEME_BFV, truncate_points
 import tenseal as ts
+from metrics import Metrics
+from out_of_core import SpillFile, FileTable, intersect_files, iter_rows
+from blinded_cache import BlindedSetCache
+from curves import negotiate_curve, CURVE_PREFERENCE
+from event_log import EventLog, DEBUG, WARNING
+from aggregation import AggregationLayout, segment_vectors, group_stride
+from cardinality import hash_ids, sample_mask, estimate_cardinality
+import threading
+from row_index import RowIndex, compact_columns, pack_rows, unpack_rows
+import network_utils
+import numpy as np
+import os
+import tempfile
 import pandas as pd
 
 def test_psi():
@@ -16,40 +30,23 @@ def test_psi():
     
     # 1. Alice Blinds (a * H(x))
     print("Alice computes a*H(x)...")
-    alice_blinded = []
-    for x in alice_items:
-        pt = alice.hash_to_curve_public_key(x)
-        blinded = alice.apply_private_key(pt)
-        alice_blinded.append(blinded)
+    alice_blinded = alice.blind_many(alice_items)
         
     # 2. Bob receives a*H(x). Computes b*(a*H(x)).
     print("Bob computes b*(a*H(x))...")
-    alice_blinded_by_bob = []
-    for p in alice_blinded:
-        res = bob.apply_private_key(p)
-        alice_blinded_by_bob.append(res)
+    alice_blinded_by_bob = bob.reblind_many(alice_blinded)
         
     # 3. Bob sends b*H(y).
     print("Bob computes b*H(y)...")
-    bob_blinded = []
-    for y in bob_items:
-        pt = bob.hash_to_curve_public_key(y)
-        blinded = bob.apply_private_key(pt)
-        bob_blinded.append(blinded)
+    bob_blinded = bob.blind_many(bob_items)
         
     # 4. Alice receives b*H(y). Computes a*(b*H(y)).
     print("Alice computes a*(b*H(y))...")
-    bob_blinded_by_alice = []
-    for p in bob_blinded:
-        res = alice.apply_private_key(p)
-        bob_blinded_by_alice.append(res)
+    bob_blinded_by_alice = alice.reblind_many(bob_blinded)
         
     # 5. Intersect
-    bob_set = set(bob_blinded_by_alice)
-    intersection = []
-    for i, val in enumerate(alice_blinded_by_bob):
-        if val in bob_set:
-            intersection.append(alice_items[i])
+    indices = alice_blinded_by_bob.intersect_indices(bob_blinded_by_alice)
+    intersection = [alice_items[i] for i in indices]
             
     print(f"Intersection: {intersection}")
     assert set(intersection) == {"2", "3"}
@@ -94,6 +91,384 @@ def test_aggregation():
     assert math.isclose(decrypted, expected, abs_tol=0.1)
     print("Aggregation Test Passed!")
 
+def test_group_sum():
+    print("Testing Packed Group-By Logic...")
+    context = SecureAggregator.create_context()
+    
+    # Totals: [110, 220, 330, 440], Groups: [0, 1, 0, 2]
+    enc_totals = SecureAggregator.encrypt_vector(context, [110.0, 220.0, 330.0, 440.0])
+    packed = SecureAggregator.group_sum(context, enc_totals, [0, 1, 0, 2], num_groups=3)
+    
+    # Send back as one ciphertext, Alice decrypts once
+    slots = SecureAggregator.decrypt_packed(context, SecureAggregator.serialize_ciphertext(packed))
+    
+    print(f"Decrypted Group Sums: {slots[:3]}")
+    import math
+    for got, expected in zip(slots[:3], [440, 220, 440]):
+        assert math.isclose(got, expected, abs_tol=0.1)
+    print("Group-By Test Passed!")
+
+def test_context_cache():
+    print("Testing HE Context Cache...")
+    context = SecureAggregator.create_context()
+    data = context.serialize(save_secret_key=False)
+
+    cache = HEContextCache(capacity=1)
+    context_id = cache.put(data)
+    assert context_id == SecureAggregator.context_id(data)
+    assert context_id in cache and cache.get(context_id) is not None
+    assert cache.get("unknown") is None
+    print("Context Cache Test Passed!")
+
+def test_param_planner():
+    print("Testing HE Parameter Planner...")
+    small = plan_he_params(num_values=10, num_groups=3, max_value=100)
+    large = plan_he_params(num_values=4096, num_groups=5, max_value=200000)
+    print(f"Small job: {small}, Large job: {large}")
+    assert small.poly_modulus_degree < large.poly_modulus_degree
+    assert plan_he_params(100, num_groups=5000).slot_count >= 8192
+    # The special prime is never smaller than a data prime, even when the scale is the largest
+    for params in (large, plan_he_params(1_000_000, 5, max_value=170000), plan_he_params(1000, depth=3)):
+        assert params.coeff_mod_bit_sizes[-1] >= max(params.coeff_mod_bit_sizes[:-1])
+    assert plan_he_params(1000, depth=3).depth == 3
+
+    # Sums of the largest planned job still decrypt within the requested precision
+    context = SecureAggregator.create_context(large)
+    values = [200000.0] * 4096
+    enc = SecureAggregator.encrypt_vector(context, values)
+    packed = SecureAggregator.group_sum(context, enc, [i % 5 for i in range(4096)], num_groups=5)
+    slots = SecureAggregator.decrypt_packed(context, SecureAggregator.serialize_ciphertext(packed))
+    import math
+    for got, expected in zip(slots[:5], [sum(values[g::5]) for g in range(5)]):
+        assert math.isclose(got, expected, abs_tol=0.01)
+    print("Parameter Planner Test Passed!")
+
+def test_bfv_group_sum():
+    print("Testing Exact BFV Group-By...")
+    params = plan_he_params(num_values=4, num_groups=3, max_value=440, scheme=SCHEME_BFV)
+    context = SecureAggregator.create_context(params)
+
+    enc_totals = SecureAggregator.encrypt_vector(context, [110, 220, 330, 440])
+    packed = SecureAggregator.group_sum(context, enc_totals, [0, 1, 0, 2], num_groups=3)
+    slots = SecureAggregator.decrypt_packed(context, SecureAggregator.serialize_ciphertext(packed))
+
+    print(f"Decrypted Group Sums: {slots[:3]}")
+    assert list(slots[:3]) == [440, 220, 440]
+    print("BFV Group-By Test Passed!")
+
+def test_metrics():
+    print("Testing Metrics Registry...")
+    metrics = Metrics(prefix="test_")
+    psi = PSIProtocol(workers=1, metrics=metrics)
+    psi.blind_many(["1", "2", "3"])
+    metrics.observe("command_seconds", 0.02, command="PSI")
+
+    text = metrics.render()
+    assert 'test_items_blinded_total{op="blind"} 3' in text
+    assert 'test_command_seconds_bucket{command="PSI",le="0.05"} 1' in text
+    assert 'test_command_seconds_count{command="PSI"} 1' in text
+    # Label values can't break out of their quotes or the line
+    metrics.inc("odd_total", label='a\\b"}\nx 1')
+    assert 'test_odd_total{label="a\\\\b\\"}\\nx 1"} 1' in metrics.render()
+    print("Metrics Test Passed!")
+
+def test_out_of_core():
+    print("Testing Out-of-Core Intersection...")
+    rng = np.random.default_rng(0)
+    shared = rng.integers(0, 256, (300, 32), dtype=np.uint8)
+    alice = np.concatenate([rng.integers(0, 256, (700, 32), dtype=np.uint8), shared])[rng.permutation(1000)]
+    bob = np.concatenate([shared, rng.integers(0, 256, (500, 32), dtype=np.uint8)])
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        spills = []
+        for name, data in (("alice", alice), ("bob", bob)):
+            spill = SpillFile(os.path.join(work_dir, f"{name}.bin"))
+            for i in range(0, len(data), 128):
+                spill.append(PointArray(data[i:i + 128]))
+            spills.append(spill.points())
+        # A tiny memory budget forces several buckets
+        out_path = os.path.join(work_dir, "intersection.npy")
+        count = intersect_files(spills[0], spills[1], out_path, work_dir, memory_bytes=4096)
+        expected = PointArray(alice).intersect_indices(PointArray(bob))
+        assert count == 300 and np.array_equal(np.load(out_path), expected)
+
+        # Lazy row reads and ID lookups against a CSV file
+        csv_path = os.path.join(work_dir, "bob.csv")
+        pd.DataFrame({"ID": [f"id{i}" for i in range(50)], "Department": ["HR", "Sales"] * 25,
+                      "Bonus": range(50)}).to_csv(csv_path, index=False)
+        rows = pd.concat(iter_rows(csv_path, np.array([3, 17, 42]), chunk_size=10))
+        assert rows["ID"].tolist() == ["id3", "id17", "id42"]
+        table = FileTable.build(csv_path, os.path.join(work_dir, "table"), ["Department", "Bonus"],
+                                chunk_size=16, memory_bytes=256)
+        found = table.lookup(["id42", "missing", "id3"])
+        assert found.to_dict("records") == [{"ID": "id42", "Department": "HR", "Bonus": 42},
+                                            {"ID": "id3", "Department": "Sales", "Bonus": 3}]
+
+        # Colliding hashes still find the right row (and nothing for unknown IDs)
+        class CollidingTable(FileTable):
+            @staticmethod
+            def _hash(ids):
+                return FileTable._hash(ids) % np.uint64(4)
+        table = CollidingTable.build(csv_path, os.path.join(work_dir, "colliding"), ["Department", "Bonus"],
+                                     chunk_size=16, memory_bytes=256)
+        found = table.lookup(["id42", "missing", "id3", "id0"])
+        assert found["ID"].tolist() == ["id42", "id3", "id0"] and found["Bonus"].tolist() == [42, 3, 0]
+    print("Out-of-Core Test Passed!")
+
+def test_indexed_join():
+    print("Testing Indexed Columnar JOIN...")
+    df = compact_columns(pd.DataFrame({"ID": ["a", "b", "c"], "Department": ["HR", "Sales", "HR"],
+                                       "Bonus": [10, 20, 30]}))
+    assert isinstance(df["Department"].dtype, pd.CategoricalDtype) and df["Bonus"].dtype == np.int32
+    positions, rows = RowIndex(df).locate(["c", "x", "a"])
+    assert positions.tolist() == [0, 2]
+
+    # Columns travel as raw buffers and come back with the same dtypes
+    frame = b"".join(bytes(p) for p in network_utils.encode_frame({"positions": positions, "columns": rows}))
+    frame_type, _ = network_utils.HEADER.unpack_from(frame)
+    msg = network_utils.decode_frame(frame_type, frame[network_utils.HEADER.size:])
+    assert frame_type == network_utils.FRAME_BINARY
+    assert msg["positions"].tolist() == [0, 2]
+    assert msg["columns"]["Department"].tolist() == ["HR", "HR"] and msg["columns"]["Bonus"].tolist() == [30, 10]
+    assert msg["columns"]["Bonus"].dtype == np.int32
+    print("Indexed JOIN Test Passed!")
+
+def test_psi_payload():
+    print("Testing PSI with Payload...")
+    alice = PSIProtocol(workers=1)
+    bob = PSIProtocol(workers=1)
+    bob_payload = bob.derive("payload")
+    alice_items = ["1", "2", "3"]
+    bob_items = ["4", "3", "2"]
+    bob_rows = compact_columns(pd.DataFrame({"Department": ["HR", "Sales", "HR"], "Bonus": [40, 30, 20]}))
+
+    # Bob: A^ab, A^ab2, B^b and his rows encrypted under keys from H(y)^b2
+    alice_blinded = alice.blind_many(alice_items)
+    alice_ab = bob.reblind_many(alice_blinded)
+    alice_ab2 = bob_payload.reblind_many(alice_blinded)
+    records, schema = pack_rows(bob_rows)
+    payloads = encrypt_payloads(bob_payload.blind_many(bob_items), records)
+
+    # Alice: match, then open only the matching payloads with H(x)^b2
+    found = alice_ab.find(alice.reblind_many(bob.blind_many(bob_items)))
+    assert found.tolist() == [-1, 2, 1]
+    matched = np.nonzero(found >= 0)[0]
+    ok, opened = decrypt_payloads(alice.unblind_many(alice_ab2[matched]), payloads[found[matched]])
+    rows = unpack_rows(opened[ok], schema)
+    assert ok.all() and rows["Bonus"].tolist() == [20, 30] and rows["Department"].tolist() == ["HR", "Sales"]
+    # Keys of non-members don't open anything
+    ok, _ = decrypt_payloads(alice.unblind_many(alice_ab2[:1]), payloads[:1])
+    assert not ok.any()
+    print("PSI with Payload Test Passed!")
+
+def test_blinded_set_changes():
+    print("Testing Blinded Set Change Log...")
+    psi = PSIProtocol(workers=1)
+    cache = BlindedSetCache(psi, max_change_items=4)
+    cache.sync(["1", "2"])
+    start = cache.token()
+    cache.add(["3"])
+    cache.remove(["1", "3"])
+    token, added, removed = cache.changes_since(start)
+    assert token == cache.token()
+    assert len(added) == 0 and set(removed) == set(psi.blind_many(["1"]))
+    assert cache.changes_since(cache.token())[1:] == ([], [])
+    # Same version number from another cache history (e.g. a deleted cache file): full resync
+    restarted = BlindedSetCache(psi)
+    restarted.sync(["1", "2"])
+    assert restarted.changes_since(start) is None
+    # Older than the log reaches: the caller has to take the full set
+    cache.add(["4", "5", "6"])
+    assert cache.changes_since(start) is None
+    print("Blinded Set Change Log Test Passed!")
+
+def test_curves():
+    print("Testing Curve Backends...")
+    items = ["1", "2", "3"]
+    for curve in ("p256", "x25519"):
+        alice = PSIProtocol(workers=1, curve=curve)
+        bob = PSIProtocol(workers=1, curve=curve)
+        # Commutative blinding and unblinding behave the same on every backend
+        alice_ab = bob.reblind_many(alice.blind_many(items))
+        assert alice_ab == alice.reblind_many(bob.blind_many(items))
+        assert alice.unblind_many(alice_ab) == bob.blind_many(items)
+        assert alice.blind("2") == alice.apply_private_key(alice.hash_to_curve_public_key("2"))
+        # Derived and reloaded keys are usable keys of the same curve
+        derived = bob.derive("payload")
+        assert derived.curve.name == curve and derived.key_fingerprint() != bob.key_fingerprint()
+        path = os.path.join(tempfile.mkdtemp(), "key.pem")
+        assert PSIProtocol.from_key_file(path, curve=curve).key_fingerprint() == \
+            PSIProtocol.from_key_file(path, curve=curve).key_fingerprint()
+    assert negotiate_curve(CURVE_PREFERENCE, ["p256"]) == "p256"
+    assert negotiate_curve(["p256"], ["x25519"]) is None
+    print("Curve Backends Test Passed!")
+
+def test_event_log():
+    print("Testing Event Log...")
+    events = EventLog(capacity=4, echo=False)
+    events.debug("hidden")
+    for i in range(3):
+        events.info(f"event {i}", step=i)
+    batch, cursor = events.since(0)
+    assert [e.message for e in batch] == ["event 0", "event 1", "event 2"] and cursor == 3
+    assert batch[1].fields == {"step": 1}
+    # Tailing from the cursor returns only new events; old ones are overwritten
+    events.warning("event 3")
+    events.error("event 4")
+    batch, cursor = events.since(cursor)
+    assert [e.message for e in batch] == ["event 3", "event 4"] and cursor == 5
+    assert [e.seq for e in events.since(0)[0]] == [1, 2, 3, 4] and len(events) == 4
+    assert events.lines(4)[0].endswith("ERROR: event 4")
+    assert events.since(cursor) == ([], 5)
+
+    # Concurrent writers: nothing lost beyond the capacity bound
+    events = EventLog(capacity=1000, level=DEBUG, echo=False)
+    threads = [threading.Thread(target=lambda: [events.debug("x") for _ in range(500)]) for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert events.cursor == 2000 and [e.seq for e in events.since(0)[0]] == list(range(1000, 2000))
+
+    # Disabled or filtered: no-op
+    off = EventLog(level=None, echo=False)
+    off.error("dropped")
+    assert len(off) == 0 and not off.enabled_for(WARNING)
+    print("Event Log Test Passed!")
+
+def test_secure_aggregation_stats():
+    print("Testing Multi-Statistic Secure Aggregation...")
+    rng = np.random.default_rng(7)
+    n = 300
+    rows = pd.DataFrame({"Salary": rng.integers(30_000, 150_000, n), "Age": rng.integers(20, 61, n)})
+    bonuses = rng.integers(0, 20_000, n)
+    departments = rng.choice(["HR", "Sales", "Tech"], n)
+    group_slots = {"HR": 0, "Sales": 1, "Tech": 2}
+    stats = [("TotalComp", "sum"), ("TotalComp", "mean"), ("Salary", "var"), ("Bonus", "std"), "count"]
+    frame = rows.assign(Bonus=bonuses, Department=departments, TotalComp=rows["Salary"] + bonuses)
+
+    def run(scheme, group_by, bins=None):
+        # Alice encodes, Bob applies his side and sums per group, Alice decodes
+        layout = AggregationLayout(stats, group_by, bins)
+        layout.set_rows(rows)
+        groups = group_slots if layout.by_bob else {"*": 0}
+        stride = group_stride(len(groups))
+        num_segments, num_slots, max_value = layout.plan(1 << 15, scheme, stride)
+        params = plan_he_params(n * num_segments, num_slots, max_value, precision=0.01, scheme=scheme)
+        integer = scheme == SCHEME_BFV
+        assert layout.pack(params.slot_count, bfv=integer) >= n
+        context = SecureAggregator.create_context(params)
+        enc = SecureAggregator.encrypt_vector(context, layout.encode(0, n, integer))
+        rows_group = pd.Series(departments if layout.by_bob else ["*"] * n).map(groups).to_numpy()
+        index, num_groups, span, weights, addends = segment_vectors(layout.wire(), bonuses, rows_group, stride, integer)
+        if addends is not None:
+            enc = enc + addends.tolist()
+        packed = SecureAggregator.group_sum(context, enc, index, num_groups, weights, span)
+        slots = SecureAggregator.decrypt_packed(context, SecureAggregator.serialize_ciphertext(packed))
+        return layout.decode(slots, groups, stride)
+
+    def expected(keys):
+        grouped = frame.groupby(keys, observed=True)
+        return pd.DataFrame({
+            "TotalComp_sum": grouped["TotalComp"].sum(),
+            "TotalComp_mean": grouped["TotalComp"].mean(),
+            "Salary_var": grouped["Salary"].var(ddof=0),
+            "Bonus_std": grouped["Bonus"].std(ddof=0),
+            "count": grouped.size()
+        })
+
+    for scheme in ("ckks", SCHEME_BFV):
+        got = run(scheme, ["Department"]).set_index("Department").sort_index()
+        want = expected("Department")
+        assert list(got["count"]) == list(want["count"])
+        if scheme == SCHEME_BFV:
+            assert list(got["TotalComp_sum"]) == list(want["TotalComp_sum"])
+        for column in want.columns:
+            assert np.allclose(got[column], want[column], rtol=1e-6, atol=1.0), (scheme, column)
+
+    # An Alice-side band next to Bob's Department, and no grouping at all
+    bins = {"Age": [20, 40, 61]}
+    got = run(SCHEME_BFV, ["Department", "Age"], bins)
+    frame["Age"] = pd.cut(frame["Age"], bins["Age"], right=False)
+    got = got.set_index(["Department", "Age"]).sort_index()
+    want = expected(["Department", "Age"]).sort_index()
+    assert len(got) == len(want) and list(got["count"]) == list(want["count"])
+    assert np.allclose(got["Salary_var"], want["Salary_var"], rtol=1e-9)
+    got = run("ckks", [])
+    assert got["count"].tolist() == [n] and np.isclose(got["TotalComp_mean"][0], frame["TotalComp"].mean())
+    print("Multi-Statistic Secure Aggregation Test Passed!")
+
+def test_psi_cardinality():
+    print("Testing Sampled PSI Cardinality...")
+    alice_ids = [f"user{i}" for i in range(0, 6000)]
+    bob_ids = [f"user{i}" for i in range(4000, 12000)]
+    # Coordinated sample: a shared ID is sampled on both sides or on neither
+    rate, seed = 0.25, 12345
+    alice_mask = sample_mask(hash_ids(alice_ids), rate, seed)
+    bob_mask = sample_mask(hash_ids(bob_ids), rate, seed)
+    assert np.array_equal(alice_mask[4000:], bob_mask[:2000])
+    assert abs(alice_mask.mean() - rate) < 0.03
+    assert not np.array_equal(alice_mask, sample_mask(hash_ids(alice_ids), rate, seed + 1))
+    assert sample_mask(hash_ids(alice_ids), 1.0, seed).all()
+    # Nested: a lower rate (Bob capping his larger side) samples a subset
+    assert not (sample_mask(hash_ids(alice_ids), 0.1, seed) & ~alice_mask).any()
+
+    # Compact PSI on the samples; Bob's shuffle doesn't change the count
+    alice, bob = PSIProtocol(workers=1), PSIProtocol(workers=1)
+    alice_sample = [x for x, keep in zip(alice_ids, alice_mask) if keep]
+    bob_sample = bob.blind_many([y for y, keep in zip(bob_ids, bob_mask) if keep])
+    reblinded = bob.reblind_many(alice.blind_many(alice_sample))
+    reblinded = reblinded[np.random.default_rng(0).permutation(len(reblinded))]
+    matches = int(truncate_points(alice.unblind_many(reblinded), 8).isin(truncate_points(bob_sample, 8)).sum())
+    assert matches == int(alice_mask[4000:].sum())
+
+    estimate = estimate_cardinality(matches, rate, len(alice_ids), len(bob_ids))
+    assert estimate.low <= 2000 <= estimate.high and estimate.low >= matches
+    assert estimate_cardinality(0, 0.01, 100, 1000).high == 100
+    assert estimate_cardinality(7, 1.0, 100, 1000)[:3] == (7, 7, 7)
+    print("Sampled PSI Cardinality Test Passed!")
+
+def test_frame_limits():
+    print("Testing Frame Limits...")
+    import socket
+    left, right = socket.socketpair()
+    try:
+        network_utils.send_msg(left, {"command": "PSI_HELLO", "curves": ["p256"]})
+        assert network_utils.recv_msg(right, max_bytes=1024)["command"] == "PSI_HELLO"
+        # A lying header is refused before its payload is allocated
+        left.sendall(network_utils.HEADER.pack(network_utils.FRAME_BINARY, 2**63))
+        try:
+            network_utils.recv_msg(right, max_bytes=1024)
+            assert False, "oversized frame accepted"
+        except network_utils.FrameTooLarge:
+            pass
+        # Servers refuse pickle frames
+        network_utils.send_msg(left, ["not", "a", "dict"])
+        try:
+            network_utils.recv_msg(right, allow_pickle=False)
+            assert False, "pickle frame accepted"
+        except ValueError:
+            pass
+    finally:
+        left.close()
+        right.close()
+    # NumPy scalars stay on the binary path
+    frame = network_utils.encode_frame({"count": np.int64(3), "rate": np.float32(0.5)})[0]
+    assert network_utils.HEADER.unpack_from(frame)[0] == network_utils.FRAME_BINARY
+    print("Frame Limits Test Passed!")
+
 if __name__ == "__main__":
     test_psi()
     test_aggregation()
+    test_group_sum()
+    test_context_cache()
+    test_param_planner()
+    test_bfv_group_sum()
+    test_metrics()
+    test_out_of_core()
+    test_indexed_join()
+    test_psi_payload()
+    test_blinded_set_changes()
+    test_curves()
+    test_event_log()
+    test_secure_aggregation_stats()
+    test_psi_cardinality()
+    test_frame_limits()